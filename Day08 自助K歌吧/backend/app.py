@@ -1,21 +1,125 @@
 import io
 import os
+import json
+import math
 import uuid
+import asyncio
+import hashlib
+import re
+import shutil
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi.responses import JSONResponse, FileResponse, HTMLResponse, StreamingResponse
+from pydantic import BaseModel
 
-from .demucs_service import separate_vocals_and_instrumental
+from .audio_codecs import parse_formats
+from .jobs import FINISHED, JobManager, QueueFull
+from .keyshift import SEMITONE_RANGE, TEMPO_RANGE, KeyShiftRenderer, find_stem, read_audio
+from .mixdown import MixdownRenderer
+from .pitch_track import PITCH_SUFFIX, PitchTrackCache, SingingScore, build_pitch_track, find_pitch_track
+from .waveform import TRACKS, PeakFileCache, peaks_path, write_peaks
+from .playlist import PRIORITY_BASE, PlaylistFull, PlaylistRegistry
+from .static_files import CachedStaticFiles
+from .stem_cache import INDEX_NAME, StemCache, cache_key
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 FRONTEND_DIR = BASE_DIR / "frontend"
 STORAGE_DIR = BASE_DIR / "storage"
 STORAGE_DIR.mkdir(exist_ok=True, parents=True)
 
+# 分離結果快取：STORAGE_DIR 的磁碟預算與孤兒 session 清理
+STORAGE_BUDGET_MB = int(os.environ.get("STORAGE_BUDGET_MB", "5120"))
+JANITOR_INTERVAL_SEC = float(os.environ.get("JANITOR_INTERVAL_SEC", "600"))
+ORPHAN_GRACE_SEC = float(os.environ.get("ORPHAN_GRACE_SEC", "3600"))
+UPLOAD_CHUNK = 1 << 20
+
+# 分離工作佇列：worker 行程數與最多排隊數
+SEPARATION_WORKERS = int(os.environ.get("SEPARATION_WORKERS", "1"))
+SEPARATION_QUEUE_MAX = int(os.environ.get("SEPARATION_QUEUE_MAX", "16"))
+# 串流模式（邊分離邊播放）的時間窗與交叉淡化長度
+STREAM_WINDOW_SEC = float(os.environ.get("STREAM_WINDOW_SEC", "30"))
+STREAM_OVERLAP_SEC = float(os.environ.get("STREAM_OVERLAP_SEC", "2"))
+# 輸出格式：逗號分隔，第一個非 flac 的格式作為播放用（wav / flac / opus / aac）
+STEM_FORMATS = parse_formats(os.environ.get("STEM_FORMATS", "aac,flac"))
+# CPU 平行分段：每個工作使用的分段行程數（0/1 = 關閉）與每個行程的 torch 執行緒數
+SEPARATION_PROCESSES = int(os.environ.get("SEPARATION_PROCESSES", "0"))
+SEPARATION_TORCH_THREADS = int(os.environ.get("SEPARATION_TORCH_THREADS", "0"))
+# 待唱清單：每個包廂最多登錄幾首（背景預先分離）
+PLAYLIST_MAX = int(os.environ.get("PLAYLIST_MAX", "50"))
+ROOM_RE = re.compile(r"^[\w-]{1,64}$")
+# 移調/變速版本的算圖行程數
+KEYSHIFT_WORKERS = int(os.environ.get("KEYSHIFT_WORKERS", "2"))
+SESSION_RE = re.compile(r"^[0-9a-f]{8}$")
+# 即時評分：與參考音高相差幾 cents 以內算唱對
+SCORE_TOLERANCE_CENTS = float(os.environ.get("SCORE_TOLERANCE_CENTS", "50"))
+# 錄音混音：行程數、上傳大小上限與輸出格式
+MIXDOWN_WORKERS = int(os.environ.get("MIXDOWN_WORKERS", "2"))
+MIXDOWN_MAX_MB = int(os.environ.get("MIXDOWN_MAX_MB", "100"))
+MIXDOWN_FORMATS = parse_formats(os.environ.get("MIXDOWN_FORMATS", "aac"))
+
+stem_cache = StemCache(STORAGE_DIR, STORAGE_BUDGET_MB * 1024 * 1024)
+STARTED_AT = time.time()
+
+def _storage_url(path: str) -> str:
+    return "/storage/" + Path(os.path.relpath(path, STORAGE_DIR)).as_posix()
+
+def _session_payload(session_dir: Path, in_path: str, result: dict) -> dict:
+    # 產出可下載的 URL
+    files = result.get("files", {})
+    return {
+        "session": session_dir.name[len("session_"):],
+        "original": _storage_url(in_path),
+        "vocals": _storage_url(result["vocals"]),
+        "instrumental": _storage_url(result["no_vocals"]),
+        "pitch": _storage_url(result["pitch"]) if result.get("pitch") else None,
+        "downloads": {
+            "vocals": {fmt: _storage_url(p) for fmt, p in files.get("vocals", {}).items()},
+            "instrumental": {fmt: _storage_url(p) for fmt, p in files.get("no_vocals", {}).items()},
+        },
+    }
+
+def _on_job_finish(job, status: str, result: Optional[dict]) -> Optional[dict]:
+    session_dir = Path(job.output_dir)
+    if status != "done":
+        shutil.rmtree(session_dir, ignore_errors=True)
+        return None
+    cached = stem_cache.lookup(job.key, record=False)
+    if cached is not None:
+        # 同一首歌的串流與一般工作同時執行，先完成的已存入快取：沿用它，避免留下未登錄的目錄
+        shutil.rmtree(session_dir, ignore_errors=True)
+        return {**cached, "cached": True}
+    payload = _session_payload(session_dir, job.audio_path, result)
+    stem_cache.store(job.key, session_dir, payload)
+    return {**payload, "cached": False}
+
+job_manager = JobManager(
+    workers=SEPARATION_WORKERS,
+    max_queue=SEPARATION_QUEUE_MAX,
+    on_finish=_on_job_finish,
+    url_for=_storage_url,
+    options={
+        "formats": STEM_FORMATS,
+        "processes": SEPARATION_PROCESSES,
+        "torch_threads": SEPARATION_TORCH_THREADS,
+    },
+)
+
+def _on_variant_done(path: str):
+    # 移調版本（含背景預先算出的 ±1 半音）寫在 session 目錄內，計入快取預算
+    stem_cache.refresh_size(Path(path).parent.name)
+
+playlists = PlaylistRegistry(max_items=PLAYLIST_MAX)
+keyshift = KeyShiftRenderer(workers=KEYSHIFT_WORKERS, formats=STEM_FORMATS, on_done=_on_variant_done)
+pitch_tracks = PitchTrackCache()
+peak_files = PeakFileCache()
+mixer = MixdownRenderer(workers=MIXDOWN_WORKERS, formats=MIXDOWN_FORMATS)
+_backfills: Dict[str, asyncio.Task] = {}
+
 app = FastAPI(title="Self-Serve KTV (Demucs)")
 app.add_middleware(
     CORSMiddleware,
@@ -27,7 +131,27 @@ app.add_middleware(
 
 # 靜態檔案：前端與輸出檔
 app.mount("/assets", StaticFiles(directory=str(FRONTEND_DIR)), name="assets")
-app.mount("/storage", StaticFiles(directory=str(STORAGE_DIR)), name="storage")
+app.mount("/storage", CachedStaticFiles(directory=str(STORAGE_DIR), hidden=(INDEX_NAME,)), name="storage")
+
+async def _janitor_loop():
+    while True:
+        await asyncio.to_thread(stem_cache.janitor, ORPHAN_GRACE_SEC, job_manager.active_dirs())
+        await asyncio.sleep(JANITOR_INTERVAL_SEC)
+
+@app.on_event("startup")
+async def start_background():
+    job_manager.start()
+    keyshift.start()
+    mixer.start()
+    app.state.janitor = asyncio.create_task(_janitor_loop())
+
+@app.on_event("shutdown")
+async def stop_background():
+    app.state.janitor.cancel()
+    job_manager.shutdown()
+    keyshift.shutdown()
+    mixer.shutdown()
+    stem_cache.flush()
 
 @app.get("/", response_class=HTMLResponse)
 def root():
@@ -36,37 +160,371 @@ def root():
         return index.read_text(encoding="utf-8")
     return HTMLResponse("<h1>Frontend not found.</h1>")
 
-@app.post("/api/separate")
-async def separate(file: UploadFile = File(...), model: Optional[str] = "htdemucs"):
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No filename.")
-
-    # 儲存上傳音檔到 session 目錄
+async def _receive_upload(file: UploadFile, model_name: str):
+    """儲存上傳音檔到新的 session 目錄，邊寫入邊計算 SHA-256；回傳 (session_dir, in_path, 快取鍵)。"""
     session_id = uuid.uuid4().hex[:8]
     session_dir = STORAGE_DIR / f"session_{session_id}"
     session_dir.mkdir(parents=True, exist_ok=True)
 
-    in_path = session_dir / file.filename
-    data = await file.read()
+    in_path = session_dir / Path(file.filename).name
+    hasher = hashlib.sha256()
     with open(in_path, "wb") as f:
-        f.write(data)
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            f.write(chunk)
+    return session_dir, in_path, cache_key(hasher.hexdigest(), model_name)
+
+@app.post("/api/separate")
+async def separate(file: UploadFile = File(...), model: Optional[str] = "htdemucs", stream: bool = False):
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No filename.")
 
+    model_name = model or "htdemucs"
+    session_dir, in_path, key = await _receive_upload(file, model_name)
+    cached = await asyncio.to_thread(stem_cache.lookup, key)
+    if cached is not None:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        return JSONResponse({"status": "done", "result": {**cached, "cached": True}})
+
+    # 交給背景行程池分離，立即回傳工作 ID
     try:
-        result = separate_vocals_and_instrumental(str(in_path), str(session_dir), model_name=model or "htdemucs")
+        stream_opts = {"window_sec": STREAM_WINDOW_SEC, "overlap_sec": STREAM_OVERLAP_SEC} if stream else None
+        job = job_manager.submit(key, str(in_path), str(session_dir), model_name, stream=stream_opts)
+    except QueueFull:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise HTTPException(status_code=503, detail="Separation queue is full, try again later.")
+    if Path(job.output_dir) != session_dir:
+        # 同一首歌已在分離中，共用既有工作
+        shutil.rmtree(session_dir, ignore_errors=True)
+    return JSONResponse(job_manager.snapshot(job.id), status_code=202)
+
+@app.get("/api/jobs/{job_id}")
+def job_status(job_id: str):
+    snap = job_manager.snapshot(job_id)
+    if snap is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return snap
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    if job_manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def stream():
+        # SSE：狀態有變化就推送，工作結束後關閉
+        last = None
+        while True:
+            snap = job_manager.snapshot(job_id)
+            if snap is None:
+                break
+            if snap != last:
+                yield f"data: {json.dumps(snap, ensure_ascii=False)}\n\n"
+                last = snap
+            if snap["status"] in FINISHED:
+                break
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.delete("/api/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job_manager.snapshot(job_id)
+
+class PlaylistOrder(BaseModel):
+    order: List[str]
+
+def _check_room(room: str):
+    if not ROOM_RE.match(room):
+        raise HTTPException(status_code=400, detail="Invalid room id.")
+
+def _sync_playlist_priorities():
+    # 依各包廂清單的最新順序調整背景工作優先序（不動有人正在等待的 priority 0 工作）
+    for job_id, priority in playlists.job_priorities().items():
+        job = job_manager.get(job_id)
+        if job is not None and job.priority > 0:
+            job_manager.reprioritize(job_id, priority)
+
+def _playlist_view(room: str) -> dict:
+    items = []
+    for position, item in enumerate(playlists.items(room)):
+        view = {"id": item.id, "filename": item.filename, "position": position, "status": "queued", "progress": 0.0}
+        snap = job_manager.snapshot(item.job_id) if item.job_id else None
+        if item.result is not None:
+            view.update(status="done", progress=1.0, result=item.result)
+        elif snap is not None:
+            view.update(status=snap["status"], progress=snap["progress"], eta=snap["eta"])
+            if snap.get("result"):
+                view["result"] = snap["result"]
+        else:
+            # 工作紀錄已過期：改查快取
+            cached = stem_cache.lookup(item.key, record=False)
+            if cached is not None:
+                view.update(status="done", progress=1.0, result=cached)
+            else:
+                view["status"] = "missing"
+        items.append(view)
+    return {"room": room, "items": items}
+
+@app.get("/api/playlist/{room}")
+def get_playlist(room: str):
+    _check_room(room)
+    return _playlist_view(room)
+
+@app.post("/api/playlist/{room}/songs")
+async def add_playlist_song(room: str, file: UploadFile = File(...), model: Optional[str] = "htdemucs",
+                            position: Optional[int] = None):
+    """登錄一首待唱歌曲；依在清單中的位置於背景預先分離。"""
+    _check_room(room)
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No filename.")
+    model_name = model or "htdemucs"
+    session_dir, in_path, key = await _receive_upload(file, model_name)
+    try:
+        item = playlists.add(room, key, Path(file.filename).name, position)
+    except PlaylistFull:
+        shutil.rmtree(session_dir, ignore_errors=True)
+        raise HTTPException(status_code=409, detail="Playlist is full.")
+
+    cached = await asyncio.to_thread(stem_cache.lookup, key)
+    if cached is not None:
+        item.result = {**cached, "cached": True}
+        shutil.rmtree(session_dir, ignore_errors=True)
+    else:
+        index = next(i for i, it in enumerate(playlists.items(room)) if it.id == item.id)
+        job = job_manager.submit(key, str(in_path), str(session_dir), model_name, priority=PRIORITY_BASE + index)
+        item.job_id = job.id
+        if Path(job.output_dir) != session_dir:
+            shutil.rmtree(session_dir, ignore_errors=True)
+    _sync_playlist_priorities()
+    # 清單檢視可能查詢快取（讀寫索引檔），不在事件迴圈中執行
+    return await asyncio.to_thread(_playlist_view, room)
+
+@app.put("/api/playlist/{room}")
+def reorder_playlist(room: str, req: PlaylistOrder):
+    """調整待唱順序（插隊）；背景工作會依新順序重新排程，必要時搶占。"""
+    _check_room(room)
+    playlists.reorder(room, req.order)
+    _sync_playlist_priorities()
+    return _playlist_view(room)
+
+@app.delete("/api/playlist/{room}/songs/{item_id}")
+def remove_playlist_song(room: str, item_id: str):
+    _check_room(room)
+    item = playlists.remove(room, item_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Song not found.")
+    if item.job_id and playlists.references(item.job_id) == 0:
+        job = job_manager.get(item.job_id)
+        if job is not None and job.priority > 0:
+            job_manager.cancel(item.job_id)
+    _sync_playlist_priorities()
+    return _playlist_view(room)
+
+@app.get("/api/keyshift")
+async def key_shift(session: str, semitones: int = 0, tempo: float = 1.0, stem: str = "instrumental"):
+    """回傳移調（可同時變速）後的伴奏或清唱；第一次請求時算圖並存在 session 目錄中。"""
+    if not SESSION_RE.match(session):
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+    if abs(semitones) > SEMITONE_RANGE or not (TEMPO_RANGE[0] <= tempo <= TEMPO_RANGE[1]):
+        raise HTTPException(status_code=400, detail=f"semitones must be within ±{SEMITONE_RANGE}, tempo within {TEMPO_RANGE}.")
+    if stem not in ("instrumental", "vocals"):
+        raise HTTPException(status_code=400, detail="stem must be 'instrumental' or 'vocals'.")
+    session_dir = STORAGE_DIR / f"session_{session}"
+    src = find_stem(str(session_dir), "no_vocals" if stem == "instrumental" else "vocals")
+    if src is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+
+    tempo = round(tempo, 2)
+    if semitones == 0 and tempo == 1.0:
+        return {"url": _storage_url(src), "semitones": 0, "tempo": 1.0}
+    try:
+        path = await keyshift.render(src, semitones, tempo)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Separation failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Key shift failed: {e}")
+    return {"url": _storage_url(path), "semitones": semitones, "tempo": tempo}
 
-    # 產出可下載的 URL
-    vocals_rel = os.path.relpath(result["vocals"], STORAGE_DIR)
-    nobox_rel = os.path.relpath(result["no_vocals"], STORAGE_DIR)
-
-    payload = {
-        "session": session_id,
-        "original": f"/storage/{os.path.relpath(in_path, STORAGE_DIR)}",
-        "vocals": f"/storage/{vocals_rel}",
-        "instrumental": f"/storage/{nobox_rel}",
+async def _backfill(path: str, fn, *args) -> str:
+    """舊的快取結果缺少衍生檔時在背景補算；同一個檔案同時只算一次。"""
+    task = _backfills.get(path)
+    if task is None:
+        task = _backfills[path] = asyncio.create_task(asyncio.to_thread(fn, *args))
+        task.add_done_callback(lambda _t: _backfills.pop(path, None))
+    return await asyncio.shield(task)
+
+def _build_missing_pitch(src: str) -> str:
+    wav, sr = read_audio(src)
+    base = os.path.basename(src).rsplit("_vocals", 1)[0]
+    return build_pitch_track(wav.mean(0), sr, os.path.join(os.path.dirname(src), base + PITCH_SUFFIX))
+
+async def _session_pitch_track(session_dir: Path):
+    """載入 session 的參考音高軌；舊的快取結果沒有時補算一次（同一 session 共用同一個工作）。"""
+    path = find_pitch_track(str(session_dir))
+    if path is None:
+        src = find_stem(str(session_dir), "vocals")
+        if src is None:
+            return None
+        path = await _backfill(src, _build_missing_pitch, src)
+        await asyncio.to_thread(stem_cache.refresh_size, session_dir.name)
+    return await asyncio.to_thread(pitch_tracks.get, path)
+
+@app.websocket("/ws/score/{session}")
+async def score_socket(ws: WebSocket, session: str):
+    """
+    即時歌唱評分。
+
+    用戶端送出 {"t": 播放秒數, "f0": 麥克風基頻 Hz}（或 {"frames": [[t, f0], ...]} 批次、
+    {"reset": true} 重新計分）；每一格以 O(1) 查表比對預先算好的參考音高，
+    回傳 {"t", "ref", "onset", "cents", "hit", "score"}。
+    """
+    await ws.accept()
+    if not SESSION_RE.match(session):
+        await ws.close(code=4400)
+        return
+    try:
+        track = await _session_pitch_track(STORAGE_DIR / f"session_{session}")
+    except Exception:
+        track = None
+    if track is None:
+        await ws.close(code=4404)
+        return
+
+    score = SingingScore(track, SCORE_TOLERANCE_CENTS)
+    await ws.send_json({"type": "ready", "duration": track.duration, "hop_ms": track.hop_ms})
+    try:
+        while True:
+            msg = await ws.receive_json()
+            if msg.get("reset"):
+                score = SingingScore(track, SCORE_TOLERANCE_CENTS)
+                await ws.send_json({"type": "reset", "score": 0.0})
+            elif "frames" in msg:
+                frames = [score.update(*_frame_values(t, f0)) for t, f0 in msg["frames"]]
+                await ws.send_json({"type": "frames", "frames": frames, "score": frames[-1]["score"] if frames else None})
+            else:
+                await ws.send_json({"type": "frame", **score.update(*_frame_values(msg["t"], msg.get("f0") or 0))})
+    except WebSocketDisconnect:
+        pass
+    except (AttributeError, KeyError, TypeError, ValueError):
+        await ws.close(code=1003)
+
+def _frame_values(t, f0) -> tuple:
+    """(時間, 基頻) 轉成 float；Infinity / NaN 視為格式錯誤（json 允許這些值）。"""
+    t, f0 = float(t), float(f0)
+    if not (math.isfinite(t) and math.isfinite(f0)):
+        raise ValueError("non-finite frame value")
+    return t, f0
+
+def _build_missing_peaks(src: str, dst: str) -> str:
+    wav, sr = read_audio(src)
+    return write_peaks(dst, wav, sr)
+
+def _original_path(session_dir: Path) -> Optional[str]:
+    payload = stem_cache.payload_for_dir(session_dir.name)
+    if payload is None:
+        return None
+    path = STORAGE_DIR / Path(payload["original"][len("/storage/"):])
+    return str(path) if path.is_file() else None
+
+@app.get("/api/waveform/{session}/{track}")
+async def waveform(session: str, track: str, start: float = 0.0, end: float = 0.0, width: int = 1000):
+    """
+    回傳某一軌在 [start, end) 秒（end=0 表示到結尾）內、約 width 像素寬的波形峰值。
+
+    由分離時預先算好的多解析度峰值檔讀取，回應只有數 KB，不必下載整個音檔。
+    """
+    if not SESSION_RE.match(session):
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+    if track not in TRACKS:
+        raise HTTPException(status_code=400, detail=f"track must be one of {', '.join(TRACKS)}.")
+    if not (1 <= width <= 10000) or start < 0 or (end and end <= start):
+        raise HTTPException(status_code=400, detail="Invalid viewport.")
+    session_dir = STORAGE_DIR / f"session_{session}"
+    path = peaks_path(str(session_dir), track)
+    if not os.path.exists(path):
+        if track == "original":
+            src = _original_path(session_dir)
+        else:
+            src = find_stem(str(session_dir), "vocals" if track == "vocals" else "no_vocals")
+        if src is None:
+            raise HTTPException(status_code=404, detail="Session not found.")
+        try:
+            await _backfill(path, _build_missing_peaks, src, path)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Waveform failed: {e}")
+        await asyncio.to_thread(stem_cache.refresh_size, session_dir.name)
+    peaks = await asyncio.to_thread(peak_files.get, path)
+    return {"track": track, "duration": peaks.duration, **peaks.viewport(start, end, width)}
+
+@app.post("/api/mixdown")
+async def mixdown(session: str, file: UploadFile = File(...), start: Optional[float] = None,
+                  vocal_db: float = 0.0, inst_db: float = 0.0):
+    """
+    上傳自己的清唱錄音，與該 session 的伴奏混成一首。
+
+    以 FFT 互相關將錄音對齊原唱（start 為錄音開始時的播放秒數，可縮小搜尋範圍），
+    錄音音量先對齊原唱，再套用 vocal_db / inst_db。
+    """
+    if not SESSION_RE.match(session):
+        raise HTTPException(status_code=400, detail="Invalid session id.")
+    if abs(vocal_db) > 24 or abs(inst_db) > 24:
+        raise HTTPException(status_code=400, detail="Gain must be within ±24 dB.")
+    session_dir = STORAGE_DIR / f"session_{session}"
+    vocals_src = find_stem(str(session_dir), "vocals")
+    inst_src = find_stem(str(session_dir), "no_vocals")
+    if vocals_src is None or inst_src is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+
+    mix_dir = session_dir / "mix"
+    mix_dir.mkdir(exist_ok=True)
+    mix_id = uuid.uuid4().hex[:8]
+    take_path = mix_dir / f"take_{mix_id}{Path(file.filename or 'take.webm').suffix or '.webm'}"
+    size = 0
+    with open(take_path, "wb") as f:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MIXDOWN_MAX_MB * 1024 * 1024:
+                f.close()
+                take_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=413, detail="Recording is too large.")
+            f.write(chunk)
+
+    try:
+        result = await mixer.render(str(take_path), vocals_src, inst_src, str(mix_dir / f"mix_{mix_id}"),
+                                    hint=start, vocal_db=vocal_db, inst_db=inst_db)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Mixdown failed: {e}")
+    finally:
+        take_path.unlink(missing_ok=True)
+    await asyncio.to_thread(stem_cache.refresh_size, session_dir.name)
+    files = {fmt: _storage_url(p) for fmt, p in result["files"].items()}
+    return {
+        "url": files[MIXDOWN_FORMATS[0]],
+        "downloads": files,
+        "offset": result["offset"],
+        "confidence": result["confidence"],
+        "vocal_gain": result["vocal_gain"],
+    }
+
+@app.get("/api/metrics")
+def metrics():
+    """工作數量、佇列深度、快取命中率與分離耗時直方圖（服務啟動以來累計）。"""
+    return {
+        "uptime": round(time.time() - STARTED_AT, 1),
+        "separation": job_manager.stats(),
+        "cache": stem_cache.stats(),
     }
-    return JSONResponse(payload)
 
 @app.get("/api/health")
 def health():
@@ -0,0 +1,67 @@
+import os
+import subprocess
+from typing import Dict, List, Sequence
+
+import soundfile as sf
+import torch
+from demucs.audio import save_audio
+
+# 格式名稱 -> (副檔名, ffmpeg 編碼參數)；wav / flac 不需 ffmpeg
+FORMATS = {
+    "wav": (".wav", None),
+    "flac": (".flac", None),
+    "opus": (".opus", ["-c:a", "libopus", "-b:a", "128k"]),
+    "aac": (".m4a", ["-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart"]),
+}
+ARCHIVE_FORMATS = {"flac"}
+
+def parse_formats(spec: str) -> List[str]:
+    """解析逗號分隔的格式清單，例如 "aac,flac"。"""
+    formats = []
+    for name in (part.strip().lower() for part in spec.split(",")):
+        if not name:
+            continue
+        if name not in FORMATS:
+            raise ValueError(f"不支援的輸出格式：{name}（可用：{', '.join(FORMATS)}）")
+        if name not in formats:
+            formats.append(name)
+    return formats or ["wav"]
+
+def playback_format(formats: Sequence[str]) -> str:
+    """播放用格式：清單中第一個非封存格式（都沒有時用第一個）。"""
+    return next((f for f in formats if f not in ARCHIVE_FORMATS), formats[0])
+
+def _encode_ffmpeg(wav: torch.Tensor, path: str, samplerate: int, codec_args: List[str]):
+    # 以 float32 PCM 從 stdin 餵給 ffmpeg，不落地中間 WAV
+    pcm = wav.clamp(-1, 1).t().contiguous().numpy().astype("<f4").tobytes()
+    cmd = [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        "-f", "f32le", "-ar", str(samplerate), "-ac", str(wav.shape[0]), "-i", "-",
+        *codec_args, path,
+    ]
+    proc = subprocess.run(cmd, input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg 編碼失敗（{os.path.basename(path)}）：{proc.stderr.decode(errors='ignore').strip()}")
+
+def write_stem(wav: torch.Tensor, dst_base: str, samplerate: int, formats: Sequence[str]) -> Dict[str, str]:
+    """
+    將一軌 (channels, time) 的音訊依序輸出為各種格式。
+
+    dst_base 不含副檔名；回傳 {格式: 檔案路徑}。
+    """
+    wav = wav.detach().cpu().float()
+    peak = wav.abs().max()
+    if peak > 1:
+        wav = wav / (1.01 * peak)  # 與 demucs 的 clip="rescale" 相同
+    out = {}
+    for fmt in formats:
+        ext, codec_args = FORMATS[fmt]
+        path = dst_base + ext
+        if fmt == "wav":
+            save_audio(wav, path, samplerate=samplerate)
+        elif fmt == "flac":
+            sf.write(path, wav.t().numpy(), samplerate, format="FLAC", subtype="PCM_16")
+        else:
+            _encode_ffmpeg(wav, path, samplerate, codec_args)
+        out[fmt] = path
+    return out
@@ -0,0 +1,177 @@
+"""
+分離效能基準測試。
+
+    python -m backend.benchmark --lengths 30,120,240 --models htdemucs --modes full,stream,parallel
+    python -m backend.benchmark --models htdemucs,htdemucs:onnx,htdemucs:onnx-int8 --modes full
+
+每個（音檔, 模型, 模式）組合在獨立行程中執行，回報：
+
+- load:   模型載入秒數（不計入其餘指標）
+- total:  分離加寫檔的總秒數
+- rtf:    real-time factor = total / 音檔長度（越小越快，< 1 代表比即時快）
+- first:  第一個可播放輸出出現的秒數（stream 模式為第一段，其他模式等於 total）
+- rss:    行程的峰值 RSS（MB；子行程只計入已結束者）
+- sdr:    非 PyTorch 引擎（htdemucs:onnx 等）的清唱輸出相對於同模型 PyTorch 輸出的 SDR（dB），
+          衡量量化/轉換造成的品質差異；需同時測試原模型且輸出格式含 wav 或 flac
+
+未指定 --inputs 時，以合成音訊（帶顫音的諧波「人聲」+ 低音 + 鼓點雜訊）產生測試檔。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import soundfile as sf
+
+SAMPLE_RATE = 44100
+MODES = ("full", "stream", "parallel")
+
+def synth_song(path: str, seconds: float, seed: int = 0) -> str:
+    """產生一段可重現的合成歌曲（立體聲 WAV）。"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    # 人聲：每 0.5 秒換一個音，5 Hz 顫音，前 6 個諧波
+    notes = 220.0 * 2 ** (rng.integers(0, 12, size=int(seconds * 2) + 1) / 12)
+    f0 = notes[(t * 2).astype(int)] * (1 + 0.01 * np.sin(2 * np.pi * 5 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 7)) * 0.2
+    bass = 0.25 * np.sin(2 * np.pi * 55 * t)
+    # 鼓點：每拍一次衰減雜訊
+    beat = np.exp(-((t % 0.5) * 30)) * rng.standard_normal(len(t)) * 0.3
+    mix = np.stack([voice + bass + beat, voice + bass * 0.9 + beat * 1.1], axis=1)
+    sf.write(path, (mix / np.abs(mix).max() * 0.9).astype(np.float32), SAMPLE_RATE)
+    return path
+
+def _peak_rss_mb() -> float:
+    # Linux 的 ru_maxrss 單位為 KB（macOS 為 bytes）
+    unit = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * unit / (1024 * 1024)
+
+def _run_case(audio_path: str, model: str, mode: str, processes: int, formats: List[str], output_dir: str, out):
+    """子行程：載入模型後執行一次分離，結果放進 out queue（輸出檔留在 output_dir 供比較品質）。"""
+    try:
+        from .demucs_service import load_model, separate_progressive, separate_vocals_and_instrumental
+
+        t0 = time.perf_counter()
+        load_model(model)
+        load = time.perf_counter() - t0
+        first = [None]
+        t0 = time.perf_counter()
+        if mode == "stream":
+            def on_segment(_seg):
+                if first[0] is None:
+                    first[0] = time.perf_counter() - t0
+            result = separate_progressive(audio_path, output_dir, model_name=model, on_segment=on_segment, formats=formats)
+        else:
+            result = separate_vocals_and_instrumental(
+                audio_path, output_dir, model_name=model, formats=formats,
+                processes=processes if mode == "parallel" else 0,
+            )
+        total = time.perf_counter() - t0
+        out.put({"load": load, "total": total, "first": first[0] or total, "rss": _peak_rss_mb(),
+                 "vocals": result["files"]["vocals"]})
+    except Exception as e:
+        out.put({"error": str(e)})
+
+def run_case(audio_path: str, model: str, mode: str, processes: int, formats: List[str], output_dir: str) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    out = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(audio_path, model, mode, processes, formats, output_dir, out))
+    proc.start()
+    while True:
+        try:
+            result = out.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not proc.is_alive():  # 例如記憶體不足被系統終止
+                result = {"error": f"worker exited with code {proc.exitcode}"}
+                break
+    proc.join()
+    duration = sf.info(audio_path).duration
+    result.update(input=os.path.basename(audio_path), seconds=round(duration, 1), model=model, mode=mode)
+    if "total" in result:
+        result["rtf"] = result["total"] / duration
+    return result
+
+def sdr(reference: str, estimate: str) -> float:
+    ref, _ = sf.read(reference, dtype="float32", always_2d=True)
+    est, _ = sf.read(estimate, dtype="float32", always_2d=True)
+    n = min(len(ref), len(est))
+    ref, est = ref[:n], est[:n]
+    noise = np.sum((ref - est) ** 2)
+    return float(10 * np.log10(np.sum(ref ** 2) / noise)) if noise > 0 else float("inf")
+
+def add_quality(results: List[dict]):
+    """替非 PyTorch 引擎的結果加上相對於原模型輸出的 SDR。"""
+    for r in results:
+        base = r["model"].partition(":")[0]
+        if base == r["model"] or "vocals" not in r:
+            continue
+        ref = next((x for x in results if x["model"] == base and x["input"] == r["input"]
+                    and x["mode"] == r["mode"] and "vocals" in x), None)
+        fmt = next((f for f in ("wav", "flac") if ref and f in ref["vocals"] and f in r["vocals"]), None)
+        if fmt is not None:
+            r["sdr"] = sdr(ref["vocals"][fmt], r["vocals"][fmt])
+
+def _print_row(r: dict):
+    if "error" in r:
+        print(f"{r['input']:<24} {r['model']:<20} {r['mode']:<9} error: {r['error']}")
+        return
+    print(f"{r['input']:<24} {r['model']:<20} {r['mode']:<9} {r['seconds']:>7.1f} {r['load']:>7.2f} "
+          f"{r['total']:>8.2f} {r['rtf']:>6.3f} {r['first']:>8.2f} {r['rss']:>8.0f} "
+          + (f"{r['sdr']:>7.1f}" if "sdr" in r else f"{'-':>7}"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Demucs 分離效能基準測試")
+    parser.add_argument("--inputs", nargs="*", default=[], help="要測試的音檔（預設使用合成音訊）")
+    parser.add_argument("--lengths", default="30,120", help="合成音訊長度（秒），逗號分隔")
+    parser.add_argument("--models", default="htdemucs", help="模型名稱，逗號分隔")
+    parser.add_argument("--modes", default="full,stream", help=f"模式，逗號分隔（{', '.join(MODES)}）")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 2, help="parallel 模式的分段行程數")
+    parser.add_argument("--formats", default="wav", help="輸出格式（同 STEM_FORMATS）")
+    parser.add_argument("--json", dest="json_path", help="另存完整結果為 JSON")
+    args = parser.parse_args(argv)
+
+    modes = [m for m in args.modes.split(",") if m]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"未知模式：{mode}")
+    models = [m for m in args.models.split(",") if m]
+    formats = [f for f in args.formats.split(",") if f]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = list(args.inputs) or [
+            synth_song(os.path.join(tmp, f"synth_{int(float(sec))}s.wav"), float(sec))
+            for sec in args.lengths.split(",") if sec
+        ]
+        for audio_path in inputs:
+            for model in models:
+                for mode in modes:
+                    output_dir = os.path.join(tmp, f"out_{len(results)}")
+                    r = run_case(audio_path, model, mode, args.processes, formats, output_dir)
+                    status = r["error"] if "error" in r else f"{r['total']:.1f}s"
+                    print(f"  {r['input']} / {model} / {mode}: {status}", file=sys.stderr)
+                    results.append(r)
+        add_quality(results)
+
+    print(f"{'input':<24} {'model':<20} {'mode':<9} {'seconds':>7} {'load':>7} {'total':>8} {'rtf':>6} {'first':>8} {'rss(MB)':>8} {'sdr(dB)':>7}")
+    for r in results:
+        _print_row(r)
+        r.pop("vocals", None)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
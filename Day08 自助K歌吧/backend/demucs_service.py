@@ -1,26 +1,261 @@
 import os
-import sys
-import shutil
-import tempfile
-from pathlib import Path
+import gc
+import math
+import threading
+import subprocess
+import contextlib
+from typing import Callable, List, Optional, Sequence, Tuple
 
 import torch
-import gc
-import demucs.separate
+import torch.multiprocessing as torch_mp
+import torchaudio
+import demucs.apply
+from demucs.apply import apply_model
+from demucs.audio import AudioFile, convert_audio, save_audio
+from demucs.pretrained import get_model
+
+from .audio_codecs import playback_format, write_stem
+from .onnx_engine import split_model_name
+from .pitch_track import PITCH_SUFFIX, build_pitch_track
+from .waveform import peaks_path, write_peaks
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# 常駐模型池：每個 model_name 只載入一次（htdemucs / htdemucs_ft / mdx ...）
+# 名稱可加上引擎後綴改用 onnxruntime 執行，例如 htdemucs:onnx、htdemucs:onnx-int8（見 onnx_engine）
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+# 平行分段模式：模型存成檔案後由各子行程以 mmap 載入，權重共用同一份 page cache
+MMAP_DIR = os.environ.get("DEMUCS_MMAP_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ktv_demucs"))
+PARALLEL_OVERLAP_SEC = 2.0
+PARALLEL_MIN_SEGMENT_SEC = 10.0
+_SEGMENT_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_WORKER_MODEL = None
+
+class SeparationCancelled(Exception):
+    """進度回呼要求中止分離時拋出。"""
+
+class _SegmentProgress:
+    """
+    取代 demucs.apply 內的 tqdm 模組：apply_model(progress=True) 會以 tqdm.tqdm
+    包住分段迴圈，藉此在每個 segment 完成時回報 0~1 的整體進度。
+    """
+
+    def __init__(self, callback: Callable[[float], None], passes: int):
+        self.callback = callback
+        self.passes = max(1, passes)
+        self.done_passes = 0
+
+    def tqdm(self, iterable, **kwargs):
+        items = list(iterable)
+        total = max(1, len(items))
+        self.callback(self.done_passes / self.passes)
+        for i, item in enumerate(items):
+            yield item
+            self.callback((self.done_passes + (i + 1) / total) / self.passes)
+        self.done_passes += 1
+
+_PROGRESS_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def _segment_progress(callback: Optional[Callable[[float], None]], passes: int):
+    if callback is None:
+        yield False
+        return
+    with _PROGRESS_LOCK:
+        original = demucs.apply.tqdm
+        demucs.apply.tqdm = _SegmentProgress(callback, passes)
+        try:
+            yield True
+        finally:
+            demucs.apply.tqdm = original
 
 def clear_memory():
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     gc.collect()
 
-def separate_vocals_and_instrumental(audio_path: str, output_dir: str, model_name: str = "htdemucs") -> dict:
+def load_model(model_name: str = "htdemucs"):
+    """取得常駐模型；第一次呼叫時載入權重，之後直接重用。"""
+    with _MODELS_LOCK:
+        model = _MODELS.get(model_name)
+        if model is None:
+            base, engine = split_model_name(model_name)
+            model = get_model(base)
+            model.eval()
+            if engine is None:
+                model.to(DEVICE)
+            else:
+                from .onnx_engine import build_onnx_model
+                model = build_onnx_model(model, base, engine)
+            _MODELS[model_name] = model
+        return model
+
+def _load_track(audio_path: str, audio_channels: int, samplerate: int) -> torch.Tensor:
+    # 與 demucs.separate 相同：優先以 ffmpeg 解碼，失敗再退回 torchaudio
+    try:
+        return AudioFile(audio_path).read(streams=0, samplerate=samplerate, channels=audio_channels)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        wav, sr = torchaudio.load(audio_path)
+        return convert_audio(wav, sr, samplerate, audio_channels)
+
+def _load_normalized(audio_path: str, model):
+    wav = _load_track(audio_path, model.audio_channels, model.samplerate)
+    ref = wav.mean(0)
+    mean, std = ref.mean(), ref.std() + 1e-8
+    return (wav - mean) / std, mean, std
+
+def _two_stems(model, sources: torch.Tensor):
+    # 只產生兩軌：vocals / no_vocals（其餘音軌加總）
+    vocals = sources[model.sources.index("vocals")]
+    return vocals, sources.sum(0) - vocals
+
+def _check_model(model_name: str):
+    model = load_model(model_name)
+    if "vocals" not in model.sources:
+        raise ValueError(f"模型 {model_name} 沒有 vocals 音軌")
+    return model
+
+def _model_passes(model, shifts: int = 1) -> int:
+    return len(getattr(model, "models", [model])) * shifts
+
+def _write_two_stems(vocals, no_vocals, output_dir: str, base: str, samplerate: int, formats: Sequence[str],
+                     mix: Optional[torch.Tensor] = None) -> dict:
+    files = {
+        "vocals": write_stem(vocals, os.path.join(output_dir, f"{base}_vocals"), samplerate, formats),
+        "no_vocals": write_stem(no_vocals, os.path.join(output_dir, f"{base}_no_vocals"), samplerate, formats),
+    }
+    play = playback_format(formats)
+    result = {"vocals": files["vocals"][play], "no_vocals": files["no_vocals"][play], "files": files}
+    # 順便算好清唱的參考音高軌（即時評分只需查表）；失敗不影響分離結果
+    try:
+        mono = vocals.detach().cpu().float().mean(0).numpy()
+        result["pitch"] = build_pitch_track(mono, samplerate, os.path.join(output_dir, base + PITCH_SUFFIX))
+    except Exception:
+        result["pitch"] = None
+    # 波形峰值金字塔（原曲 / 清唱 / 伴奏），前端畫波形不必下載整個音檔
+    tracks = {"vocals": vocals, "instrumental": no_vocals}
+    if mix is not None:
+        tracks["original"] = mix
+    result["peaks"] = {
+        name: write_peaks(peaks_path(output_dir, name), wav.detach().cpu().float().numpy(), samplerate)
+        for name, wav in tracks.items()
+    }
+    return result
+
+def _mmap_model_path(model_name: str, model) -> str:
+    os.makedirs(MMAP_DIR, exist_ok=True)
+    path = os.path.join(MMAP_DIR, f"{model_name}.pt")
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        torch.save(model, tmp)
+        os.replace(tmp, path)
+    return path
+
+def _segment_worker_init(model_path: str, torch_threads: int):
+    global _WORKER_MODEL
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    _WORKER_MODEL = torch.load(model_path, map_location="cpu", mmap=True, weights_only=False)
+    _WORKER_MODEL.eval()
+
+def _separate_segment(task: Tuple[int, torch.Tensor]) -> Tuple[int, torch.Tensor]:
+    index, chunk = task
+    with torch.no_grad():
+        sources = apply_model(_WORKER_MODEL, chunk[None], device="cpu", shifts=1, split=True, overlap=0.25, progress=False)[0]
+    return index, sources
+
+def _segment_pool(model_name: str, processes: int, torch_threads: int):
+    """取得（或建立）常駐的分段行程池；每組 (model_name, processes, torch_threads) 一個。"""
+    key = (model_name, processes, torch_threads)
+    with _POOLS_LOCK:
+        pool = _SEGMENT_POOLS.get(key)
+        if pool is None:
+            path = _mmap_model_path(model_name, load_model(model_name))
+            ctx = torch_mp.get_context("spawn")
+            pool = ctx.Pool(processes, initializer=_segment_worker_init, initargs=(path, torch_threads))
+            _SEGMENT_POOLS[key] = pool
+        return key, pool
+
+def _drop_segment_pool(key):
+    with _POOLS_LOCK:
+        pool = _SEGMENT_POOLS.pop(key, None)
+    if pool is not None:
+        pool.terminate()
+
+def _split_windows(length: int, count: int, overlap: int) -> List[Tuple[int, int]]:
+    hop = math.ceil(length / count)
+    return [(max(0, i * hop - overlap), min(length, (i + 1) * hop + overlap)) for i in range(count) if i * hop < length]
+
+def _window_weights(start: int, end: int, length: int, ramp: int) -> torch.Tensor:
+    # 與相鄰窗重疊處做線性淡入/淡出，兩窗權重相加為 1（overlap-add）
+    w = torch.ones(end - start)
+    ramp = min(ramp, end - start)
+    if ramp and start > 0:
+        w[:ramp] = torch.linspace(0.0, 1.0, ramp)
+    if ramp and end < length:
+        w[-ramp:] = torch.minimum(w[-ramp:], torch.linspace(1.0, 0.0, ramp))
+    return w
+
+def _apply_parallel(model_name: str, model, wav: torch.Tensor, processes: int, torch_threads: int,
+                    progress: Optional[Callable[[float], None]]) -> torch.Tensor:
+    """把整首歌切成重疊的段落交給行程池分離，再以 overlap-add 接回。"""
+    sr = model.samplerate
+    length = wav.shape[-1]
+    overlap = int(PARALLEL_OVERLAP_SEC * sr)
+    count = max(1, min(processes * 2, length // int(PARALLEL_MIN_SEGMENT_SEC * sr)))
+    windows = _split_windows(length, count, overlap)
+
+    key, pool = _segment_pool(model_name, processes, torch_threads)
+    out = torch.zeros(len(model.sources), wav.shape[0], length)
+    weight = torch.zeros(length)
+    try:
+        if progress is not None:
+            progress(0.0)
+        tasks = [(i, wav[:, s:e].clone()) for i, (s, e) in enumerate(windows)]
+        for done, (i, sources) in enumerate(pool.imap_unordered(_separate_segment, tasks), start=1):
+            s, e = windows[i]
+            w = _window_weights(s, e, length, 2 * overlap)
+            out[..., s:e] += sources * w
+            weight[s:e] += w
+            if progress is not None:
+                progress(done / len(windows))
+    except BaseException:
+        # 取消或失敗：終止行程池，避免剩餘段落繼續佔用 CPU
+        _drop_segment_pool(key)
+        raise
+    return out / weight.clamp_min(1e-8)
+
+def separate_vocals_and_instrumental(
+    audio_path: str,
+    output_dir: str,
+    model_name: str = "htdemucs",
+    progress: Optional[Callable[[float], None]] = None,
+    formats: Sequence[str] = ("wav",),
+    processes: int = 0,
+    torch_threads: int = 0,
+) -> dict:
     """
     使用 Demucs 將輸入音檔分離為 vocals / no_vocals 兩軌，並輸出到 output_dir。
 
+    模型常駐於行程內，直接對解碼後的張量執行 apply_model，
+    兩軌各寫檔一次，不再經過暫存目錄。
+
+    progress:      可選的回呼，每完成一個 segment 以 0~1 的進度呼叫一次；
+                   回呼可拋出 SeparationCancelled 以中止分離。
+    formats:       輸出格式（見 audio_codecs.FORMATS），例如 ("aac", "flac")。
+    processes:     >1 時（僅 CPU）將歌曲切成重疊段落，由常駐行程池平行分離後 overlap-add 接回。
+    torch_threads: 每個行程的 torch intra-op 執行緒數（0 = torch 預設）。
+
     回傳:
         {
-            "vocals": "/abs/path/to/vocals.wav",
-            "no_vocals": "/abs/path/to/no_vocals.wav"
+            "vocals": "/abs/path/to/vocals.m4a",       # 播放用格式
+            "no_vocals": "/abs/path/to/no_vocals.m4a",
+            "files": {"vocals": {"aac": ..., "flac": ...}, "no_vocals": {...}},
+            "pitch": "/abs/path/to/song_pitch.bin",     # 參考音高軌（見 pitch_track）
+            "peaks": {"original": ..., "vocals": ..., "instrumental": ...}  # 波形峰值（見 waveform）
         }
     """
     audio_path = str(audio_path)
@@ -28,44 +263,93 @@ def separate_vocals_and_instrumental(audio_path: str, output_dir: str, model_nam
     os.makedirs(output_dir, exist_ok=True)
 
     base = os.path.splitext(os.path.basename(audio_path))[0]
-    temp_root = tempfile.mkdtemp(prefix="demucs_", dir=output_dir)
+    model = _check_model(model_name)
 
     try:
-        # 保存原始 argv
-        argv_bak = sys.argv[:]
-        # 只產生兩軌：vocals / no_vocals
-        sys.argv = [
-            "demucs.separate",
-            "-n", model_name,
-            "-o", temp_root,
-            "--two-stems", "vocals",
-            audio_path
-        ]
-        demucs.separate.main()
-        # 還原 argv
-        sys.argv = argv_bak
-
-        # 尋找輸出
-        pair_dir = os.path.join(temp_root, model_name, base)
-        vocals_src = os.path.join(pair_dir, "vocals.wav")
-        no_vocals_src = os.path.join(pair_dir, "no_vocals.wav")
-
-        if not os.path.exists(vocals_src):
-            raise FileNotFoundError(f"找不到輸出 {vocals_src}")
-        if not os.path.exists(no_vocals_src):
-            raise FileNotFoundError(f"找不到輸出 {no_vocals_src}")
-
-        vocals_dst = os.path.join(output_dir, f"{base}_vocals.wav")
-        no_vocals_dst = os.path.join(output_dir, f"{base}_no_vocals.wav")
-
-        shutil.copy2(vocals_src, vocals_dst)
-        shutil.copy2(no_vocals_src, no_vocals_dst)
-
-        return {"vocals": vocals_dst, "no_vocals": no_vocals_dst}
-    except Exception as e:
-        raise
+        wav, mean, std = _load_normalized(audio_path, model)
+        # ONNX 引擎由 onnxruntime 自行使用多核心，不走平行分段
+        if processes > 1 and DEVICE == "cpu" and split_model_name(model_name)[1] is None:
+            sources = _apply_parallel(model_name, model, wav, processes, torch_threads, progress)
+        else:
+            if torch_threads:
+                torch.set_num_threads(torch_threads)
+            with torch.no_grad(), _segment_progress(progress, _model_passes(model)) as report:
+                sources = apply_model(model, wav[None], device=DEVICE, shifts=1, split=True, overlap=0.25, progress=report)[0]
+        vocals, no_vocals = _two_stems(model, sources * std + mean)
+        return _write_two_stems(vocals, no_vocals, output_dir, base, model.samplerate, formats, mix=wav * std + mean)
     finally:
-        try:
-            shutil.rmtree(temp_root, ignore_errors=True)
-        finally:
-            clear_memory()
\ No newline at end of file
+        clear_memory()
+
+def separate_progressive(
+    audio_path: str,
+    output_dir: str,
+    model_name: str = "htdemucs",
+    window_sec: float = 30.0,
+    overlap_sec: float = 2.0,
+    on_segment: Optional[Callable[[dict], None]] = None,
+    progress: Optional[Callable[[float], None]] = None,
+    formats: Sequence[str] = ("wav",),
+) -> dict:
+    """
+    串流模式：以重疊的時間窗逐段分離，窗與窗之間做線性交叉淡化。
+
+    每完成一個時間窗，就把「已定案」的片段寫成 output_dir/stream/ 下的
+    vocals_NNN.wav / no_vocals_NNN.wav 並呼叫 on_segment，前端可先播放前段；
+    全部完成後仍輸出完整的 vocals / no_vocals，回傳格式同
+    separate_vocals_and_instrumental（另含 "segments" 清單）。
+    """
+    audio_path = str(audio_path)
+    output_dir = str(output_dir)
+    stream_dir = os.path.join(output_dir, "stream")
+    os.makedirs(stream_dir, exist_ok=True)
+
+    base = os.path.splitext(os.path.basename(audio_path))[0]
+    model = _check_model(model_name)
+    sr = model.samplerate
+
+    try:
+        wav, mean, std = _load_normalized(audio_path, model)
+        length = wav.shape[-1]
+        window = max(int(window_sec * sr), 1)
+        overlap = min(max(int(overlap_sec * sr), 0), window // 2)
+        hop = window - overlap
+        n_windows = max(1, math.ceil(max(length - overlap, 1) / hop))
+        fade_in = torch.linspace(0.0, 1.0, overlap) if overlap else torch.zeros(0)
+
+        pending = None  # 上一窗尾端、尚待與下一窗交叉淡化的區段
+        parts, segments = [], []
+        with torch.no_grad(), _segment_progress(progress, _model_passes(model) * n_windows) as report:
+            for i in range(n_windows):
+                start = i * hop
+                chunk = wav[:, start:start + window]
+                sources = apply_model(model, chunk[None], device=DEVICE, shifts=1, split=True, overlap=0.25, progress=report)[0]
+                stems = torch.stack(_two_stems(model, sources.cpu() * std + mean))
+
+                if pending is not None:
+                    n = min(pending.shape[-1], stems.shape[-1])
+                    stems[..., :n] = pending[..., :n] * (1 - fade_in[:n]) + stems[..., :n] * fade_in[:n]
+                if i < n_windows - 1 and overlap:
+                    final, pending = stems[..., :-overlap], stems[..., -overlap:]
+                else:
+                    final, pending = stems, None
+
+                seg = {
+                    "index": i,
+                    "start": start / sr,
+                    "duration": final.shape[-1] / sr,
+                    "vocals": os.path.join(stream_dir, f"vocals_{i:03d}.wav"),
+                    "no_vocals": os.path.join(stream_dir, f"no_vocals_{i:03d}.wav"),
+                }
+                # 片段之間音量需一致，不做逐檔 rescale
+                save_audio(final[0], seg["vocals"], samplerate=sr, clip="clamp")
+                save_audio(final[1], seg["no_vocals"], samplerate=sr, clip="clamp")
+                parts.append(final)
+                segments.append(seg)
+                if on_segment is not None:
+                    on_segment(seg)
+
+        stems = torch.cat(parts, dim=-1)
+        result = _write_two_stems(stems[0], stems[1], output_dir, base, sr, formats, mix=wav * std + mean)
+        return {**result, "segments": segments}
+    finally:
+        clear_memory()
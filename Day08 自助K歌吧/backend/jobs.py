@@ -0,0 +1,383 @@
+import queue
+import threading
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .demucs_service import SeparationCancelled, separate_progressive, separate_vocals_and_instrumental
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = {DONE, FAILED, CANCELLED}
+
+# 分離耗時直方圖的上界（秒），最後一格為 +Inf
+DURATION_BUCKETS = (5, 15, 30, 60, 120, 300, 600)
+
+class QueueFull(Exception):
+    """等待中的工作已達上限。"""
+
+class DurationHistogram:
+    """累積式直方圖（與 Prometheus histogram 相同：每格計入 <= 上界的次數）。"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict:
+        cumulative, total = {}, 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += n
+            cumulative[str(bound)] = total
+        return {"buckets": cumulative, "count": self.count, "sum": round(self.sum, 3)}
+
+@dataclass
+class Job:
+    id: str
+    key: str
+    audio_path: str
+    output_dir: str
+    model: str
+    priority: int = 0
+    status: str = QUEUED
+    progress: float = 0.0
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    stream: Optional[dict] = None
+    segments: List[dict] = field(default_factory=list)
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    future: object = None
+    preempted: bool = False
+    cancel_requested: bool = False
+
+def _run_separation(job_id: str, audio_path: str, output_dir: str, model_name: str, events, cancel_flags,
+                    stream: Optional[dict] = None, options: Optional[dict] = None) -> dict:
+    """在 worker 行程內執行；進度與開始事件經由 Manager queue 回傳給主行程。"""
+    events.put((job_id, "start", time.time()))
+    options = options or {}
+    last = [0.0]
+
+    def report(frac: float):
+        if cancel_flags.get(job_id):
+            raise SeparationCancelled(job_id)
+        # 節流：進度每增加 1% 才送一次
+        if frac - last[0] >= 0.01 or frac >= 1.0:
+            last[0] = frac
+            events.put((job_id, "progress", frac))
+
+    if stream is not None:
+        # 串流模式：每完成一個時間窗就通知主行程
+        return separate_progressive(
+            audio_path, output_dir, model_name=model_name, progress=report, formats=options.get("formats", ("wav",)),
+            on_segment=lambda seg: events.put((job_id, "segment", seg)), **stream,
+        )
+    return separate_vocals_and_instrumental(audio_path, output_dir, model_name=model_name, progress=report, **options)
+
+class JobManager:
+    """
+    分離工作佇列：固定大小的行程池執行 Demucs，主行程只負責排程與狀態。
+
+    - 每個 worker 行程各自常駐模型（見 demucs_service.load_model）
+    - 依 priority（數字越小越優先，其次先到先做）派工；有空的 worker 才送進行程池
+    - 更優先的工作在排隊、而 worker 都在做較不優先的工作時，搶占其中最不優先的一個：
+      該工作在下一個 segment 邊界中止並重新排隊
+    - 進度由 worker 的 segment 迴圈回報，經 Manager queue 彙整到 Job
+    - 排隊中的工作直接取消；執行中的工作在下一個 segment 邊界中止
+    """
+
+    def __init__(self, workers: int = 1, max_queue: int = 16, job_ttl: float = 3600.0,
+                 on_finish: Optional[Callable[[Job, str, Optional[dict]], Optional[dict]]] = None,
+                 url_for: Callable[[str], str] = str, options: Optional[dict] = None):
+        self.workers = max(1, workers)
+        # 傳給 separate_vocals_and_instrumental 的參數（formats / processes / torch_threads）
+        self.options = dict(options or {})
+        self.url_for = url_for
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+        self.on_finish = on_finish
+        self._jobs: Dict[str, Job] = {}
+        self._pending: List[Job] = []
+        self._lock = threading.RLock()
+        self._durations: List[float] = []
+        # 服務啟動以來的累計數字（_jobs 會過期清除，不能拿來算）
+        self._submitted = 0
+        self._totals = {s: 0 for s in FINISHED}
+        self._preemptions = 0
+        self._histograms = {"separation": DurationHistogram(), "first_segment": DurationHistogram()}
+        self._executor = None
+        self._manager = None
+        self._events = None
+        self._cancel_flags = None
+        self._pump = None
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._manager = ctx.Manager()
+        self._events = self._manager.Queue()
+        self._cancel_flags = self._manager.dict()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        self._pump = threading.Thread(target=self._pump_events, name="job-events", daemon=True)
+        self._pump.start()
+
+    def shutdown(self):
+        with self._lock:
+            self._pending.clear()
+            for job in self._jobs.values():
+                if job.status == RUNNING:
+                    job.cancel_requested = True
+                    self._cancel_flags[job.id] = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+        self._executor = self._manager = None
+
+    def _pump_events(self):
+        while self._manager is not None:
+            try:
+                job_id, kind, value = self._events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status != RUNNING:
+                    continue
+                if kind == "start":
+                    job.started = value
+                elif kind == "progress":
+                    job.progress = max(job.progress, min(1.0, value))
+                elif kind == "segment":
+                    if not job.segments and job.started:
+                        self._histograms["first_segment"].observe(time.time() - job.started)
+                    job.segments.append(value)
+
+    def submit(self, key: str, audio_path: str, output_dir: str, model: str,
+               stream: Optional[dict] = None, priority: int = 0) -> Job:
+        """
+        送出分離工作。stream 為 None 時一次輸出完整兩軌；否則以
+        separate_progressive 的參數（window_sec / overlap_sec）逐段輸出。
+
+        priority 0 為有人正在等待的上傳；max_queue 只限制這類工作，
+        背景預先分離（priority > 0）由呼叫端自行控制數量。
+        """
+        with self._lock:
+            self._prune()
+            # 同一首歌（同模型）已在處理中：共用同一個工作，必要時提高優先序。
+            # 串流請求只共用串流工作；尚在排隊的一般工作直接改為串流，已在執行的則另開一個
+            for job in self._jobs.values():
+                if job.key == key and job.status in (QUEUED, RUNNING):
+                    if stream is not None and job.stream is None:
+                        if job.status != QUEUED:
+                            continue
+                        job.stream = stream
+                    if priority < job.priority:
+                        job.priority = priority
+                        dispatched = self._schedule()
+                        break
+                    return job
+            else:
+                waiting = sum(1 for j in self._pending if j.priority <= 0)
+                if priority <= 0 and waiting >= self.max_queue:
+                    raise QueueFull()
+                job = Job(id=uuid.uuid4().hex[:12], key=key, audio_path=audio_path, output_dir=output_dir,
+                          model=model, priority=priority, stream=stream)
+                self._jobs[job.id] = job
+                self._pending.append(job)
+                self._submitted += 1
+                dispatched = self._schedule()
+        self._watch(dispatched)
+        return job
+
+    def reprioritize(self, job_id: str, priority: int) -> Optional[Job]:
+        """調整排隊或執行中工作的優先序（例如有人插隊），並視需要搶占。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED or job.priority == priority:
+                return job
+            job.priority = priority
+            dispatched = self._schedule()
+        self._watch(dispatched)
+        return job
+
+    def _schedule(self) -> List[Job]:
+        """（需持有 lock）派出可執行的工作，必要時標記一個待搶占的工作；回傳新派出的工作。"""
+        dispatched = []
+        self._pending.sort(key=lambda j: (j.priority, j.created))
+        running = [j for j in self._jobs.values() if j.status == RUNNING]
+        while self._pending and len(running) < self.workers:
+            job = self._pending.pop(0)
+            job.status, job.started = RUNNING, time.time()
+            job.future = self._executor.submit(
+                _run_separation, job.id, job.audio_path, job.output_dir, job.model,
+                self._events, self._cancel_flags, job.stream, self.options,
+            )
+            running.append(job)
+            dispatched.append(job)
+
+        if self._pending and not any(j.preempted for j in running):
+            best = self._pending[0]
+            victim = max(running, key=lambda j: (j.priority, j.created), default=None)
+            if victim is not None and victim.priority > best.priority:
+                victim.preempted = True
+                self._cancel_flags[victim.id] = True
+                self._preemptions += 1
+        return dispatched
+
+    def _watch(self, jobs: List[Job]):
+        for job in jobs:
+            job.future.add_done_callback(lambda fut, job_id=job.id: self._finish(job_id, fut))
+
+    def _finish(self, job_id: str, fut):
+        result, error = None, None
+        try:
+            result = fut.result()
+            status = DONE
+        except (CancelledError, SeparationCancelled):
+            status = CANCELLED
+        except Exception as e:
+            status, error = FAILED, str(e)
+        job = self.get(job_id)
+        try:
+            self._cancel_flags.pop(job_id, None)
+        except (EOFError, OSError, AttributeError):
+            pass  # Manager 已關閉（服務結束中）
+
+        if status == CANCELLED and job.preempted and not job.cancel_requested:
+            # 被搶占：重新排隊，之後從頭分離
+            with self._lock:
+                job.status, job.preempted = QUEUED, False
+                job.progress, job.segments, job.started, job.future = 0.0, [], None, None
+                self._pending.append(job)
+                dispatched = self._schedule()
+            self._watch(dispatched)
+            return
+
+        # on_finish 可將 worker 回傳的路徑轉為對外的結果（或在失敗時清理檔案）
+        if self.on_finish is not None:
+            try:
+                result = self.on_finish(job, status, result)
+            except Exception as e:
+                status, error, result = FAILED, str(e), None
+        with self._lock:
+            job.status, job.result, job.error = status, result, error
+            job.finished = time.time()
+            self._totals[status] += 1
+            if status == DONE:
+                job.progress = 1.0
+                if job.started:
+                    self._durations = (self._durations + [job.finished - job.started])[-20:]
+                    self._histograms["separation"].observe(job.finished - job.started)
+            dispatched = self._schedule() if self._executor is not None else []
+        self._watch(dispatched)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return job
+            job.cancel_requested = True
+            if job.status == RUNNING:
+                self._cancel_flags[job_id] = True
+                return job
+            # 尚未派出的工作直接結束
+            self._pending.remove(job)
+        if self.on_finish is not None:
+            self.on_finish(job, CANCELLED, None)
+        with self._lock:
+            job.status, job.finished = CANCELLED, time.time()
+            self._totals[CANCELLED] += 1
+        return job
+
+    def active_dirs(self) -> set:
+        """排隊或執行中工作的輸出目錄名稱（清理程式不可刪除）。"""
+        with self._lock:
+            return {Path(j.output_dir).name for j in self._jobs.values() if j.status not in FINISHED}
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and now - j.finished > self.job_ttl]:
+            del self._jobs[job_id]
+
+    def _avg_duration(self) -> float:
+        return sum(self._durations) / len(self._durations) if self._durations else 60.0
+
+    def snapshot(self, job_id: str) -> Optional[dict]:
+        """回傳可直接序列化的工作狀態（含排隊位置與預估剩餘秒數）。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            data = {
+                "job": job.id,
+                "status": job.status,
+                "model": job.model,
+                "priority": job.priority,
+                "progress": round(job.progress, 4),
+                "position": None,
+                "eta": None,
+            }
+            if job.stream is not None:
+                data["segments"] = [
+                    {
+                        "index": seg["index"],
+                        "start": seg["start"],
+                        "duration": seg["duration"],
+                        "vocals": self.url_for(seg["vocals"]),
+                        "instrumental": self.url_for(seg["no_vocals"]),
+                    }
+                    for seg in job.segments
+                ]
+            avg = self._avg_duration()
+            if job.status == QUEUED:
+                position = self._pending.index(job)
+                data["position"] = position + 1
+                data["eta"] = round(avg * (position // self.workers + 1), 1)
+            elif job.status == RUNNING:
+                elapsed = time.time() - (job.started or time.time())
+                if job.progress > 0.02:
+                    data["eta"] = round(elapsed / job.progress * (1 - job.progress), 1)
+                else:
+                    data["eta"] = round(max(avg - elapsed, 0.0), 1)
+            elif job.status == DONE:
+                data["result"] = job.result
+            elif job.status == FAILED:
+                data["error"] = job.error
+            return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {s: 0 for s in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "jobs": counts,
+                "queue_depth": len(self._pending),
+                "submitted": self._submitted,
+                "finished": dict(self._totals),
+                "preemptions": self._preemptions,
+                "durations": {name: h.to_dict() for name, h in self._histograms.items()},
+            }
@@ -0,0 +1,191 @@
+import asyncio
+import glob
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from fractions import Fraction
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+import scipy.fft
+import soundfile as sf
+from scipy.signal import resample_poly
+
+from .audio_codecs import FORMATS, playback_format
+
+N_FFT = 2048
+HOP = 512
+SEMITONE_RANGE = 6
+TEMPO_RANGE = (0.5, 2.0)
+_WINDOW = np.hanning(N_FFT + 1)[:-1].astype(np.float32)
+
+# ---- DSP（全部以 numpy 向量化，逐聲道處理）----
+
+def _stft(x: np.ndarray) -> np.ndarray:
+    x = np.pad(x, N_FFT // 2)
+    n_frames = 1 + (len(x) - N_FFT) // HOP
+    frames = np.lib.stride_tricks.as_strided(x, shape=(n_frames, N_FFT), strides=(x.strides[0] * HOP, x.strides[0]))
+    return scipy.fft.rfft(frames * _WINDOW, axis=1).T  # (freq, time)
+
+def _istft(spec: np.ndarray, length: int) -> np.ndarray:
+    frames = scipy.fft.irfft(spec.T, n=N_FFT, axis=1).astype(np.float32) * _WINDOW
+    n_frames = frames.shape[0]
+    y = np.zeros(N_FFT * (n_frames // (N_FFT // HOP) + 2), np.float32)
+    wsum = np.zeros_like(y)
+    # 第 r, r+k, r+2k... 個 frame 彼此剛好相距 N_FFT，可直接攤平後一次疊加
+    k = N_FFT // HOP
+    for r in range(k):
+        part = frames[r::k]
+        start = r * HOP
+        y[start:start + part.size] += part.reshape(-1)
+        wsum[start:start + part.size] += np.tile(_WINDOW ** 2, part.shape[0])
+    y = np.where(wsum > 1e-3, y / np.maximum(wsum, 1e-3), 0.0)
+    out = y[N_FFT // 2:N_FFT // 2 + length]
+    return np.pad(out, (0, length - len(out)))
+
+def time_stretch(x: np.ndarray, stretch: float) -> np.ndarray:
+    """相位聲碼器（phase vocoder）時間伸縮：長度變為 stretch 倍、音高不變。"""
+    spec = _stft(x)
+    n_bins, n_frames = spec.shape
+    steps = np.arange(0, max(n_frames - 1, 1), 1.0 / stretch)
+    idx = np.minimum(steps.astype(np.int64), n_frames - 2) if n_frames > 1 else np.zeros(len(steps), np.int64)
+    nxt = np.minimum(idx + 1, n_frames - 1)
+    alpha = (steps - idx).astype(np.float32)[None, :]
+
+    mag = np.abs(spec)
+    phase = np.angle(spec)
+    out_mag = (1 - alpha) * mag[:, idx] + alpha * mag[:, nxt]
+
+    omega = (2 * np.pi * HOP * np.arange(n_bins) / N_FFT)[:, None]
+    dphi = phase[:, nxt] - phase[:, idx] - omega
+    dphi -= 2 * np.pi * np.round(dphi / (2 * np.pi))
+    # 相位累加以 float64 計算，避免長曲目累積誤差
+    acc = np.empty(out_mag.shape, np.float64)
+    acc[:, 0] = phase[:, 0]
+    acc[:, 1:] = phase[:, :1] + np.cumsum(omega + dphi[:, :-1], axis=1)
+    out = (out_mag * np.exp(1j * np.mod(acc, 2 * np.pi))).astype(np.complex64)
+    return _istft(out, int(round(len(x) * stretch)))
+
+def shift_audio(wav: np.ndarray, semitones: int, tempo: float = 1.0) -> np.ndarray:
+    """
+    wav: (channels, time)。先以相位聲碼器伸縮 ratio/tempo 倍，再以多相濾波重取樣
+    壓回 1/ratio，得到移調 semitones 個半音、速度 tempo 倍的結果。
+    """
+    ratio = 2.0 ** (semitones / 12.0)
+    stretch = ratio / tempo
+    out = wav.astype(np.float32)
+    if abs(stretch - 1.0) > 1e-6:
+        out = np.stack([time_stretch(ch, stretch) for ch in out])
+    if semitones:
+        frac = Fraction(ratio).limit_denominator(200)
+        out = resample_poly(out, frac.denominator, frac.numerator, axis=-1).astype(np.float32)
+    return out
+
+# ---- 檔案 ----
+
+def variant_suffix(semitones: int, tempo: float) -> str:
+    suffix = f"_key{semitones:+d}"
+    if abs(tempo - 1.0) > 1e-6:
+        suffix += f"_tempo{tempo:.2f}"
+    return suffix
+
+def find_stem(session_dir: str, stem: str) -> Optional[str]:
+    """在 session 目錄中找出某一軌的來源檔，優先使用無損格式。"""
+    for fmt in ("flac", "wav", "aac", "opus"):
+        suffix = f"_{stem}{FORMATS[fmt][0]}"
+        matches = [p for p in glob.glob(os.path.join(session_dir, f"*{suffix}")) if not p.endswith("_no" + suffix)]
+        if matches:
+            return matches[0]
+    return None
+
+def read_audio(path: str):
+    """讀取一軌為 (channels, time) 的 float32 陣列；回傳 (陣列, 取樣率)。"""
+    if path.endswith((".flac", ".wav")):
+        data, sr = sf.read(path, dtype="float32", always_2d=True)
+        return data.T, sr
+    from demucs.audio import AudioFile  # 壓縮格式交給 ffmpeg 解碼
+    sr = 44100
+    return AudioFile(path).read(streams=0, samplerate=sr, channels=2).numpy(), sr
+
+def render_variant(src_path: str, dst_base: str, semitones: int, tempo: float, formats: Sequence[str]) -> Dict[str, str]:
+    """在 worker 行程內執行：讀取來源軌、移調/變速並輸出。"""
+    import torch
+    from .audio_codecs import write_stem
+
+    wav, sr = read_audio(src_path)
+    shifted = shift_audio(wav, semitones, tempo)
+    return write_stem(torch.from_numpy(np.ascontiguousarray(shifted)), dst_base, sr, formats)
+
+class KeyShiftRenderer:
+    """
+    移調版本的算圖與快取：輸出檔放在原 session 目錄（與分離結果一起被快取淘汰）。
+
+    同一個版本只算一次（進行中的請求共用同一個 Future）；
+    每次請求後會在背景預先算出相鄰的 ±1 半音。
+    on_done(輸出路徑) 在每個版本算完時於背景執行緒呼叫（包含預先算圖），供快取重新計算目錄大小。
+    """
+
+    def __init__(self, workers: int = 2, formats: Sequence[str] = ("wav",),
+                 on_done: Optional[Callable[[str], None]] = None):
+        self.workers = max(1, workers)
+        self.formats = tuple(f for f in formats if f != "flac") or ("wav",)
+        self.on_done = on_done
+        self._executor = None
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _paths(self, src_path: str, semitones: int, tempo: float):
+        stem_base = os.path.splitext(src_path)[0]
+        dst_base = stem_base + variant_suffix(semitones, tempo)
+        return dst_base, dst_base + FORMATS[playback_format(self.formats)][0]
+
+    def submit(self, src_path: str, semitones: int, tempo: float = 1.0) -> Future:
+        dst_base, out_path = self._paths(src_path, semitones, tempo)
+        with self._lock:
+            fut = self._inflight.get(out_path)
+            if fut is not None:
+                return fut
+            if os.path.exists(out_path):
+                fut = Future()
+                fut.set_result(out_path)
+                return fut
+            inner = self._executor.submit(render_variant, src_path, dst_base, semitones, tempo, self.formats)
+            fut = Future()
+            self._inflight[out_path] = fut
+
+        def done(f):
+            with self._lock:
+                self._inflight.pop(out_path, None)
+            if f.cancelled():
+                fut.cancel()
+            elif f.exception() is not None:
+                fut.set_exception(f.exception())
+            else:
+                if self.on_done is not None:
+                    try:
+                        self.on_done(out_path)
+                    except Exception:
+                        pass  # 只影響快取統計，不讓算圖結果失敗
+                fut.set_result(out_path)
+
+        inner.add_done_callback(done)
+        return fut
+
+    def prefetch_neighbours(self, src_path: str, semitones: int, tempo: float = 1.0):
+        for n in (semitones - 1, semitones + 1):
+            if abs(n) <= SEMITONE_RANGE and (n != 0 or abs(tempo - 1.0) > 1e-6):
+                self.submit(src_path, n, tempo)
+
+    async def render(self, src_path: str, semitones: int, tempo: float = 1.0) -> str:
+        path = await asyncio.wrap_future(self.submit(src_path, semitones, tempo))
+        self.prefetch_neighbours(src_path, semitones, tempo)
+        return path
@@ -0,0 +1,119 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from typing import Optional, Sequence
+
+import numpy as np
+import scipy.fft
+from scipy.signal import resample_poly
+
+from .keyshift import read_audio
+
+# 對齊以 8 kHz 單聲道計算（GCC-PHAT），再換算回原取樣率
+ALIGN_SR = 8000
+MAX_HINT_DRIFT_SEC = 2.0
+GAIN_RANGE = (0.1, 10.0)
+PEAK_CEILING = 0.98
+
+def _resample(x: np.ndarray, src_sr: int, dst_sr: int) -> np.ndarray:
+    if src_sr == dst_sr:
+        return x
+    frac = Fraction(dst_sr, src_sr).limit_denominator(1000)
+    return resample_poly(x, frac.numerator, frac.denominator, axis=-1).astype(np.float32)
+
+def _gain(db: float) -> float:
+    return float(10.0 ** (db / 20.0))
+
+def estimate_offset(take: np.ndarray, ref: np.ndarray, samplerate: int,
+                    hint: Optional[float] = None, max_drift: float = MAX_HINT_DRIFT_SEC):
+    """
+    以 FFT 互相關（PHAT 加權）估計錄音在參考清唱中的起點。
+
+    take / ref: 單聲道。回傳 (offset 秒, 信心值)：take[0] 對應 ref 的 offset 秒處。
+    hint 為錄音開始時的播放秒數（前端提供），有的話只在 hint ± max_drift 內找峰值。
+    """
+    a = _resample(take, samplerate, ALIGN_SR)
+    b = _resample(ref, samplerate, ALIGN_SR)
+    nfft = scipy.fft.next_fast_len(len(a) + len(b) - 1, real=True)
+    spec = scipy.fft.rfft(a, nfft) * np.conj(scipy.fft.rfft(b, nfft))
+    spec /= np.abs(spec) + 1e-9
+    cc = scipy.fft.irfft(spec, nfft)
+
+    # cc[k] 對應 take 落後 ref k 格；把負延遲移到前面，index i 對應 offset = (len(b)-1) - i
+    corr = np.concatenate([cc[nfft - (len(b) - 1):], cc[:len(a)]])[::-1]
+    offsets = np.arange(-(len(a) - 1), len(b))
+    if hint is not None:
+        window = np.abs(offsets - hint * ALIGN_SR) <= max_drift * ALIGN_SR
+        if window.any():
+            corr, offsets = corr[window], offsets[window]
+    best = int(np.argmax(corr))
+    confidence = float(corr[best] / (np.median(np.abs(corr)) + 1e-9))
+    return offsets[best] / ALIGN_SR, confidence
+
+def _place(take: np.ndarray, offset: int, length: int) -> np.ndarray:
+    """把 (channels, time) 的錄音放到長度 length 的時間軸上 offset 樣本處。"""
+    out = np.zeros((take.shape[0], length), np.float32)
+    src = take[:, max(-offset, 0):]
+    start = max(offset, 0)
+    n = max(min(src.shape[-1], length - start), 0)
+    out[:, start:start + n] = src[:, :n]
+    return out
+
+def render_mixdown(take_path: str, vocals_path: str, inst_path: str, dst_base: str,
+                   hint: Optional[float] = None, vocal_db: float = 0.0, inst_db: float = 0.0,
+                   formats: Sequence[str] = ("aac",)) -> dict:
+    """在 worker 行程內執行：對齊錄音、調整音量後與伴奏混音並編碼。"""
+    import torch
+    from .audio_codecs import write_stem
+
+    inst, sr = read_audio(inst_path)
+    ref, ref_sr = read_audio(vocals_path)
+    ref = _resample(ref, ref_sr, sr)
+    take, take_sr = read_audio(take_path)
+    take = _resample(take, take_sr, sr)
+    if take.shape[0] != inst.shape[0]:
+        take = np.repeat(take.mean(0, keepdims=True), inst.shape[0], axis=0)
+
+    offset_sec, confidence = estimate_offset(take.mean(0), ref.mean(0), sr, hint)
+    vocal = _place(take, int(round(offset_sec * sr)), inst.shape[-1])
+
+    # 音量：讓錄音在重疊區段的 RMS 與原唱相同，再套用使用者指定的增益
+    active = np.abs(vocal).max(0) > 0
+    take_rms = float(np.sqrt(np.mean(vocal[:, active] ** 2))) if active.any() else 0.0
+    ref_rms = float(np.sqrt(np.mean(ref[:, :inst.shape[-1]][:, active[:ref.shape[-1]]] ** 2))) if active.any() else 0.0
+    match = float(np.clip(ref_rms / take_rms, *GAIN_RANGE)) if take_rms > 0 and ref_rms > 0 else 1.0
+    mix = inst * _gain(inst_db) + vocal * (match * _gain(vocal_db))
+    peak = float(np.abs(mix).max()) if mix.size else 0.0
+    if peak > PEAK_CEILING:
+        mix *= PEAK_CEILING / peak
+
+    files = write_stem(torch.from_numpy(np.ascontiguousarray(mix)), dst_base, sr, formats)
+    return {
+        "files": files,
+        "offset": round(offset_sec, 4),
+        "confidence": round(confidence, 2),
+        "vocal_gain": round(match * _gain(vocal_db), 3),
+    }
+
+class MixdownRenderer:
+    """錄音與伴奏的混音行程池（對齊與混音都以 numpy 向量化，在 worker 行程內執行）。"""
+
+    def __init__(self, workers: int = 2, formats: Sequence[str] = ("aac",)):
+        self.workers = max(1, workers)
+        self.formats = tuple(formats)
+        self._executor = None
+
+    def start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, take_path: str, vocals_path: str, inst_path: str, dst_base: str,
+                     hint: Optional[float] = None, vocal_db: float = 0.0, inst_db: float = 0.0) -> dict:
+        fut = self._executor.submit(render_mixdown, take_path, vocals_path, inst_path, dst_base,
+                                    hint, vocal_db, inst_db, self.formats)
+        return await asyncio.wrap_future(fut)
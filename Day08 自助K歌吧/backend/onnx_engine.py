@@ -0,0 +1,168 @@
+import contextlib
+import inspect
+import os
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from demucs.apply import BagOfModels
+from demucs.htdemucs import HTDemucs
+
+# 以 "模型名稱:引擎" 選擇執行引擎，例如 htdemucs:onnx、htdemucs:onnx-int8
+ENGINES = ("onnx", "onnx-int8")
+ONNX_DIR = os.environ.get("DEMUCS_ONNX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ktv_demucs", "onnx"))
+# onnxruntime 的 intra-op 執行緒數（0 = 使用全部核心）
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+# 動態量化只處理矩陣乘法（transformer / 線性層）；卷積維持 float32
+QUANTIZE_OPS = ["MatMul", "Gemm"]
+
+def split_model_name(model_name: str) -> Tuple[str, Optional[str]]:
+    """"htdemucs:onnx-int8" -> ("htdemucs", "onnx-int8")；沒有引擎時為 (名稱, None)。"""
+    base, sep, engine = model_name.partition(":")
+    if not sep:
+        return model_name, None
+    if engine not in ENGINES:
+        raise ValueError(f"不支援的引擎：{engine}（可用：{', '.join(ENGINES)}）")
+    return base, engine
+
+@contextlib.contextmanager
+def _patched(module, **methods):
+    for name, fn in methods.items():
+        setattr(module, name, fn)
+    try:
+        yield
+    finally:
+        for name in methods:
+            delattr(module, name)
+
+class _HTDemucsCore(torch.nn.Module):
+    """
+    匯出用：ONNX 不支援複數 STFT，因此 STFT / 遮罩 / iSTFT 留在 PyTorch，
+    只匯出中間的實數網路。輸入 (mix, mag)，輸出 (時域分支, 頻域分支)。
+    """
+
+    def __init__(self, model: HTDemucs):
+        super().__init__()
+        self.model = model
+
+    def forward(self, mix, mag):
+        captured = {}
+
+        def mask(_z, m):
+            captured["spec"] = m
+            return None
+
+        with _patched(self.model, _spec=lambda _mix: None, _magnitude=lambda _z: mag, _mask=mask,
+                      _ispec=lambda _zout, _length: torch.zeros((), dtype=mix.dtype)):
+            wave = self.model(mix)
+        return wave, captured["spec"]
+
+def _export(model: HTDemucs, path: str, length: int):
+    mix = torch.zeros(1, model.audio_channels, length)
+    mag = model._magnitude(model._spec(mix))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    # 新版 torch 預設走 dynamo 匯出；這裡固定使用 TorchScript 匯出器
+    extra = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    # 不可包在 no_grad 裡：推論模式下 nn.MultiheadAttention 會走無法匯出的融合 kernel
+    fastpath = getattr(torch.backends, "mha", None)
+    if fastpath is not None:
+        fastpath.set_fastpath_enabled(False)
+    try:
+        torch.onnx.export(
+            _HTDemucsCore(model).eval(), (mix, mag), tmp, opset_version=17,
+            input_names=["mix", "mag"], output_names=["wave", "spec"], **extra,
+        )
+    finally:
+        if fastpath is not None:
+            fastpath.set_fastpath_enabled(True)
+    os.replace(tmp, path)
+
+def _ort():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("ONNX 引擎需要安裝 onnxruntime 與 onnx（pip install onnxruntime onnx）")
+    return onnxruntime
+
+def _quantize(src: str, dst: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    quantize_dynamic(src, tmp, weight_type=QuantType.QInt8, op_types_to_quantize=QUANTIZE_OPS)
+    os.replace(tmp, dst)
+
+def _session(path: str):
+    ort = _ort()
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = ONNX_THREADS or (os.cpu_count() or 1)
+    options.inter_op_num_threads = 1
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+class OnnxHTDemucs(torch.nn.Module):
+    """
+    以 onnxruntime 執行的 HTDemucs，可直接交給 demucs.apply.apply_model。
+
+    輸入長度固定為訓練時的 segment；較短的片段補零後再裁回。
+    原模型只保留 STFT 相關設定（權重移到 meta 裝置釋放記憶體）。
+    """
+
+    def __init__(self, model: HTDemucs, session):
+        super().__init__()
+        self.sources = model.sources
+        self.samplerate = model.samplerate
+        self.audio_channels = model.audio_channels
+        self.segment = model.segment
+        self.length = int(model.segment * model.samplerate)
+        self.session = session
+        # apply_model 會讀取第一個參數所在的裝置
+        self._anchor = torch.nn.Parameter(torch.zeros(0), requires_grad=False)
+        # 不註冊為子模組：apply_model 會呼叫 .to(device)
+        object.__setattr__(self, "_stft", model.to("meta"))
+
+    def valid_length(self, length: int) -> int:
+        # 與 HTDemucs 相同：apply_model 會以前後文把片段補到 segment 長度
+        return self.length
+
+    def forward(self, mix: torch.Tensor) -> torch.Tensor:
+        device, length = mix.device, mix.shape[-1]
+        if length > self.length:
+            raise ValueError(f"輸入長度 {length} 超過 segment 長度 {self.length}，請以 split=True 呼叫 apply_model")
+        mix = F.pad(mix.detach().cpu().float(), (0, self.length - length))
+        z = self._stft._spec(mix)
+        mag = self._stft._magnitude(z)
+        waves, specs = [], []
+        for b in range(mix.shape[0]):
+            wave, spec = self.session.run(None, {"mix": mix[b:b + 1].numpy(), "mag": mag[b:b + 1].contiguous().numpy()})
+            waves.append(torch.from_numpy(wave))
+            specs.append(torch.from_numpy(spec))
+        zout = self._stft._mask(z, torch.cat(specs))
+        out = self._stft._ispec(zout, self.length) + torch.cat(waves)
+        return out[..., :length].to(device)
+
+def build_onnx_model(model, base_name: str, engine: str) -> BagOfModels:
+    """
+    將已載入的 demucs 模型轉為 onnxruntime 版本。第一次會匯出 ONNX 檔
+    （engine 為 onnx-int8 時再做動態量化），存放於 DEMUCS_ONNX_DIR 後重複使用。
+    """
+    _ort()
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    bag = model if isinstance(model, BagOfModels) else BagOfModels([model])
+    wrapped = []
+    for i, sub in enumerate(bag.models):
+        if not isinstance(sub, HTDemucs):
+            raise ValueError(f"ONNX 引擎只支援 HTDemucs 系列模型（{base_name} 含 {type(sub).__name__}）")
+        sub = sub.cpu().eval()
+        length = int(sub.segment * sub.samplerate)
+        path = os.path.join(ONNX_DIR, f"{base_name}-{i}-{length}.onnx")
+        if not os.path.exists(path):
+            _export(sub, path, length)
+        if engine == "onnx-int8":
+            quantized = path[:-len(".onnx")] + "-int8.onnx"
+            if not os.path.exists(quantized):
+                _quantize(path, quantized)
+            path = quantized
+        wrapped.append(OnnxHTDemucs(sub, _session(path)))
+    return BagOfModels(wrapped, weights=bag.weights)
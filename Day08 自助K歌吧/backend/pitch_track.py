@@ -0,0 +1,158 @@
+import glob
+import os
+import struct
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+# 參考音高軌：每 10 ms 一格，存成 <base>_pitch.bin 與分離結果放在一起
+ANALYSIS_SR = 16000
+HOP_MS = 10
+FRAME_LENGTH = 1024
+FMIN, FMAX = 70.0, 1000.0
+SILENCE_DB = -35.0  # 低於整首最大 RMS 這麼多 dB 視為無聲
+
+# 檔頭：magic、版本、每格毫秒數、格數；之後為 uint16 音高（MIDI × 100，0 = 無聲）
+# 與 uint8 起音旗標，全部 little-endian
+MAGIC = b"KTVP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+PITCH_SUFFIX = "_pitch.bin"
+
+def hz_to_cents(f0: np.ndarray) -> np.ndarray:
+    """Hz -> MIDI 音高 × 100（A4 = 6900）；非正值回傳 0。"""
+    f0 = np.asarray(f0, dtype=np.float64)
+    out = np.zeros(f0.shape, np.float64)
+    voiced = f0 > 0
+    out[voiced] = 6900.0 + 1200.0 * np.log2(f0[voiced] / 440.0)
+    return out
+
+def extract_pitch_track(mono: np.ndarray, samplerate: int):
+    """
+    由清唱軌（單聲道 float）估計基頻與起音：回傳 (cents uint16[n], onsets uint8[n])。
+
+    以 librosa.yin 逐格估計 f0，再以 RMS 門檻判斷有聲/無聲；
+    起音取 onset_strength 的峰值，與音高共用同一個 10 ms 時間格。
+    """
+    import librosa
+
+    y = librosa.resample(np.asarray(mono, dtype=np.float32), orig_sr=samplerate, target_sr=ANALYSIS_SR)
+    hop = ANALYSIS_SR * HOP_MS // 1000
+    if len(y) < FRAME_LENGTH:
+        y = np.pad(y, (0, FRAME_LENGTH - len(y)))
+
+    f0 = librosa.yin(y, fmin=FMIN, fmax=FMAX, sr=ANALYSIS_SR, frame_length=FRAME_LENGTH, hop_length=hop)
+    rms = librosa.feature.rms(y=y, frame_length=FRAME_LENGTH, hop_length=hop)[0]
+    n = min(len(f0), len(rms))
+    f0, rms = f0[:n], rms[:n]
+    floor = rms.max() * 10 ** (SILENCE_DB / 20) if n else 0.0
+    f0 = np.where(rms > floor, f0, 0.0)
+    cents = np.clip(np.rint(hz_to_cents(f0)), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+    envelope = librosa.onset.onset_strength(y=y, sr=ANALYSIS_SR, hop_length=hop)
+    frames = librosa.onset.onset_detect(onset_envelope=envelope, sr=ANALYSIS_SR, hop_length=hop)
+    onsets = np.zeros(n, np.uint8)
+    onsets[frames[frames < n]] = 1
+    return cents, onsets
+
+def write_pitch_track(path: str, cents: np.ndarray, onsets: np.ndarray) -> str:
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, HOP_MS, len(cents)))
+        f.write(cents.astype("<u2").tobytes())
+        f.write(onsets.astype(np.uint8).tobytes())
+    os.replace(tmp, path)
+    return path
+
+def build_pitch_track(mono: np.ndarray, samplerate: int, path: str) -> str:
+    cents, onsets = extract_pitch_track(mono, samplerate)
+    return write_pitch_track(path, cents, onsets)
+
+def find_pitch_track(session_dir: str):
+    matches = glob.glob(os.path.join(session_dir, f"*{PITCH_SUFFIX}"))
+    return matches[0] if matches else None
+
+@dataclass
+class PitchTrack:
+    cents: np.ndarray   # uint16，MIDI × 100，0 = 無聲
+    onsets: np.ndarray  # uint8，1 = 此格有起音
+    hop_ms: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.cents) * self.hop_ms / 1000.0
+
+    def at(self, t: float):
+        """時間 t（秒）的參考音高（cents，無聲為 0）與起音旗標；O(1)。"""
+        i = int(t * 1000.0 / self.hop_ms)
+        if i < 0 or i >= len(self.cents):
+            return 0, False
+        return int(self.cents[i]), bool(self.onsets[i])
+
+def read_pitch_track(path: str) -> PitchTrack:
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, hop_ms, n = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or len(data) < HEADER.size + 3 * n:
+        raise ValueError(f"無效的音高軌檔案：{os.path.basename(path)}")
+    cents = np.frombuffer(data, dtype="<u2", count=n, offset=HEADER.size)
+    onsets = np.frombuffer(data, dtype=np.uint8, count=n, offset=HEADER.size + 2 * n)
+    return PitchTrack(cents=cents, onsets=onsets, hop_ms=hop_ms)
+
+class PitchTrackCache:
+    """已載入音高軌的 LRU（每首約數十 KB，多個包廂唱同一首時共用）。"""
+
+    def __init__(self, max_items: int = 64):
+        self.max_items = max_items
+        self._items: "OrderedDict[tuple, PitchTrack]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> PitchTrack:
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            track = self._items.get(key)
+            if track is not None:
+                self._items.move_to_end(key)
+                return track
+        track = read_pitch_track(path)
+        with self._lock:
+            self._items[key] = track
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return track
+
+def fold_cents(diff: float) -> float:
+    """音高差折回 ±600 cents 之內（唱高/低八度也算對）。"""
+    return (diff + 600.0) % 1200.0 - 600.0
+
+class SingingScore:
+    """
+    即時評分狀態（每條 WebSocket 連線一份）。
+
+    只計算參考軌有聲的格；每一格只計分一次，
+    誤差在 tolerance cents 內算命中。
+    """
+
+    def __init__(self, track: PitchTrack, tolerance: float = 50.0):
+        self.track = track
+        self.tolerance = tolerance
+        self.scored = np.zeros(len(track.cents), dtype=bool)
+        self.voiced = 0
+        self.hits = 0
+
+    def update(self, t: float, f0: float) -> dict:
+        ref, onset = self.track.at(t)
+        out = {"t": round(t, 3), "ref": ref, "onset": onset, "cents": None, "hit": False}
+        if ref:
+            i = int(t * 1000.0 / self.track.hop_ms)
+            if f0 > 0:
+                out["cents"] = round(fold_cents(float(hz_to_cents(f0)) - ref), 1)
+                out["hit"] = abs(out["cents"]) <= self.tolerance
+            if not self.scored[i]:
+                self.scored[i] = True
+                self.voiced += 1
+                self.hits += int(out["hit"])
+        out["score"] = round(100.0 * self.hits / self.voiced, 1) if self.voiced else 0.0
+        return out
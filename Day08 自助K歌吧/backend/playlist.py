@@ -0,0 +1,81 @@
+import threading
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# 待唱清單的優先序：0 保留給有人正在等的上傳，清單第 n 首為 PRIORITY_BASE + n
+PRIORITY_BASE = 1
+
+class PlaylistFull(Exception):
+    """包廂的待唱清單已達上限。"""
+
+@dataclass
+class PlaylistItem:
+    id: str
+    key: str
+    filename: str
+    job_id: Optional[str] = None
+    result: Optional[dict] = None  # 快取命中時直接填入
+
+class PlaylistRegistry:
+    """
+    各包廂（room）登錄的待唱清單。
+
+    清單順序即背景預先分離的優先序：越前面的歌越早分離，
+    插隊（調整順序）時由呼叫端依 job_priorities() 重新設定工作優先序。
+    """
+
+    def __init__(self, max_items: int = 50):
+        self.max_items = max_items
+        self._rooms: Dict[str, List[PlaylistItem]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, room: str, key: str, filename: str, position: Optional[int] = None) -> PlaylistItem:
+        with self._lock:
+            items = self._rooms.setdefault(room, [])
+            if len(items) >= self.max_items:
+                raise PlaylistFull()
+            item = PlaylistItem(id=uuid.uuid4().hex[:10], key=key, filename=filename)
+            if position is None or position >= len(items):
+                items.append(item)
+            else:
+                items.insert(max(position, 0), item)
+            return item
+
+    def remove(self, room: str, item_id: str) -> Optional[PlaylistItem]:
+        with self._lock:
+            items = self._rooms.get(room, [])
+            for i, item in enumerate(items):
+                if item.id == item_id:
+                    del items[i]
+                    if not items:
+                        del self._rooms[room]
+                    return item
+            return None
+
+    def reorder(self, room: str, order: List[str]) -> List[PlaylistItem]:
+        """依 order 重新排列；未列出的項目保持原相對順序接在後面。"""
+        with self._lock:
+            items = self._rooms.get(room, [])
+            rank = {item_id: i for i, item_id in enumerate(order)}
+            items.sort(key=lambda it: rank.get(it.id, len(order)))
+            return list(items)
+
+    def items(self, room: str) -> List[PlaylistItem]:
+        with self._lock:
+            return list(self._rooms.get(room, []))
+
+    def references(self, job_id: str) -> int:
+        with self._lock:
+            return sum(1 for items in self._rooms.values() for it in items if it.job_id == job_id)
+
+    def job_priorities(self) -> Dict[str, int]:
+        """各工作在所有包廂中最靠前的位置所對應的優先序。"""
+        out: Dict[str, int] = {}
+        with self._lock:
+            for items in self._rooms.values():
+                for position, item in enumerate(items):
+                    if item.job_id:
+                        priority = PRIORITY_BASE + position
+                        out[item.job_id] = min(out.get(item.job_id, priority), priority)
+        return out
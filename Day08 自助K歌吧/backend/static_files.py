@@ -0,0 +1,114 @@
+import os
+import re
+import mimetypes
+from typing import Iterator, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.staticfiles import StaticFiles
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+READ_CHUNK = 256 * 1024
+
+# 分離輸出的壓縮格式（部分平台的 mimetypes 沒有登錄）
+mimetypes.add_type("audio/ogg", ".opus")
+mimetypes.add_type("audio/mp4", ".m4a")
+mimetypes.add_type("audio/flac", ".flac")
+
+def strong_etag(stat_result: os.stat_result) -> str:
+    # 輸出檔寫入後不再修改：以 inode + 大小 + 修改時間 (ns) 作為強式 ETag
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析單一 bytes 範圍，回傳 (start, end)（含 end）。
+
+    多重範圍或格式錯誤回傳 None（改送完整內容）；無法滿足時拋出 ValueError。
+    """
+    m = RANGE_RE.match(header.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+def _iter_file(path: str, start: int, end: int) -> Iterator[bytes]:
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+class CachedStaticFiles(StaticFiles):
+    """
+    /storage 專用的靜態檔案服務：
+
+    - 強式 ETag 與 If-None-Match（304）
+    - Accept-Ranges / 單一 Range 請求（206，含 If-Range）
+    - 長效 Cache-Control（輸出檔不會被改寫）
+    - hidden 中的檔名（例如快取索引）不對外提供
+    """
+
+    def __init__(self, *args, max_age: int = 31536000, hidden: Tuple[str, ...] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = f"public, max-age={max_age}, immutable"
+        self.hidden = set(hidden)
+
+    async def get_response(self, path: str, scope) -> Response:
+        if os.path.basename(path) in self.hidden:
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        etag = strong_etag(stat_result)
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": self.cache_control,
+        }
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            return Response(status_code=304, headers=headers)
+
+        size = stat_result.st_size
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and status_code == 200 and (not if_range or if_range.strip() == etag):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            if byte_range is not None:
+                start, end = byte_range
+                media_type = mimetypes.guess_type(str(full_path))[0] or "application/octet-stream"
+                return StreamingResponse(
+                    _iter_file(str(full_path), start, end),
+                    status_code=206,
+                    media_type=media_type,
+                    headers={
+                        **headers,
+                        "Content-Range": f"bytes {start}-{end}/{size}",
+                        "Content-Length": str(end - start + 1),
+                    },
+                )
+
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers.update(headers)
+        return response
@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional
+
+INDEX_NAME = "cache_index.json"
+SESSION_PREFIX = "session_"
+
+def cache_key(audio_sha256: str, model_name: str) -> str:
+    """快取鍵：音訊內容的 SHA-256 加上模型名稱。"""
+    return f"{model_name}-{audio_sha256}"
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class StemCache:
+    """
+    以內容雜湊為鍵的分離結果快取（存放於 STORAGE_DIR）。
+
+    - 每筆紀錄對應一個 session 目錄與 /api/separate 回傳的 URL
+    - 依最近使用順序（LRU）淘汰，總大小不超過 budget_bytes
+    - 索引寫在 STORAGE_DIR/cache_index.json，重啟後仍有效；新增與淘汰立即寫入，
+      命中只更新記憶體中的 LRU 順序，最多每 save_interval 秒寫一次（關閉時呼叫 flush()）
+    """
+
+    def __init__(self, storage_dir: Path, budget_bytes: int, save_interval: float = 30.0):
+        self.storage_dir = Path(storage_dir)
+        self.budget_bytes = budget_bytes
+        self.save_interval = save_interval
+        self.index_path = self.storage_dir / INDEX_NAME
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._saved_at = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.index_path.exists():
+            return
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        items = sorted(data.items(), key=lambda kv: kv[1].get("atime", 0))
+        for key, entry in items:
+            if (self.storage_dir / entry["dir"]).is_dir():
+                self._entries[key] = entry
+
+    def _save(self):
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def flush(self):
+        """把尚未寫入的 LRU 順序寫回索引。"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(e["bytes"] for e in self._entries.values())
+
+    def lookup(self, key: str, record: bool = True) -> Optional[dict]:
+        """查詢快取；record=False 時不計入命中率（例如清單頁面輪詢）。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not (self.storage_dir / entry["dir"]).is_dir():
+                del self._entries[key]
+                self._save()
+                entry = None
+            if record:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            if entry is None:
+                return None
+            entry["atime"] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                self._save()
+            return dict(entry["payload"])
+
+    def store(self, key: str, session_dir: Path, payload: dict) -> list:
+        """登錄新結果並依 LRU 淘汰超出預算的舊紀錄，回傳被刪除的目錄。"""
+        session_dir = Path(session_dir)
+        entry = {
+            "dir": session_dir.name,
+            "payload": dict(payload),
+            "bytes": dir_size(session_dir),
+            "atime": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            evicted = self._evict(keep=key)
+            self._save()
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+        return evicted
+
+    def payload_for_dir(self, dir_name: str) -> Optional[dict]:
+        with self._lock:
+            entry = next((e for e in self._entries.values() if e["dir"] == dir_name), None)
+            return dict(entry["payload"]) if entry is not None else None
+
+    def refresh_size(self, dir_name: str) -> list:
+        """session 目錄新增檔案（例如移調版本）後重新計算大小並依預算淘汰。"""
+        with self._lock:
+            key = next((k for k, e in self._entries.items() if e["dir"] == dir_name), None)
+            if key is None:
+                return []
+            self._entries[key]["bytes"] = dir_size(self.storage_dir / dir_name)
+            evicted = self._evict(keep=key)
+            self._save()
+        for path in evicted:
+            shutil.rmtree(path, ignore_errors=True)
+        return evicted
+
+    def _evict(self, keep: str) -> list:
+        evicted = []
+        total = sum(e["bytes"] for e in self._entries.values())
+        while total > self.budget_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                break
+            del self._entries[key]
+            total -= entry["bytes"]
+            evicted.append(self.storage_dir / entry["dir"])
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e["bytes"] for e in self._entries.values()),
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+    def janitor(self, grace_seconds: float = 3600.0, keep: Iterable[str] = ()) -> list:
+        """刪除不在索引中的 session 目錄（超過 grace_seconds 未修改者，避免誤刪處理中的上傳）。"""
+        with self._lock:
+            referenced = {e["dir"] for e in self._entries.values()} | set(keep)
+        now = time.time()
+        removed = []
+        for path in self.storage_dir.glob(f"{SESSION_PREFIX}*"):
+            if not path.is_dir() or path.name in referenced:
+                continue
+            try:
+                age = now - path.stat().st_mtime
+            except OSError:
+                continue
+            if age >= grace_seconds:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        return removed
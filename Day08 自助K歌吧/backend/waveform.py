@@ -0,0 +1,136 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+
+# 多解析度波形峰值：每個 bin 存 (min, max)，int16；細層依序 8 倍合併成粗層
+LEVELS = (256, 2048, 16384)
+PEAKS_DIR = "peaks"
+TRACKS = ("original", "vocals", "instrumental")
+
+# 檔頭：magic、版本、層數、取樣率、總樣本數；之後每層 (samples_per_bin, bins)，再接各層資料
+MAGIC = b"KTVW"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQ")
+LEVEL_HEADER = struct.Struct("<II")
+
+def peaks_path(session_dir: str, track: str) -> str:
+    return os.path.join(session_dir, PEAKS_DIR, f"{track}.bin")
+
+def _to_mono(wav: np.ndarray) -> np.ndarray:
+    wav = np.asarray(wav, dtype=np.float32)
+    return wav.mean(0) if wav.ndim == 2 else wav
+
+def compute_pyramid(mono: np.ndarray, levels: Tuple[int, ...] = LEVELS) -> List[np.ndarray]:
+    """回傳各層 (bins, 2) 的 int16 [min, max]；第一層直接由樣本計算，其後由前一層合併。"""
+    scale = np.iinfo(np.int16).max
+    base = levels[0]
+    n_bins = max(1, -(-len(mono) // base))
+    padded = np.zeros(n_bins * base, np.float32)
+    padded[:len(mono)] = mono
+    frames = padded.reshape(n_bins, base)
+    lo, hi = frames.min(axis=1), frames.max(axis=1)
+
+    out = []
+    for i, spb in enumerate(levels):
+        if i:
+            factor = spb // levels[i - 1]
+            n = -(-len(lo) // factor)
+            pad = n * factor - len(lo)
+            lo = np.pad(lo, (0, pad), mode="edge").reshape(n, factor).min(axis=1)
+            hi = np.pad(hi, (0, pad), mode="edge").reshape(n, factor).max(axis=1)
+        out.append(np.clip(np.stack([lo, hi], axis=1) * scale, -scale, scale).astype("<i2"))
+    return out
+
+def write_peaks(path: str, wav: np.ndarray, samplerate: int, levels: Tuple[int, ...] = LEVELS) -> str:
+    mono = _to_mono(wav)
+    pyramid = compute_pyramid(mono, levels)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(levels), samplerate, len(mono)))
+        for spb, data in zip(levels, pyramid):
+            f.write(LEVEL_HEADER.pack(spb, len(data)))
+        for data in pyramid:
+            f.write(data.tobytes())
+    os.replace(tmp, path)
+    return path
+
+class PeakFile:
+    """以 memmap 開啟的峰值檔；viewport 只讀取需要的 bin。"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            head = f.read(HEADER.size)
+            magic, version, n_levels, self.samplerate, self.length = HEADER.unpack(head)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"無效的波形檔案：{os.path.basename(path)}")
+            self.levels = [LEVEL_HEADER.unpack(f.read(LEVEL_HEADER.size)) for _ in range(n_levels)]
+        offset = HEADER.size + LEVEL_HEADER.size * n_levels
+        self._data = []
+        for _spb, bins in self.levels:
+            self._data.append(np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(bins, 2)))
+            offset += bins * 4
+
+    @property
+    def duration(self) -> float:
+        return self.length / self.samplerate
+
+    def viewport(self, start: float, end: float, width: int) -> dict:
+        """
+        回傳 [start, end) 秒之間、約 width 個像素所需的峰值。
+
+        選擇每 bin 樣本數不超過「每像素樣本數」的最粗一層（都太粗時用最細層）；
+        超過 width 個 bin 時再合併，回傳的 bin 數不超過 width。
+        """
+        start = max(0.0, start)
+        end = min(self.duration, end) if end > 0 else self.duration
+        width = max(1, width)
+        per_pixel = max((end - start) * self.samplerate / width, 1.0)
+        level = 0
+        for i, (spb, _bins) in enumerate(self.levels):
+            if spb <= per_pixel:
+                level = i
+        spb, bins = self.levels[level]
+        first = min(int(start * self.samplerate) // spb, bins)
+        last = min(-(-int(end * self.samplerate) // spb), bins)
+        data = np.asarray(self._data[level][first:last])
+
+        factor = -(-len(data) // width) if len(data) > width else 1
+        if factor > 1:
+            n = -(-len(data) // factor)
+            data = np.pad(data, ((0, n * factor - len(data)), (0, 0)), mode="edge").reshape(n, factor, 2)
+            data = np.stack([data[..., 0].min(axis=1), data[..., 1].max(axis=1)], axis=1)
+        return {
+            "samplerate": self.samplerate,
+            "samples_per_bin": spb * factor,
+            "start": first * spb / self.samplerate,
+            "bits": 16,
+            "min": data[:, 0].tolist(),
+            "max": data[:, 1].tolist(),
+        }
+
+class PeakFileCache:
+    """已開啟峰值檔的 LRU（memmap 只佔用頁快取）。"""
+
+    def __init__(self, max_items: int = 128):
+        self.max_items = max_items
+        self._items: "OrderedDict[tuple, PeakFile]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> PeakFile:
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            peaks = self._items.get(key)
+            if peaks is not None:
+                self._items.move_to_end(key)
+                return peaks
+        peaks = PeakFile(path)
+        with self._lock:
+            self._items[key] = peaks
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return peaks
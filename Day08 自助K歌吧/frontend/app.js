@@ -9,6 +9,8 @@ const progress = el('#progress');
 const progressBar = el('#progress .bar');
 const progressLabel = el('#progress .label');
 const queueEl = el('#queue');
+const btnPreview = el('#btnPreview');
+const playlistEl = el('#playlist');
 
 const playerOriginal = el('#playerOriginal');
 const playerVocals   = el('#playerVocals');
@@ -24,10 +26,15 @@ const eqLow = el('#eqLow');
 const eqMid = el('#eqMid');
 const eqHigh = el('#eqHigh');
 const rate = el('#rate');
+const keyShift = el('#keyShift');
+const wave = el('#wave');
 
 const btnMic = el('#btnMic');
 const btnRec = el('#btnRec');
 const dlRec = el('#dlRec');
+const scoreEl = el('#score');
+const btnMix = el('#btnMix');
+const dlMix = el('#dlMix');
 const viz = el('#viz');
 
 const lrcInput = el('#lrcInput');
@@ -36,7 +43,9 @@ const lrcBox = el('#lrc');
 let AC, masterGain, delayNode, convolver, convolverGain;
 let eq = {low:null, mid:null, high:null};
 let analyser, vizCtx, dest, mediaRecorder, recChunks = [];
-let micStream, micNode;
+let micStream, micNode, micAnalyser, pitchTimer;
+let scoreSocket = null;
+let takeRecorder, takeChunks = [], takeStart = null, takeBlob = null;
 
 function ensureAudioGraph(){
   if (AC) return;
@@ -140,6 +149,27 @@ eqMid.addEventListener('input', e => { ensureAudioGraph(); eq.mid.gain.value = p
 eqHigh.addEventListener('input', e => { ensureAudioGraph(); eq.high.gain.value = parseFloat(e.target.value); });
 rate.addEventListener('input', e => setPlaybackRate(parseFloat(e.target.value)));
 
+// 伴奏移調：由後端算圖（第一次稍慢，之後直接取用快取）
+keyShift.addEventListener('change', async e => {
+  if(!currentSession) return;
+  const semitones = parseInt(e.target.value, 10);
+  keyShift.disabled = true;
+  try{
+    const resp = await fetch(`/api/keyshift?session=${currentSession}&semitones=${semitones}`);
+    if(!resp.ok) return;
+    const { url } = await resp.json();
+    const t = playerInst.currentTime, playing = !playerInst.paused;
+    playerInst.src = url;
+    playerInst.addEventListener('loadedmetadata', () => {
+      playerInst.currentTime = t;
+      playerInst.playbackRate = parseFloat(rate.value);
+      if(playing) playerInst.play();
+    }, {once:true});
+  } finally {
+    keyShift.disabled = false;
+  }
+});
+
 // Drag & drop / file select
 pickBtn.addEventListener('click', ()=> fileInput.click());
 dropzone.addEventListener('dragover', e => { e.preventDefault(); dropzone.classList.add('hover'); });
@@ -147,13 +177,19 @@ dropzone.addEventListener('dragleave', e => { dropzone.classList.remove('hover')
 dropzone.addEventListener('drop', e => {
   e.preventDefault(); dropzone.classList.remove('hover');
   if (e.dataTransfer.files && e.dataTransfer.files[0]) {
-    handleFile(e.dataTransfer.files[0]);
+    handleFiles(Array.from(e.dataTransfer.files));
   }
 });
 fileInput.addEventListener('change', e => {
-  if (e.target.files[0]) handleFile(e.target.files[0]);
+  if (e.target.files[0]) handleFiles(Array.from(e.target.files));
 });
 
+// 第一首立即分離；其餘登錄到待唱清單，由後端依順序在背景預先分離
+function handleFiles(files){
+  handleFile(files[0]);
+  files.slice(1).forEach(registerSong);
+}
+
 async function handleFile(file){
   queueEl.insertAdjacentHTML('beforeend', `<div class="item">佇列：${file.name}</div>`);
   progress.classList.remove('hidden');
@@ -162,32 +198,224 @@ async function handleFile(file){
   const form = new FormData();
   form.append('file', file);
 
-  const resp = await fetch('/api/separate', { method:'POST', body:form });
+  resetPreview();
+  const resp = await fetch('/api/separate?stream=true', { method:'POST', body:form });
   if(!resp.ok){
-    setProgress(0, '分離失敗 😢');
+    setProgress(0, resp.status === 503 ? '佇列已滿，請稍後再試 😢' : '分離失敗 😢');
     return;
   }
-  setProgress(0.7, '分離中，請稍候…');
 
-  const data = await resp.json();
+  let data = await resp.json();
+  if(data.status !== 'done'){
+    data = await waitForJob(data.job);
+    if(data.status !== 'done'){
+      setProgress(0, data.status === 'cancelled' ? '已取消' : '分離失敗 😢');
+      return;
+    }
+  }
+  btnPreview.classList.add('hidden'); // 預覽若已開始會播放到最後一段
+  loadResult(data.result);
+
+  setProgress(1.0, '完成 ✅');
+  setTimeout(()=> progress.classList.add('hidden'), 1500);
+}
+
+let currentSession = null;
+
+function loadResult(result){
   // 取得檔案 URL
-  const { original, vocals, instrumental } = data;
+  const { original, vocals, instrumental } = result;
+  currentSession = result.session;
+  keyShift.value = '0';
+  openScoreSocket(currentSession);
+  loadWaveform(currentSession);
 
   playerOriginal.src = original;
   playerVocals.src = vocals;
   playerInst.src = instrumental;
 
-  dlVocals.href = vocals; dlVocals.download = 'vocals.wav';
-  dlInst.href = instrumental; dlInst.download = 'instrumental.wav';
+  // 下載優先提供無損（flac），否則用播放檔
+  const downloads = result.downloads || {};
+  const dlVocalsUrl = (downloads.vocals || {}).flac || vocals;
+  const dlInstUrl = (downloads.instrumental || {}).flac || instrumental;
+  dlVocals.href = dlVocalsUrl; dlVocals.download = 'vocals' + fileExt(dlVocalsUrl);
+  dlInst.href = dlInstUrl; dlInst.download = 'instrumental' + fileExt(dlInstUrl);
 
   ;[playerOriginal, playerVocals, playerInst].forEach(tag => {
+    if(tag.dataset.connected) return; // MediaElementSource 每個元素只能建立一次
+    tag.dataset.connected = '1';
     tag.addEventListener('play', ()=> connectTagAudio(tag), {once:true});
   });
+}
 
-  setProgress(1.0, '完成 ✅');
-  setTimeout(()=> progress.classList.add('hidden'), 1500);
+// 伴奏波形：只向後端要畫布寬度所需的峰值（數 KB），點擊可跳轉
+let wavePeaks = null;
+
+async function loadWaveform(session){
+  wavePeaks = null;
+  drawWaveform();
+  const resp = await fetch(`/api/waveform/${session}/instrumental?width=${wave.width}`);
+  if(resp.ok && session === currentSession){
+    wavePeaks = await resp.json();
+    drawWaveform();
+  }
+}
+
+function drawWaveform(){
+  const ctx = wave.getContext('2d');
+  ctx.clearRect(0, 0, wave.width, wave.height);
+  if(!wavePeaks) return;
+  const { min, max, duration } = wavePeaks;
+  const mid = wave.height / 2, scale = mid / 32767, w = wave.width / min.length;
+  const played = duration ? playerInst.currentTime / duration * wave.width : 0;
+  for(let i=0;i<min.length;i++){
+    const x = i * w;
+    ctx.fillStyle = x < played ? '#06b6d4' : '#7c3aed';
+    ctx.fillRect(x, mid - max[i]*scale, Math.max(w, 1), Math.max((max[i]-min[i])*scale, 1));
+  }
+}
+
+playerInst.addEventListener('timeupdate', drawWaveform);
+wave.addEventListener('click', e => {
+  if(!wavePeaks) return;
+  const t = e.offsetX / wave.clientWidth * wavePeaks.duration;
+  [playerOriginal, playerVocals, playerInst].forEach(p => { if(p.src) p.currentTime = t; });
+});
+
+// 待唱清單（每個瀏覽器一個包廂 ID）
+const ROOM = localStorage.getItem('ktvRoom') || (() => {
+  const id = Math.random().toString(36).slice(2, 10);
+  localStorage.setItem('ktvRoom', id);
+  return id;
+})();
+let playlistTimer = null;
+
+async function registerSong(file){
+  const form = new FormData();
+  form.append('file', file);
+  const resp = await fetch(`/api/playlist/${ROOM}/songs`, { method:'POST', body:form });
+  if(resp.ok) renderPlaylist(await resp.json());
+}
+
+async function refreshPlaylist(){
+  const resp = await fetch(`/api/playlist/${ROOM}`);
+  if(resp.ok) renderPlaylist(await resp.json());
+}
+
+async function moveToFront(itemId, items){
+  const order = [itemId, ...items.map(it => it.id).filter(id => id !== itemId)];
+  const resp = await fetch(`/api/playlist/${ROOM}`, {
+    method:'PUT', headers:{'Content-Type':'application/json'}, body: JSON.stringify({order}),
+  });
+  if(resp.ok) renderPlaylist(await resp.json());
+}
+
+function renderPlaylist(data){
+  const label = { queued:'等待預先分離', running:'分離中', done:'可以唱了 ✅', failed:'失敗', cancelled:'已取消', missing:'已過期' };
+  playlistEl.innerHTML = '';
+  data.items.forEach(it => {
+    const div = document.createElement('div');
+    div.className = 'item';
+    const pct = it.status === 'running' ? ` ${Math.round(it.progress*100)}%` : '';
+    div.textContent = `${it.position + 1}. ${it.filename} · ${label[it.status] || it.status}${pct}`;
+    if(it.result){
+      const play = document.createElement('button');
+      play.className = 'btn'; play.textContent = '唱這首';
+      play.onclick = async () => {
+        loadResult(it.result);
+        await fetch(`/api/playlist/${ROOM}/songs/${it.id}`, { method:'DELETE' });
+        refreshPlaylist();
+      };
+      div.appendChild(play);
+    }else if(it.position > 0){
+      const jump = document.createElement('button');
+      jump.className = 'btn'; jump.textContent = '插隊';
+      jump.onclick = () => moveToFront(it.id, data.items);
+      div.appendChild(jump);
+    }
+    playlistEl.appendChild(div);
+  });
+  clearTimeout(playlistTimer);
+  if(data.items.some(it => it.status === 'queued' || it.status === 'running')){
+    playlistTimer = setTimeout(refreshPlaylist, 3000);
+  }
+}
+refreshPlaylist();
+
+function fileExt(url){
+  const m = url.match(/\.[a-z0-9]+$/i);
+  return m ? m[0] : '';
+}
+
+// 以 SSE 追蹤背景分離工作：排隊位置 / 進度 / 預估剩餘時間
+function waitForJob(jobId){
+  return new Promise(resolve => {
+    const es = new EventSource(`/api/jobs/${jobId}/events`);
+    es.onmessage = e => {
+      const job = JSON.parse(e.data);
+      if(job.segments) addPreviewSegments(job.segments);
+      const eta = job.eta != null ? `，約 ${Math.ceil(job.eta)} 秒` : '';
+      if(job.status === 'queued'){
+        setProgress(0.2, `排隊中（第 ${job.position} 位${eta}）…`);
+      }else if(job.status === 'running'){
+        setProgress(0.2 + job.progress * 0.8, `分離中 ${Math.round(job.progress*100)}%${eta}…`);
+      }else{
+        es.close();
+        resolve(job);
+      }
+    };
+    es.onerror = () => { es.close(); resolve({status:'failed'}); };
+  });
+}
+
+// 串流預覽：分離完成的片段依序以 AudioBuffer 接續播放（伴奏）
+let preview = { segments: [], scheduled: 0, nextTime: 0, sources: [], playing: false };
+
+function resetPreview(){
+  stopPreview();
+  preview = { segments: [], scheduled: 0, nextTime: 0, sources: [], playing: false };
+  btnPreview.disabled = true;
+  btnPreview.classList.remove('hidden');
+}
+
+function stopPreview(){
+  preview.sources.forEach(src => { try { src.stop(); } catch(e){} });
+  preview.sources = [];
+  preview.playing = false;
+  btnPreview.classList.add('hidden');
+}
+
+function addPreviewSegments(segments){
+  for(const seg of segments.slice(preview.segments.length)){
+    preview.segments.push({ ...seg, buffer: fetch(seg.instrumental).then(r => r.arrayBuffer()) });
+  }
+  btnPreview.disabled = preview.segments.length === 0;
+  if(preview.playing) schedulePreview();
+}
+
+async function schedulePreview(){
+  while(preview.playing && preview.scheduled < preview.segments.length){
+    const seg = preview.segments[preview.scheduled++];
+    const audio = await AC.decodeAudioData(await seg.buffer);
+    const src = AC.createBufferSource();
+    src.buffer = audio;
+    src.connect(eq.low);
+    preview.nextTime = Math.max(preview.nextTime, AC.currentTime + 0.05);
+    src.start(preview.nextTime);
+    preview.nextTime += audio.duration;
+    preview.sources.push(src);
+  }
 }
 
+btnPreview.addEventListener('click', async ()=>{
+  ensureAudioGraph();
+  await AC.resume();
+  if(preview.playing) return;
+  preview.playing = true;
+  btnPreview.disabled = true;
+  schedulePreview();
+});
+
 function setProgress(pct, text){
   progressBar.style.setProperty('--w', `${pct*100}%`);
   progress.querySelector('.bar').style.setProperty('--w', `${pct*100}%`);
@@ -204,6 +432,45 @@ function setProgress(pct, text){
   progressLabel.textContent = text;
 }
 
+// 即時評分：麥克風基頻每 50ms 送往後端，與預先算好的清唱音高比對
+function openScoreSocket(session){
+  if(scoreSocket) scoreSocket.close();
+  scoreEl.textContent = '即時評分：—';
+  const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+  const ws = new WebSocket(`${proto}://${location.host}/ws/score/${session}`);
+  ws.onmessage = e => {
+    const msg = JSON.parse(e.data);
+    if(msg.score !== undefined && msg.score !== null) scoreEl.textContent = `即時評分：${msg.score.toFixed(1)}`;
+  };
+  ws.onclose = () => { if(scoreSocket === ws) scoreSocket = null; };
+  scoreSocket = ws;
+}
+
+// 自相關法估計基頻（Hz）；音量太小或找不到週期時回傳 0
+function detectPitch(buf, sampleRate){
+  let rms = 0;
+  for(let i=0;i<buf.length;i++) rms += buf[i]*buf[i];
+  if(Math.sqrt(rms / buf.length) < 0.01) return 0;
+  const minLag = Math.floor(sampleRate / 1000), maxLag = Math.floor(sampleRate / 70);
+  let bestLag = 0, best = 0;
+  for(let lag=minLag; lag<=maxLag; lag++){
+    let sum = 0;
+    for(let i=0;i<buf.length-lag;i++) sum += buf[i]*buf[i+lag];
+    if(sum > best){ best = sum; bestLag = lag; }
+  }
+  return bestLag ? sampleRate / bestLag : 0;
+}
+
+function sendPitchFrame(){
+  if(!scoreSocket || scoreSocket.readyState !== WebSocket.OPEN || playerInst.paused) return;
+  const buf = new Float32Array(micAnalyser.fftSize);
+  micAnalyser.getFloatTimeDomainData(buf);
+  const f0 = detectPitch(buf, AC.sampleRate);
+  // 伴奏移調時，把人聲換算回原調再比對
+  const shift = Math.pow(2, parseInt(keyShift.value, 10) / 12);
+  scoreSocket.send(JSON.stringify({ t: playerInst.currentTime, f0: f0 / shift }));
+}
+
 // Mic / recording
 btnMic.addEventListener('click', async ()=>{
   ensureAudioGraph();
@@ -211,9 +478,14 @@ btnMic.addEventListener('click', async ()=>{
     micStream = await navigator.mediaDevices.getUserMedia({audio:true});
     micNode = AC.createMediaStreamSource(micStream);
     micNode.connect(eq.low);
+    micAnalyser = AC.createAnalyser();
+    micAnalyser.fftSize = 2048;
+    micNode.connect(micAnalyser);
+    pitchTimer = setInterval(sendPitchFrame, 50);
     btnMic.textContent = '關閉麥克風';
     btnRec.disabled = false;
   } else {
+    clearInterval(pitchTimer);
     micStream.getTracks().forEach(t=>t.stop());
     micStream = null;
     btnMic.textContent = '開啟麥克風';
@@ -225,13 +497,48 @@ btnRec.addEventListener('click', ()=>{
   if(mediaRecorder.state === 'inactive'){
     recChunks = [];
     mediaRecorder.start();
+    startTake();
     btnRec.textContent = '停止錄音';
   }else{
     mediaRecorder.stop();
+    if(takeRecorder && takeRecorder.state !== 'inactive') takeRecorder.stop();
     btnRec.textContent = '開始錄音';
   }
 });
 
+// 另外只錄麥克風（不含伴奏與效果），供後端對齊後混音
+function startTake(){
+  takeChunks = []; takeBlob = null;
+  btnMix.classList.add('hidden');
+  takeRecorder = new MediaRecorder(micStream);
+  takeRecorder.ondataavailable = e => { if (e.data.size) takeChunks.push(e.data); };
+  takeRecorder.onstop = () => {
+    takeBlob = new Blob(takeChunks, {type: 'audio/webm'});
+    if(currentSession) btnMix.classList.remove('hidden');
+  };
+  takeStart = playerInst.paused ? null : playerInst.currentTime;
+  takeRecorder.start();
+}
+
+btnMix.addEventListener('click', async ()=>{
+  if(!takeBlob || !currentSession) return;
+  btnMix.disabled = true;
+  dlMix.textContent = '混音中…';
+  try{
+    const form = new FormData();
+    form.append('file', takeBlob, 'take.webm');
+    const params = new URLSearchParams({ session: currentSession });
+    if(takeStart !== null) params.set('start', takeStart.toFixed(3));
+    const resp = await fetch(`/api/mixdown?${params}`, { method:'POST', body:form });
+    if(!resp.ok){ dlMix.textContent = '混音失敗 😢'; return; }
+    const { url } = await resp.json();
+    dlMix.href = url; dlMix.download = 'karaoke-mix' + fileExt(url);
+    dlMix.textContent = '下載混音';
+  } finally {
+    btnMix.disabled = false;
+  }
+});
+
 // LRC
 lrcInput.addEventListener('change', async e => {
   const f = e.target.files[0];
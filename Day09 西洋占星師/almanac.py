@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+年度月相曆：新月／滿月、日月食、月亮換座、月亮空亡、行星停滯（順逆轉換）。
+
+所有時間以求根取得（lunar / transits，精度 1 秒；日月食用 swe 的全球日月食搜尋），
+輸出為指定時區的當地時間，依時間排序。計算一年約需 1 秒，
+結果以 (年, 時區, ALMANAC_VERSION) 為鍵存入 SQLite，之後直接讀取。
+"""
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import pytz
+import swisseph as swe  # pyswisseph
+
+from chart import ZODIAC
+from lunar import lunations, moon_ingresses, void_of_course
+from transits import DEFAULT_BODIES, iso_to_jd, jd_to_iso, transit_events
+
+# 計算方式改變時調整，讓舊的快取失效
+ALMANAC_VERSION = 1
+# 會逆行的行星（不含日月）
+STATION_BODIES = [name for name in DEFAULT_BODIES if name != "太陽"]
+
+SOLAR_ECLIPSES = [(swe.ECL_ANNULAR_TOTAL, "全環食"), (swe.ECL_TOTAL, "全食"), (swe.ECL_ANNULAR, "環食"), (swe.ECL_PARTIAL, "偏食")]
+LUNAR_ECLIPSES = [(swe.ECL_TOTAL, "全食"), (swe.ECL_PARTIAL, "偏食"), (swe.ECL_PENUMBRAL, "半影月食")]
+
+def _sign(lon: float) -> str:
+    return ZODIAC[int(lon % 360.0 // 30)]["name"]
+
+def _kind(flags: int, kinds) -> str:
+    return next((name for bit, name in kinds if flags & bit), "")
+
+def eclipses(jd_start: float, jd_end: float) -> List[Dict]:
+    """區間內的日食與月食（食甚時刻）：{"jd", "body", "kind", "lon"}。"""
+    out = []
+    for body, when, kinds, pid in (("日食", swe.sol_eclipse_when_glob, SOLAR_ECLIPSES, swe.SUN),
+                                  ("月食", swe.lun_eclipse_when, LUNAR_ECLIPSES, swe.MOON)):
+        jd = jd_start
+        while True:
+            flags, tret = when(jd)
+            if tret[0] >= jd_end:
+                break
+            out.append({"jd": tret[0], "body": body, "kind": _kind(flags, kinds), "lon": swe.calc_ut(tret[0], pid)[0][0]})
+            jd = tret[0] + 1.0
+    out.sort(key=lambda e: e["jd"])
+    return out
+
+def year_bounds(year: int, tz: str):
+    """當地時間 year/1/1 00:00 到 year+1/1/1 00:00 的 UT Julian Day。"""
+    zone = pytz.timezone(tz)
+    bounds = []
+    for y in (year, year + 1):
+        ut = zone.localize(datetime(y, 1, 1)).astimezone(pytz.utc)
+        bounds.append(swe.julday(ut.year, ut.month, ut.day, ut.hour + ut.minute / 60.0 + ut.second / 3600.0, swe.GREG_CAL))
+    return bounds
+
+def build_calendar(year: int, tz: str) -> Dict[str, Any]:
+    jd_start, jd_end = year_bounds(year, tz)
+    zone = pytz.timezone(tz)
+
+    def local(jd: float) -> str:
+        return datetime.fromisoformat(jd_to_iso(jd)).astimezone(zone).isoformat()
+
+    events = []
+    for e in lunations(jd_start, jd_end):
+        events.append({"type": "lunation", "jd": e["jd"], "phase": e["phase"], "sign": _sign(e["lon"]),
+                       "degree": round(e["lon"] % 30.0, 2)})
+    for e in eclipses(jd_start, jd_end):
+        events.append({"type": "eclipse", "jd": e["jd"], "body": e["body"], "kind": e["kind"], "sign": _sign(e["lon"]),
+                       "degree": round(e["lon"] % 30.0, 2)})
+    for jd, sign in moon_ingresses(jd_start, jd_end):
+        events.append({"type": "moon_ingress", "jd": jd, "sign": ZODIAC[sign]["name"]})
+    for v in void_of_course(jd_start, jd_end):
+        last = v["last_aspect"]
+        events.append({"type": "void_of_course", "jd": v["start"], "end": local(v["end"]), "sign": v["sign"],
+                       "last_aspect": {"body": last["body"], "aspect": last["aspect"]} if last else None})
+    for e in transit_events({}, jd_start, jd_end, STATION_BODIES):
+        if e["type"] == "station":
+            events.append({"type": "station", "jd": iso_to_jd(datetime.fromisoformat(e["time"])), "body": e["body"],
+                           "direction": e["direction"], "sign": e["sign"], "degree": round(e["lon"] % 30.0, 2)})
+
+    events.sort(key=lambda e: e["jd"])
+    events = [{"type": e.pop("type"), "time": local(e.pop("jd")), **e} for e in events]
+    return {"year": year, "tz": tz, "count": len(events), "events": events}
+
+class CalendarCache:
+    def __init__(self, path: str):
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS almanac ("
+            " year INTEGER NOT NULL, tz TEXT NOT NULL, version INTEGER NOT NULL, data TEXT NOT NULL, created REAL NOT NULL,"
+            " PRIMARY KEY (year, tz, version))"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _get(self, year: int, tz: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM almanac WHERE year = ? AND tz = ? AND version = ?", (year, tz, ALMANAC_VERSION)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, year: int, tz: str) -> Dict[str, Any]:
+        """讀取快取；沒有時計算並寫入。"""
+        cached = self._get(year, tz)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        data = build_calendar(year, tz)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO almanac (year, tz, version, data, created) VALUES (?, ?, ?, ?, ?)",
+                (year, tz, ALMANAC_VERSION, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+            self._db.commit()
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM almanac").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
@@ -6,319 +6,140 @@ Backend: FastAPI + Swiss Ephemeris (pyswisseph)
 - 不向使用者索取 OpenAI Key，讀環境變數 OPENAI_API_KEY
 - 回傳每個宮位的行星清單，前端顯示且解讀會引用
 """
+import asyncio
+import json
+import math
+import multiprocessing
 import os
-from datetime import datetime
-from typing import Optional, List, Dict, Any, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 
-from fastapi import FastAPI, Request, HTTPException
+import anyio
+import pytz
+from fastapi import FastAPI, Request, HTTPException, Query
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
-import swisseph as swe  # pyswisseph
 from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
-import pytz
+from geopy.exc import GeopyError
+
+from almanac import CalendarCache
+from chart import ChartCache, calc_charts, localize
+from electional import search as electional_search, sign_index
+from gazetteer import Gazetteer
+from ephemeris import default_table
+from geocache import GeocodeCache
+from interpret_cache import InterpretationCache, fingerprint
+from synastry import synastry
+from transits import DEFAULT_BODIES, iso_to_jd, jd_to_iso, transit_events
 
 # Optional OpenAI support for interpretation (server-side env key only)
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    import httpx
     OPENAI_AVAILABLE = True
 except Exception:
     OPENAI_AVAILABLE = False
 
 # --- Configuration ---
-EPHE_PATH = os.environ.get("SE_EPHE_PATH", ".")
-swe.set_ephe_path(EPHE_PATH)
-
 # Web
 app = FastAPI(title="ASTRO//ARCANE", version="3.0")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 # Geocoding + Timezone
-geolocator = Nominatim(user_agent="astro_arcane_app")
-tfinder = TimezoneFinder()
-
-# ---- Utilities ----
-
-ZODIAC = [
-    {"name": "白羊座", "abbr": "Aries", "glyph": "♈", "element": "火"},
-    {"name": "金牛座", "abbr": "Taurus", "glyph": "♉", "element": "土"},
-    {"name": "雙子座", "abbr": "Gemini", "glyph": "♊", "element": "風"},
-    {"name": "巨蟹座", "abbr": "Cancer", "glyph": "♋", "element": "水"},
-    {"name": "獅子座", "abbr": "Leo", "glyph": "♌", "element": "火"},
-    {"name": "處女座", "abbr": "Virgo", "glyph": "♍", "element": "土"},
-    {"name": "天秤座", "abbr": "Libra", "glyph": "♎", "element": "風"},
-    {"name": "天蠍座", "abbr": "Scorpio", "glyph": "♏", "element": "水"},
-    {"name": "射手座", "abbr": "Sagittarius", "glyph": "♐", "element": "火"},
-    {"name": "摩羯座", "abbr": "Capricorn", "glyph": "♑", "element": "土"},
-    {"name": "水瓶座", "abbr": "Aquarius", "glyph": "♒", "element": "風"},
-    {"name": "雙魚座", "abbr": "Pisces", "glyph": "♓", "element": "水"},
-]
-
-HOUSE_MEANINGS = {
-    1: "自我、外在形象、開端、身體與氣場。",
-    2: "價值、財務、個人資源與自我價值感。",
-    3: "溝通、學習、鄰里、手足與短途旅行。",
-    4: "家庭、根源、私生活與內在安全感。",
-    5: "創造、戀愛、子女、表演與自我表達。",
-    6: "日常、服務、健康、工作流程與照顧。",
-    7: "伴侶、合作、對手與公開的關係。",
-    8: "共享資源、親密、轉化、危機與再生。",
-    9: "信念、遠行、高等教育、哲學與出版。",
-    10: "事業、名聲、社會角色與目標。",
-    11: "朋友、人脈、團體與未來願景。",
-    12: "潛意識、療癒、隱居、結束與放下。",
-}
-
-PLANETS = [
-    ("太陽", swe.SUN, "☉"),
-    ("月亮", swe.MOON, "☽"),
-    ("水星", swe.MERCURY, "☿"),
-    ("金星", swe.VENUS, "♀"),
-    ("火星", swe.MARS, "♂"),
-    ("木星", swe.JUPITER, "♃"),
-    ("土星", swe.SATURN, "♄"),
-    ("天王星", swe.URANUS, "♅"),
-    ("海王星", swe.NEPTUNE, "♆"),
-    ("冥王星", swe.PLUTO, "♇"),
-]
-
-ANGULAR = {1, 4, 7, 10}
-CADENT = {3, 6, 9, 12}
-SUCCEDENT = {2, 5, 8, 11}
-
-ASPECTS = [
-    ("合相", 0, 8),
-    ("六合", 60, 4),
-    ("四分相", 90, 6),
-    ("三分相", 120, 7),
-    ("對分相", 180, 8),
-]
-MAJOR_ASPECTS = {"合相", "三分相", "對分相"}
-
-def norm360(x: float) -> float:
-    x = x % 360.0
-    if x < 0:
-        x += 360.0
-    return x
-
-def angle_distance(a: float, b: float) -> float:
-    d = abs(norm360(a - b))
-    return min(d, 360 - d)
-
-def format_dms(deg: float) -> Dict[str, Any]:
-    total = deg % 360.0
-    sign_idx = int(total // 30)
-    within = total % 30
-    d = int(within)
-    m_float = (within - d) * 60
-    m = int(m_float)
-    s = int(round((m_float - m) * 60))
-    if s == 60:
-        s = 0; m += 1
-    if m == 60:
-        m = 0; d += 1
-    return {
-        "sign_index": sign_idx,
-        "sign_name": ZODIAC[sign_idx]["name"],
-        "sign_glyph": ZODIAC[sign_idx]["glyph"],
-        "deg": d,
-        "min": m,
-        "sec": s,
-        "text": f'{ZODIAC[sign_idx]["glyph"]}{d:02d}°{m:02d}′{s:02d}″ {ZODIAC[sign_idx]["name"]}',
-    }
-
-def arc_contains(angle: float, start: float, end: float) -> bool:
-    start = norm360(start); end = norm360(end); angle = norm360(angle)
-    span = (end - start) % 360.0
-    offset = (angle - start) % 360.0
-    return 0 <= offset < span if span != 0 else False
-
-def pick_house(lon: float, cusps: List[float]) -> int:
-    cusp_list = list(cusps)
-    if len(cusp_list) == 13:
-        cusp_list = cusp_list[1:13]
-    elif len(cusp_list) > 12:
-        cusp_list = cusp_list[:12]
-    for i in range(12):
-        start = cusp_list[i]
-        end = cusp_list[(i + 1) % 12]
-        if arc_contains(lon, start, end):
-            return i + 1
-    return 12
-
-def accidental_status(house: int, retrograde: bool, near_angle: bool) -> Dict[str, Any]:
-    status = {"flags": [], "score": 0}
-    if house in ANGULAR:
-        status["flags"].append("Angular（意外尊貴）"); status["score"] += 1
-    elif house in CADENT:
-        status["flags"].append("Cadent（意外失勢）"); status["score"] -= 1
-    else:
-        status["flags"].append("Succedent（中性）")
-    if retrograde:
-        status["flags"].append("逆行（減分）"); status["score"] -= 1
-    if near_angle:
-        status["flags"].append("臨近角度（略加分）"); status["score"] += 0.5
-    return status
-
-def near(a: float, b: float, orb: float=5.0) -> bool:
-    return angle_distance(a, b) <= orb
-
-def orb_for(aspect_name: str, p1: str, p2: str) -> float:
-    base = next(o for n, a, o in ASPECTS if n == aspect_name)
-    if p1 in ("太陽", "月亮") or p2 in ("太陽", "月亮"):
-        base += 2.0
-    return base
-
-def detect_aspects(positions: Dict[str, float]) -> List[Dict[str, Any]]:
-    items = []
-    names = list(positions.keys())
-    for i in range(len(names)):
-        for j in range(i + 1, len(names)):
-            n1, n2 = names[i], names[j]
-            a1, a2 = positions[n1], positions[n2]
-            delta = angle_distance(a1, a2)
-            for asp_name, asp_angle, _orb in ASPECTS:
-                diff = abs(delta - asp_angle)
-                if diff <= orb_for(asp_name, n1, n2):
-                    importance = "major" if asp_name in MAJOR_ASPECTS else "minor"
-                    strength = max(0.0, orb_for(asp_name, n1, n2) - diff)
-                    items.append({
-                        "pair": f"{n1}–{n2}",
-                        "type": asp_name,
-                        "exact": asp_angle,
-                        "delta": round(delta, 2),
-                        "off_exact": round(diff, 2),
-                        "importance": importance,
-                        "strength": round(strength, 2),
-                    })
-    items.sort(key=lambda x: (x["importance"] != "major", -x["strength"]))
-    return items
-
-def detect_grand_trines(positions: Dict[str, float]) -> List[Dict[str, Any]]:
-    keys = list(positions.keys())
-    out = []
-    for i in range(len(keys)):
-        for j in range(i+1, len(keys)):
-            for k in range(j+1, len(keys)):
-                a, b, c = positions[keys[i]], positions[keys[j]], positions[keys[k]]
-                def is_trine(x, y): return abs(angle_distance(x, y) - 120) <= 6
-                if is_trine(a, b) and is_trine(a, c) and is_trine(b, c):
-                    def element_for(lon):
-                        sign_idx = int((lon % 360) // 30)
-                        return ZODIAC[sign_idx]["element"]
-                    elems = [element_for(a), element_for(b), element_for(c)]
-                    elem = elems[0] if len(set(elems)) == 1 else "混合"
-                    out.append({"triplet": [keys[i], keys[j], keys[k]], "element": elem})
-    return out
-
-def calc_chart(dt_local: datetime, latitude: float, longitude: float) -> Dict[str, Any]:
-    # 時區自動推斷並轉 UT
-    tzname = tfinder.timezone_at(lng=longitude, lat=latitude)
-    if tzname is None:
-        raise HTTPException(status_code=400, detail="無法判斷時區，請手動提供較精確的出生地或經緯度。")
-    tz = pytz.timezone(tzname)
-    localized = tz.localize(dt_local)
-    dt_ut = localized.astimezone(pytz.utc)
-    ut_hour = dt_ut.hour + dt_ut.minute/60.0 + dt_ut.second/3600.0
-
-    # UT Julian Day
-    birth_julian_day = swe.julday(dt_ut.year, dt_ut.month, dt_ut.day, ut_hour, swe.GREG_CAL)
-
-    # 宮位（Placidus）— 正確使用 swe.houses
-    cusps, ascmc = swe.houses(birth_julian_day, latitude, longitude, b'P')
-
-    positions: Dict[str, float] = {}
-    details: Dict[str, Any] = {}
-    aspects_basis: Dict[str, float] = {}
-
-    # 上升點
-    asc_lon = float(ascmc[0])
-    positions["上升"] = asc_lon
-    asc_fmt = format_dms(asc_lon)
-
-    # 行星
-    for cname, pid, glyph in PLANETS:
-        # 正確使用 swe.calc_ut
-        result, ret = swe.calc_ut(birth_julian_day, pid)
-        lon, lat, dist = result[:3]
-        speed_long = result[3]
-        positions[cname] = lon
-        aspects_basis[cname] = lon
-
-        h = pick_house(lon, list(cusps))
-        d = format_dms(lon)
-        near_asc = near(lon, asc_lon, orb=5.0)
-        retro = speed_long < 0
-
-        details[cname] = {
-            "name": cname,
-            "glyph": glyph,
-            "lon": lon,
-            "lat": lat,
-            "dist": dist,
-            "sign": d,
-            "house": h,
-            "house_meaning": HOUSE_MEANINGS.get(h, ""),
-            "accidental": accidental_status(h, retro, near_asc),
-            "retrograde": retro,
-        }
-
-    # 上升當作偽天體列出（固定落 1 宮）
-    details["上升"] = {
-        "name": "上升",
-        "glyph": "ASC",
-        "lon": asc_lon,
-        "lat": None,
-        "dist": None,
-        "sign": asc_fmt,
-        "house": 1,
-        "house_meaning": HOUSE_MEANINGS.get(1, ""),
-        "accidental": {"flags": ["角度點"], "score": 1},
-        "retrograde": False,
-    }
-
-    # 相位（不含上升）
-    aspects = detect_aspects(aspects_basis)
-
-    # 大三角
-    grand_trines = detect_grand_trines(aspects_basis)
-
-    # 宮首整理 & 落宮清單
-    cusp_list = list(cusps)
-    if len(cusp_list) == 13:
-        cusp_list = cusp_list[1:13]
-    elif len(cusp_list) > 12:
-        cusp_list = cusp_list[:12]
-
-    house_data = []
-    occupants_map: Dict[int, List[str]] = {i: [] for i in range(1, 13)}
-    for pname in [p[0] for p in PLANETS]:
-        h = details[pname]["house"]
-        occupants_map[h].append(pname)
-
-    for i, cusp in enumerate(cusp_list, start=1):
-        house_data.append({
-            "house": i,
-            "cusp": cusp,
-            "cusp_text": format_dms(cusp)["text"],
-            "meaning": HOUSE_MEANINGS.get(i, ""),
-            "occupants": occupants_map[i],
-        })
-
-    return {
-        "utc": dt_ut.isoformat(),
-        "tz": tzname,
-        "positions": positions,
-        "details": details,
-        "aspects": aspects,
-        "grand_trines": grand_trines,
-        "houses": house_data,
-        "ascendant": {"lon": asc_lon, "sign": asc_fmt},
-    }
+geolocator = Nominatim(user_agent="astro_arcane_app", timeout=10)
+
+# 地理編碼快取（SQLite）；找不到的地名以較短的 TTL 快取
+GEOCODE_DB = os.environ.get("GEOCODE_DB", "geocode_cache.sqlite3")
+GEOCODE_TTL_DAYS = float(os.environ.get("GEOCODE_TTL_DAYS", "30"))
+GEOCODE_NEGATIVE_TTL_SEC = float(os.environ.get("GEOCODE_NEGATIVE_TTL_SEC", "3600"))
+
+def _nominatim(place: str, language: str):
+    loc = geolocator.geocode(place, language=language)
+    if loc is None:
+        return None
+    return float(loc.latitude), float(loc.longitude), loc.address
+
+geocache = GeocodeCache(
+    GEOCODE_DB, _nominatim,
+    ttl=GEOCODE_TTL_DAYS * 86400, negative_ttl=GEOCODE_NEGATIVE_TTL_SEC,
+)
+
+# 離線地名索引（GeoNames cities 檔）；檔案不存在時只用 Nominatim
+GAZETTEER_PATH = os.environ.get("GAZETTEER_PATH", "cities15000.txt")
+gazetteer = Gazetteer.load(GAZETTEER_PATH) if os.path.exists(GAZETTEER_PATH) else Gazetteer()
+
+# 星盤快取：最多筆數、經緯度四捨五入的小數位數（4 位約 11 公尺）
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", "4096"))
+CHART_CACHE_DECIMALS = int(os.environ.get("CHART_CACHE_DECIMALS", "4"))
+chart_cache = ChartCache(CHART_CACHE_SIZE, CHART_CACHE_DECIMALS)
+
+# AI 解讀快取：同樣的星盤重點直接重播已生成的解讀；修改提示詞或模型時調整 PROMPT_VERSION
+INTERPRET_MODEL = "gpt-4o"
+PROMPT_VERSION = "1"
+INTERPRET_CACHE_DB = os.environ.get("INTERPRET_CACHE_DB", "interpret_cache.sqlite3")
+# 重播節奏：每段字數、段與段之間的間隔（毫秒）
+INTERPRET_REPLAY_CHARS = int(os.environ.get("INTERPRET_REPLAY_CHARS", "12"))
+INTERPRET_REPLAY_INTERVAL_MS = float(os.environ.get("INTERPRET_REPLAY_INTERVAL_MS", "30"))
+interpret_cache = InterpretationCache(INTERPRET_CACHE_DB)
+
+# OpenAI：全域共用一個 AsyncOpenAI（連線池重用 TLS 連線），同時生成數以 semaphore 限制，
+# 其餘請求排隊，等超過 INTERPRET_QUEUE_TIMEOUT_SEC 秒改用模板解讀
+INTERPRET_MAX_CONCURRENCY = int(os.environ.get("INTERPRET_MAX_CONCURRENCY", "8"))
+INTERPRET_QUEUE_TIMEOUT_SEC = float(os.environ.get("INTERPRET_QUEUE_TIMEOUT_SEC", "30"))
+interpret_slots = asyncio.Semaphore(max(1, INTERPRET_MAX_CONCURRENCY))
+_openai_client: Optional["AsyncOpenAI"] = None
+
+def openai_client(api_key: str) -> "AsyncOpenAI":
+    # 第一次使用時建立；連線數與同時生成數一致
+    global _openai_client
+    if _openai_client is None:
+        size = max(1, INTERPRET_MAX_CONCURRENCY)
+        _openai_client = AsyncOpenAI(api_key=api_key, http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=60),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        ))
+    return _openai_client
+
+@app.on_event("shutdown")
+async def _close_openai_client():
+    if _openai_client is not None:
+        await _openai_client.close()
+
+# 行運時間軸最長年數
+TRANSIT_MAX_YEARS = float(os.environ.get("TRANSIT_MAX_YEARS", "5"))
+
+# 年度月相曆：依 (年, 時區) 存入 SQLite；可查詢的年份範圍
+CALENDAR_DB = os.environ.get("CALENDAR_DB", "calendar_cache.sqlite3")
+CALENDAR_MIN_YEAR = int(os.environ.get("CALENDAR_MIN_YEAR", "1800"))
+CALENDAR_MAX_YEAR = int(os.environ.get("CALENDAR_MAX_YEAR", "2200"))
+calendar_cache = CalendarCache(CALENDAR_DB)
+
+# 擇時搜尋最長天數
+ELECTIONAL_MAX_DAYS = float(os.environ.get("ELECTIONAL_MAX_DAYS", "366"))
+
+# 批次星盤：每批最多筆數、每個 worker 工作的筆數、worker 行程數
+BATCH_MAX_RECORDS = int(os.environ.get("BATCH_MAX_RECORDS", "2000"))
+BATCH_CHUNK = int(os.environ.get("BATCH_CHUNK", "50"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 2)))
+_batch_pool: Optional[ProcessPoolExecutor] = None
+
+def batch_pool() -> ProcessPoolExecutor:
+    # 第一次使用時才啟動 worker 行程
+    global _batch_pool
+    if _batch_pool is None:
+        _batch_pool = ProcessPoolExecutor(max_workers=max(1, BATCH_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+    return _batch_pool
+
+@app.on_event("shutdown")
+def _shutdown_batch_pool():
+    if _batch_pool is not None:
+        _batch_pool.shutdown(wait=False, cancel_futures=True)
 
 # ---- Models ----
 
@@ -328,6 +149,35 @@ class ChartRequest(BaseModel):
     latitude: Optional[float] = Field(None, description="緯度（可選）")
     longitude: Optional[float] = Field(None, description="經度（可選）")
 
+class BatchRecord(BaseModel):
+    id: Optional[Any] = Field(None, description="呼叫端自訂識別碼，原樣回傳")
+    datetime_local: str
+    place: Optional[str] = Field(None, description="地名（只查離線地名索引）")
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+class SynastryRequest(BaseModel):
+    a: ChartRequest
+    b: ChartRequest
+
+class TransitRequest(BaseModel):
+    chart: Dict[str, Any] = Field(..., description="/api/chart 回傳的本命盤（使用 positions）")
+    start: Optional[str] = Field(None, description="開始時間（UTC，ISO 格式；預設為現在）")
+    years: float = Field(1.0, gt=0, description="區間長度（年）")
+    include_moon: bool = Field(False, description="是否包含行運月亮")
+
+class ElectionalRequest(BaseModel):
+    place: Optional[str] = Field(None, description="地名（可選）")
+    latitude: Optional[float] = Field(None, description="緯度（可選）")
+    longitude: Optional[float] = Field(None, description="經度（可選）")
+    start: Optional[str] = Field(None, description="開始時間（當地時間，ISO 格式；預設為現在）")
+    days: float = Field(90.0, gt=0, description="搜尋天數")
+    asc_sign: Optional[str] = Field(None, description="上升星座，如 獅子座 / Leo（可選）")
+    benefic_in_10th: bool = Field(False, description="金星或木星在第 10 宮")
+    moon_not_void: bool = Field(True, description="月亮不在空亡")
+    no_hard_moon_aspects: bool = Field(True, description="月亮不與任何行星成四分相或對分相")
+    limit: int = Field(20, ge=1, le=200, description="回傳的時段數")
+
 class InterpretRequest(BaseModel):
     chart: Dict[str, Any]
 
@@ -337,58 +187,214 @@ class InterpretRequest(BaseModel):
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
-@app.post("/api/chart")
-async def api_chart(req: ChartRequest):
+async def _locate(place: Optional[str], lat: Optional[float], lon: Optional[float]) -> Tuple[float, float]:
+    """經緯度優先，其次離線地名索引，最後 Nominatim（有快取）。"""
+    if lat is not None and lon is not None:
+        return lat, lon
+    if not place:
+        raise HTTPException(status_code=400, detail="請提供出生地（地名）或經緯度。")
+    city = gazetteer.resolve(place)
+    if city is not None:
+        return city.lat, city.lon
+    try:
+        loc = await geocache.lookup(place, language="zh-TW")
+    except GeopyError:
+        raise HTTPException(status_code=503, detail="地理編碼服務暫時無法使用，請稍後再試或改用經緯度。")
+    if loc is None:
+        raise HTTPException(status_code=400, detail=f"無法找到地點：{place}，請改用經緯度或更精確的地名。")
+    return loc[0], loc[1]
+
+async def _chart_for(req: ChartRequest) -> Dict[str, Any]:
+    """出生資料 → 星盤。"""
     if not req.datetime_local:
         raise HTTPException(status_code=400, detail="缺少出生時間（需精確到分鐘）。")
 
-    lat, lon = req.latitude, req.longitude
-    if (lat is None or lon is None):
-        if not req.place:
-            raise HTTPException(status_code=400, detail="請提供出生地（地名）或經緯度。")
-        loc = geolocator.geocode(req.place, language="zh-TW")
-        if loc is None:
-            raise HTTPException(status_code=400, detail=f"無法找到地點：{req.place}，請改用經緯度或更精確的地名。")
-        lat, lon = float(loc.latitude), float(loc.longitude)
+    lat, lon = await _locate(req.place, req.latitude, req.longitude)
 
     try:
         dt_local = datetime.fromisoformat(req.datetime_local)
     except Exception:
         raise HTTPException(status_code=400, detail="時間格式需為 ISO，如 2000-01-01T08:15")
 
-    chart = calc_chart(dt_local, latitude=lat, longitude=lon)
+    return await asyncio.to_thread(chart_cache.get, dt_local, lat, lon)
+
+@app.post("/api/chart")
+async def api_chart(req: ChartRequest):
+    chart = await _chart_for(req)
     has_ai = bool(os.environ.get("OPENAI_API_KEY"))
     return JSONResponse({"ai_ready": has_ai, **chart})
 
-@app.post("/api/interpret/stream")
-async def api_interpret_stream(req: InterpretRequest):
-    """Streaming interpret endpoint (SSE-like)."""
-    openai_key = os.environ.get("OPENAI_API_KEY", "").strip()
-    chart = req.chart
+@app.post("/api/synastry")
+async def api_synastry(req: SynastryRequest):
+    """合盤：兩人星盤、交互相位矩陣、落入對方宮位與中點組合盤。"""
+    chart_a, chart_b = await asyncio.gather(_chart_for(req.a), _chart_for(req.b))
+    return {"a": chart_a, "b": chart_b, **synastry(chart_a, chart_b)}
 
-    def sse_yield(text_iter: Iterator[str]):
-        # Helpful headers to reduce buffering in some reverse proxies
-        yield "event: start\ndata: 解讀開始\n\n"
-        for chunk in text_iter:
-            # 每段 chunk 以 data: 行輸出，遵循 SSE 格式
-            yield f"data: {chunk}\n\n"
-        yield "event: done\ndata: [DONE]\n\n"
+def _parse_batch(body: bytes, content_type: str) -> List[Any]:
+    try:
+        if "ndjson" in content_type or "jsonl" in content_type:
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無法解析 JSON / NDJSON 內容。")
+    rows = data.get("records") if isinstance(data, dict) else data
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="請提供紀錄陣列，或 {\"records\": [...]}。")
+    return rows
+
+@app.post("/api/charts/batch")
+async def api_charts_batch(request: Request):
+    """
+    批次計算星盤。內容為 JSON 陣列（或 {"records": [...]}）或 NDJSON（Content-Type: application/x-ndjson），
+    每筆 {id?, datetime_local, latitude, longitude} 或以 place 查離線地名索引（批次不使用 Nominatim）。
+    以 NDJSON 串流回傳，每行 {"index", "id", "chart"} 或 {"index", "id", "error"}，依完成順序。
+    """
+    rows = _parse_batch(await request.body(), request.headers.get("content-type", ""))
+    if len(rows) > BATCH_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"單次最多 {BATCH_MAX_RECORDS} 筆。")
+
+    errors, jobs = [], []
+    for index, row in enumerate(rows):
+        rid = row.get("id") if isinstance(row, dict) else None
+        try:
+            rec = BatchRecord.model_validate(row)
+        except ValidationError as e:
+            errors.append({"index": index, "id": rid, "error": e.errors(include_url=False)[0]["msg"]})
+            continue
+        lat, lon = rec.latitude, rec.longitude
+        if lat is None or lon is None:
+            city = gazetteer.resolve(rec.place) if rec.place else None
+            if city is None:
+                errors.append({"index": index, "id": rid, "error": "請提供經緯度，或離線地名索引中的地名。"})
+                continue
+            lat, lon = city.lat, city.lon
+        jobs.append((index, rid, (rec.datetime_local, lat, lon)))
+
+    async def run_chunk(chunk):
+        global _batch_pool
+        loop = asyncio.get_running_loop()
+        pool = batch_pool()
+        try:
+            charts = await loop.run_in_executor(pool, calc_charts, [job[2] for job in chunk])
+        except BrokenProcessPool:
+            # worker 異常結束：下一次請求重建行程池
+            if _batch_pool is pool:
+                _batch_pool = None
+            charts = [{"error": "計算行程異常結束，請稍後重試。"}] * len(chunk)
+        except Exception as e:
+            charts = [{"error": f"計算失敗：{e}"}] * len(chunk)
+        return chunk, charts
 
-    # 沒有 openai 或 key → 流式輸出模板解讀
-    if not (openai_key and OPENAI_AVAILABLE):
-        def chunker(txt: str, n: int = 40) -> Iterator[str]:
-            for i in range(0, len(txt), n):
-                yield txt[i:i+n]
-        txt = fallback_interpretation(chart)
-        return StreamingResponse(
-            sse_yield(chunker(txt, 40)),
-            media_type="text/event-stream",
-            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
-        )
+    async def lines():
+        for err in errors:
+            yield json.dumps(err, ensure_ascii=False) + "\n"
+        tasks = [asyncio.ensure_future(run_chunk(jobs[i:i + BATCH_CHUNK])) for i in range(0, len(jobs), BATCH_CHUNK)]
+        try:
+            for done in asyncio.as_completed(tasks):
+                chunk, charts = await done
+                for (index, rid, _rec), chart in zip(chunk, charts):
+                    out = {"index": index, "id": rid, **({"error": chart["error"]} if "error" in chart else {"chart": chart})}
+                    yield json.dumps(out, ensure_ascii=False) + "\n"
+        finally:
+            # 用戶端中斷時取消尚未開始的區塊
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@app.post("/api/transits")
+async def api_transits(req: TransitRequest):
+    """行運時間軸：區間內行運行星對本命點的精確相位、換座與停滯。"""
+    natal = req.chart.get("positions")
+    if not isinstance(natal, dict) or not natal:
+        raise HTTPException(status_code=400, detail="本命盤缺少 positions，請傳入 /api/chart 的結果。")
+    try:
+        natal = {str(name): float(lon) for name, lon in natal.items()}
+    except (TypeError, ValueError):
+        natal = None
+    if natal is None or not all(math.isfinite(lon) for lon in natal.values()):
+        raise HTTPException(status_code=400, detail="positions 的黃經必須是數字。")
+    if req.years > TRANSIT_MAX_YEARS:
+        raise HTTPException(status_code=400, detail=f"區間最長 {TRANSIT_MAX_YEARS:g} 年。")
+    try:
+        start = datetime.fromisoformat(req.start) if req.start else datetime.now(timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式需為 ISO，如 2025-01-01 或 2025-01-01T00:00")
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    end = start + timedelta(days=365.25 * req.years)
+
+    bodies = ["月亮", *DEFAULT_BODIES] if req.include_moon else DEFAULT_BODIES
+    events = await asyncio.to_thread(transit_events, natal, iso_to_jd(start), iso_to_jd(end), bodies)
+    return {"start": start.isoformat(), "end": end.isoformat(), "count": len(events), "events": events}
+
+@app.post("/api/electional")
+async def api_electional(req: ElectionalRequest):
+    """擇時：區間內符合條件的時段，依評分排序（時間為當地時間）。"""
+    if req.days > ELECTIONAL_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"區間最長 {ELECTIONAL_MAX_DAYS:g} 天。")
+    asc_sign = None
+    if req.asc_sign:
+        asc_sign = sign_index(req.asc_sign)
+        if asc_sign is None:
+            raise HTTPException(status_code=400, detail=f"無法辨識的星座：{req.asc_sign}")
+    lat, lon = await _locate(req.place, req.latitude, req.longitude)
+    try:
+        start = datetime.fromisoformat(req.start) if req.start else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="時間格式需為 ISO，如 2025-01-01 或 2025-01-01T09:00")
+    # 未帶時區的時間視為當地時間
+    start = start or datetime.now(timezone.utc)
+    tzname, start_ut = localize(start.replace(tzinfo=None), lat, lon)
+    if start.tzinfo is not None:
+        start_ut = start.astimezone(timezone.utc)
+    jd_start = iso_to_jd(start_ut)
+
+    result = await asyncio.to_thread(
+        electional_search, lat, lon, jd_start, jd_start + req.days,
+        asc_sign=asc_sign, benefic_in_10th=req.benefic_in_10th, moon_not_void=req.moon_not_void,
+        no_hard_moon_aspects=req.no_hard_moon_aspects, tz=tzname, limit=req.limit,
+    )
+    return {"tz": tzname, "latitude": lat, "longitude": lon, "days": req.days, **result}
+
+@app.get("/api/calendar/{year}")
+async def api_calendar(year: int, tz: str = Query("Asia/Taipei", description="IANA 時區，如 Asia/Taipei")):
+    """年度月相曆：新月／滿月、日月食、月亮換座與空亡、行星停滯（時間為 tz 當地時間）。"""
+    if not CALENDAR_MIN_YEAR <= year <= CALENDAR_MAX_YEAR:
+        raise HTTPException(status_code=400, detail=f"年份需介於 {CALENDAR_MIN_YEAR}–{CALENDAR_MAX_YEAR}。")
+    if tz not in pytz.all_timezones_set:
+        raise HTTPException(status_code=400, detail=f"無法辨識的時區：{tz}")
+    return await asyncio.to_thread(calendar_cache.get, year, tz)
+
+@app.get("/api/places/suggest")
+def api_places_suggest(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(10, ge=1, le=50)):
+    """出生地自動完成（離線地名索引）；回傳經緯度與時區。"""
+    return {"query": q, "results": gazetteer.suggest(q, limit)}
+
+@app.get("/api/metrics")
+def api_metrics():
+    return {
+        "chart_cache": chart_cache.stats(),
+        "geocode_cache": geocache.stats(),
+        "interpret_cache": interpret_cache.stats(),
+        "calendar_cache": calendar_cache.stats(),
+        "gazetteer": {"places": len(gazetteer)},
+        "ephemeris_table": _ephemeris_stats(),
+    }
 
-    # 有 openai → 以 Chat Completions 串流
-    client = OpenAI(api_key=openai_key)
+def _ephemeris_stats() -> Optional[Dict[str, Any]]:
+    table = default_table()
+    if table is None:
+        return None
+    return {
+        "rows": table.rows,
+        "start": jd_to_iso(table.jd_start),
+        "end": jd_to_iso(table.jd_end),
+        "max_error_arcsec": max(table.max_error.values(), default=0.0),
+    }
 
+def build_prompt(chart: Dict[str, Any]) -> str:
+    """解讀提示詞；只取太陽/月亮/上升、落宮、主要相位與格局，也作為解讀快取的指紋。"""
     # 落宮摘要
     house_occupancy_lines = []
     for h in chart["houses"]:
@@ -400,23 +406,84 @@ async def api_interpret_stream(req: InterpretRequest):
     moon = chart["details"]["月亮"]["sign"]["text"]
     asc  = chart["details"]["上升"]["sign"]["text"]
     aspects_summary = "; ".join([f'{a["pair"]} {a["type"]}（偏差 {a["off_exact"]}°）' for a in chart["aspects"][:12]])
+    patterns_summary = "；".join(p["text"] for p in chart.get("patterns", [])) or "（無）"
 
-    prompt = f"""
+    return f"""
 你是一位專業占星解讀者。請根據以下出生星盤重點，撰寫約 400–600 字的中文性格與傾向分析，風格務實、避免宿命論：
 - 太陽：{sun}
 - 月亮：{moon}
 - 上升：{asc}
 - 落宮重點：{occupancy_text}
 - 主要相位（節選）：{aspects_summary}
+- 格局：{patterns_summary}
 
 接著說明「行星落入各宮」對生活領域可能帶來的影響（請以條列的方式簡述 4–7 點，對應上文的落宮）。
 最後給出具體可行的建議 3–5 條，聚焦學習、工作、人際與情緒管理。
 """
 
-    def openai_stream():
+def interpret_key(chart: Dict[str, Any]) -> str:
+    """
+    解讀快取鍵：只取星盤重點的離散欄位（不含度數與偏差），出生時間差幾分鐘的星盤可共用解讀。
+    太陽/月亮/上升的星座、各宮落入的天體、前 12 個相位的組合與種類、格局。
+    """
+    signs = [chart["details"][name]["sign"]["sign_name"] for name in ("太陽", "月亮", "上升")]
+    occupancy = [f'{h["house"]}:' + ",".join(sorted(h["occupants"])) for h in chart["houses"] if h["occupants"]]
+    aspects = sorted(f'{a["pair"]}:{a["type"]}' for a in chart["aspects"][:12])
+    patterns = sorted(p["text"] for p in chart.get("patterns", []))
+    return fingerprint(PROMPT_VERSION, INTERPRET_MODEL, *signs, "|".join(occupancy), "|".join(aspects), "|".join(patterns))
+
+@app.post("/api/interpret/stream")
+async def api_interpret_stream(req: InterpretRequest, request: Request):
+    """Streaming interpret endpoint (SSE-like)."""
+    openai_key = os.environ.get("OPENAI_API_KEY", "").strip()
+    chart = req.chart
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    async def sse_yield(text_iter: AsyncIterator[str]):
+        # Helpful headers to reduce buffering in some reverse proxies
+        yield "event: start\ndata: 解讀開始\n\n"
+        async for chunk in text_iter:
+            # 每段 chunk 以 data: 行輸出，遵循 SSE 格式
+            yield f"data: {chunk}\n\n"
+        yield "event: done\ndata: [DONE]\n\n"
+
+    async def chunker(txt: str, n: int = 40, interval: float = 0.0) -> AsyncIterator[str]:
+        for i in range(0, len(txt), n):
+            yield txt[i:i+n]
+            if interval:
+                await asyncio.sleep(interval)
+
+    # 快取命中 → 以固定節奏重播，前端看到的事件與即時生成相同
+    prompt = build_prompt(chart)
+    key = interpret_key(chart)
+    cached = await asyncio.to_thread(interpret_cache.get, key)
+    if cached is not None:
+        replay = chunker(cached, INTERPRET_REPLAY_CHARS, INTERPRET_REPLAY_INTERVAL_MS / 1000)
+        return StreamingResponse(sse_yield(replay), media_type="text/event-stream",
+                                 headers={**headers, "X-Interpretation-Cache": "hit"})
+
+    # 沒有 openai 或 key → 流式輸出模板解讀
+    if not (openai_key and OPENAI_AVAILABLE):
+        txt = fallback_interpretation(chart)
+        return StreamingResponse(
+            sse_yield(chunker(txt, 40)),
+            media_type="text/event-stream",
+            headers=headers
+        )
+
+    # 有 openai → 以 Chat Completions 串流
+    async def openai_stream():
         try:
-            stream = client.chat.completions.create(
-                model="gpt-4o",
+            await asyncio.wait_for(interpret_slots.acquire(), INTERPRET_QUEUE_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            async for seg in chunker("（AI 解讀忙碌中，改用模板簡述）\n" + fallback_interpretation(chart), 50):
+                yield seg
+            return
+
+        parts, complete, failed = [], False, False
+        try:
+            stream = await openai_client(openai_key).chat.completions.create(
+                model=INTERPRET_MODEL,
                 messages=[
                     {"role": "system", "content": "你是精通西洋占星的中文助理，提供務實且尊重自由意志的解讀。"},
                     {"role": "user", "content": prompt},
@@ -424,28 +491,45 @@ async def api_interpret_stream(req: InterpretRequest):
                 temperature=0.7,
                 stream=True,
             )
-            for chunk in stream:
-                try:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, "content") and delta.content:
-                        yield delta.content
-                except Exception:
-                    # 兼容不同 SDK 物件結構
-                    part = getattr(chunk, "choices", [{}])[0]
-                    delta = getattr(part, "delta", {})
-                    content = getattr(delta, "content", None) or ""
+            try:
+                async for chunk in stream:
+                    try:
+                        delta = chunk.choices[0].delta
+                        content = getattr(delta, "content", None) or ""
+                    except Exception:
+                        # 兼容不同 SDK 物件結構
+                        part = getattr(chunk, "choices", [{}])[0]
+                        delta = getattr(part, "delta", {})
+                        content = getattr(delta, "content", None) or ""
                     if content:
+                        # 用戶已離線 → 停止讀取，finally 會關閉上游連線、結束生成
+                        if await request.is_disconnected():
+                            return
+                        parts.append(content)
                         yield content
+                complete = True
+            finally:
+                # 用戶中斷時這裡可能處於取消狀態，關閉連線時需遮蔽取消
+                with anyio.CancelScope(shield=True):
+                    await stream.close()
         except Exception as e:
             # 如果 OpenAI 串流出錯，切成模板內容繼續輸出，避免前端中斷
+            failed = True
+        finally:
+            interpret_slots.release()
+
+        if failed:
             txt = "（AI 串流中斷，改用模板簡述）\n" + fallback_interpretation(chart)
-            for seg in (txt[i:i+50] for i in range(0, len(txt), 50)):
+            async for seg in chunker(txt, 50):
                 yield seg
+        # 只快取完整結束的串流
+        elif complete and parts:
+            await asyncio.to_thread(interpret_cache.put, key, "".join(parts))
 
     return StreamingResponse(
         sse_yield(openai_stream()),
         media_type="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        headers={**headers, "X-Interpretation-Cache": "miss"}
     )
 
 def fallback_interpretation(chart: Dict[str, Any]) -> str:
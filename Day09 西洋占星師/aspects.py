@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+向量化相位與格局偵測（NumPy）。
+
+所有天體的角距矩陣只計算一次，容許度以 broadcasting 一次套用到全部相位；
+格局（大三角、T 三角、上帝之指、星群）由相位鄰接矩陣組合而成。
+行星數 n 時相位為 O(n²·k)、三體格局為 O(n³) 的布林運算，沒有 Python 迴圈。
+"""
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+ASPECTS = [
+    ("合相", 0, 8),
+    ("六合", 60, 4),
+    ("四分相", 90, 6),
+    ("三分相", 120, 7),
+    ("對分相", 180, 8),
+]
+MAJOR_ASPECTS = {"合相", "三分相", "對分相"}
+# 太陽、月亮的相位容許度加寬
+LUMINARIES = ("太陽", "月亮")
+LUMINARY_BONUS = 2.0
+
+ASPECT_ANGLES = np.array([a for _n, a, _o in ASPECTS], dtype=float)
+ASPECT_ORBS = np.array([o for _n, _a, o in ASPECTS], dtype=float)
+
+# 格局使用固定容許度（不加寬日月）；150° 只用於上帝之指
+PATTERN_ORBS = {180: 8.0, 150: 3.0, 120: 6.0, 90: 6.0, 60: 4.0}
+STELLIUM_MIN = 3
+
+def separation_matrix(a: np.ndarray, b: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    黃經 a (n,) 與 b (m,) 兩兩之間的最短角距（0–180°），形狀 (n, m)；b 省略時為 a 自身。
+    前面可有批次維度：(N, n) 與 (N, m) 得到 (N, n, m)。
+    """
+    a = np.asarray(a, dtype=float)
+    b = a if b is None else np.asarray(b, dtype=float)
+    d = np.mod(a[..., :, None] - b[..., None, :], 360.0)
+    return np.minimum(d, 360.0 - d)
+
+def orb_matrix(names_a: Sequence[str], names_b: Optional[Sequence[str]] = None) -> np.ndarray:
+    """(n, m, 相位數) 的容許度；任一方為日月時加寬。"""
+    names_b = names_a if names_b is None else names_b
+    lum_a = np.isin(list(names_a), LUMINARIES)
+    lum_b = np.isin(list(names_b), LUMINARIES)
+    bonus = (lum_a[:, None] | lum_b[None, :]) * LUMINARY_BONUS
+    return ASPECT_ORBS[None, None, :] + bonus[:, :, None]
+
+def aspect_hits(delta: np.ndarray, orbs: np.ndarray, upper: bool = False):
+    """
+    回傳成立相位的 ([批次,] i, j, k, 偏差, 容許度)，依索引排序。upper=True 時只取 i < j。
+    delta 可為 (n, m) 或 (N, n, m)；orbs 為 (n, m, 相位數)。
+    """
+    diff = np.abs(delta[..., None] - ASPECT_ANGLES)
+    mask = diff <= orbs
+    if upper:
+        mask &= np.triu(np.ones(delta.shape[-2:], dtype=bool), k=1)[:, :, None]
+    idx = np.nonzero(mask)
+    return (*idx, diff[idx], np.broadcast_to(orbs, diff.shape)[idx])
+
+def _aspect_items(names_a, names_b, delta, hits) -> List[Dict]:
+    items = []
+    for i, j, k, diff, orb in zip(*hits):
+        name = ASPECTS[k][0]
+        items.append({
+            "pair": f"{names_a[i]}–{names_b[j]}",
+            "type": name,
+            "exact": ASPECTS[k][1],
+            "delta": round(float(delta[i, j]), 2),
+            "off_exact": round(float(diff), 2),
+            "importance": "major" if name in MAJOR_ASPECTS else "minor",
+            "strength": round(max(0.0, float(orb - diff)), 2),
+        })
+    items.sort(key=lambda x: (x["importance"] != "major", -x["strength"]))
+    return items
+
+def detect_aspects(positions: Dict[str, float]) -> List[Dict]:
+    names = list(positions.keys())
+    delta = separation_matrix(np.fromiter(positions.values(), float, len(names)))
+    return _aspect_items(names, names, delta, aspect_hits(delta, orb_matrix(names), upper=True))
+
+def detect_cross_aspects(positions_a: Dict[str, float], positions_b: Dict[str, float],
+                         labels: Sequence[str] = ("", "")) -> List[Dict]:
+    """兩組天體之間的全部相位（n × m，不限 i < j）；labels 為兩方名稱前綴，如 ("A", "B")。"""
+    names_a, names_b = list(positions_a.keys()), list(positions_b.keys())
+    delta = separation_matrix(np.fromiter(positions_a.values(), float, len(names_a)),
+                              np.fromiter(positions_b.values(), float, len(names_b)))
+    hits = aspect_hits(delta, orb_matrix(names_a, names_b))
+    return _aspect_items([labels[0] + n for n in names_a], [labels[1] + n for n in names_b], delta, hits)
+
+def detect_aspects_batch(names: Sequence[str], lons: np.ndarray) -> List[List[Dict]]:
+    """多張星盤（同一組天體）的相位；lons 形狀 (N, n)，回傳每張星盤與 detect_aspects 相同格式的清單。"""
+    delta = separation_matrix(lons)
+    r, *hits = aspect_hits(delta, orb_matrix(names), upper=True)
+    bounds = np.searchsorted(r, np.arange(len(delta) + 1))
+    return [
+        _aspect_items(names, names, delta[n], [h[bounds[n]:bounds[n + 1]] for h in hits])
+        for n in range(len(delta))
+    ]
+
+def adjacency(delta: np.ndarray, angle: float, orb: Optional[float] = None) -> np.ndarray:
+    """角距矩陣中形成某一角度（± 容許度）的布林鄰接矩陣；對角線為 False。"""
+    adj = np.abs(delta - angle) <= (PATTERN_ORBS[angle] if orb is None else orb)
+    np.fill_diagonal(adj, False)
+    return adj
+
+def _triples(adj_ij: np.ndarray, adj_ik: np.ndarray, adj_jk: np.ndarray, ordered: bool):
+    """cube[i, j, k] = adj_ij[i, j] & adj_ik[i, k] & adj_jk[j, k]；ordered 時限制 i < j < k，否則只限 i < j。"""
+    cube = adj_ij[:, :, None] & adj_ik[:, None, :] & adj_jk[None, :, :]
+    n = adj_ij.shape[0]
+    idx = np.arange(n)
+    keep = idx[:, None, None] < idx[None, :, None]
+    if ordered:
+        keep = keep & (idx[None, :, None] < idx[None, None, :])
+    return zip(*np.nonzero(cube & keep))
+
+def detect_grand_trines(positions: Dict[str, float], elements: Sequence[str]) -> List[Dict]:
+    """三顆天體兩兩三分相。elements 為 12 星座對應的元素。"""
+    names = list(positions.keys())
+    lons = np.fromiter(positions.values(), float, len(names))
+    trine = adjacency(separation_matrix(lons), 120)
+    out = []
+    for i, j, k in _triples(trine, trine, trine, ordered=True):
+        elems = {elements[int(lons[x] % 360 // 30)] for x in (i, j, k)}
+        out.append({"triplet": [names[i], names[j], names[k]], "element": elems.pop() if len(elems) == 1 else "混合"})
+    return out
+
+def detect_t_squares(positions: Dict[str, float]) -> List[Dict]:
+    """一組對分相，第三顆天體與兩端皆成四分相（頂點）。"""
+    names = list(positions.keys())
+    delta = separation_matrix(np.fromiter(positions.values(), float, len(names)))
+    opp, sq = adjacency(delta, 180), adjacency(delta, 90)
+    return [{"opposition": [names[i], names[j]], "apex": names[k]} for i, j, k in _triples(opp, sq, sq, ordered=False)]
+
+def detect_yods(positions: Dict[str, float]) -> List[Dict]:
+    """一組六合，第三顆天體與兩端皆成 150°（頂點）。"""
+    names = list(positions.keys())
+    delta = separation_matrix(np.fromiter(positions.values(), float, len(names)))
+    sextile, quincunx = adjacency(delta, 60), adjacency(delta, 150)
+    return [{"sextile": [names[i], names[j]], "apex": names[k]}
+            for i, j, k in _triples(sextile, quincunx, quincunx, ordered=False)]
+
+def detect_stelliums(positions: Dict[str, float], houses: Optional[Dict[str, int]] = None,
+                     minimum: int = STELLIUM_MIN) -> List[Dict]:
+    """同一星座（以及同一宮位，若提供 houses）中至少 minimum 顆天體。"""
+    names = np.array(list(positions.keys()), dtype=object)
+    groups = [("sign", np.fromiter(positions.values(), float, len(names)) % 360 // 30)]
+    if houses is not None:
+        groups.append(("house", np.array([houses[n] for n in names], dtype=float)))
+    out = []
+    for kind, labels in groups:
+        labels = labels.astype(int)
+        counts = np.bincount(labels, minlength=13)
+        for value in np.nonzero(counts >= minimum)[0]:
+            out.append({"kind": kind, "value": int(value), "bodies": names[labels == value].tolist()})
+    return out
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+星盤計算核心（Swiss Ephemeris）。
+
+與 Web 層分開，供 API 與批次計算的 worker 行程共用；每個行程只建立一個 TimezoneFinder。
+API 透過 ChartCache 取得星盤，重複的出生資料不再重算。
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+
+import numpy as np
+
+from fastapi import HTTPException
+import swisseph as swe  # pyswisseph
+from timezonefinder import TimezoneFinder
+import pytz
+
+from aspects import detect_aspects, detect_aspects_batch, detect_grand_trines, detect_stelliums, detect_t_squares, detect_yods
+
+EPHE_PATH = os.environ.get("SE_EPHE_PATH", ".")
+swe.set_ephe_path(EPHE_PATH)
+
+tfinder = TimezoneFinder()
+
+# 宮位制（swe.houses 的代碼），P = Placidus
+HOUSE_SYSTEM = "P"
+
+# ---- Utilities ----
+
+ZODIAC = [
+    {"name": "白羊座", "abbr": "Aries", "glyph": "♈", "element": "火"},
+    {"name": "金牛座", "abbr": "Taurus", "glyph": "♉", "element": "土"},
+    {"name": "雙子座", "abbr": "Gemini", "glyph": "♊", "element": "風"},
+    {"name": "巨蟹座", "abbr": "Cancer", "glyph": "♋", "element": "水"},
+    {"name": "獅子座", "abbr": "Leo", "glyph": "♌", "element": "火"},
+    {"name": "處女座", "abbr": "Virgo", "glyph": "♍", "element": "土"},
+    {"name": "天秤座", "abbr": "Libra", "glyph": "♎", "element": "風"},
+    {"name": "天蠍座", "abbr": "Scorpio", "glyph": "♏", "element": "水"},
+    {"name": "射手座", "abbr": "Sagittarius", "glyph": "♐", "element": "火"},
+    {"name": "摩羯座", "abbr": "Capricorn", "glyph": "♑", "element": "土"},
+    {"name": "水瓶座", "abbr": "Aquarius", "glyph": "♒", "element": "風"},
+    {"name": "雙魚座", "abbr": "Pisces", "glyph": "♓", "element": "水"},
+]
+
+HOUSE_MEANINGS = {
+    1: "自我、外在形象、開端、身體與氣場。",
+    2: "價值、財務、個人資源與自我價值感。",
+    3: "溝通、學習、鄰里、手足與短途旅行。",
+    4: "家庭、根源、私生活與內在安全感。",
+    5: "創造、戀愛、子女、表演與自我表達。",
+    6: "日常、服務、健康、工作流程與照顧。",
+    7: "伴侶、合作、對手與公開的關係。",
+    8: "共享資源、親密、轉化、危機與再生。",
+    9: "信念、遠行、高等教育、哲學與出版。",
+    10: "事業、名聲、社會角色與目標。",
+    11: "朋友、人脈、團體與未來願景。",
+    12: "潛意識、療癒、隱居、結束與放下。",
+}
+
+PLANETS = [
+    ("太陽", swe.SUN, "☉"),
+    ("月亮", swe.MOON, "☽"),
+    ("水星", swe.MERCURY, "☿"),
+    ("金星", swe.VENUS, "♀"),
+    ("火星", swe.MARS, "♂"),
+    ("木星", swe.JUPITER, "♃"),
+    ("土星", swe.SATURN, "♄"),
+    ("天王星", swe.URANUS, "♅"),
+    ("海王星", swe.NEPTUNE, "♆"),
+    ("冥王星", swe.PLUTO, "♇"),
+]
+
+ANGULAR = {1, 4, 7, 10}
+CADENT = {3, 6, 9, 12}
+SUCCEDENT = {2, 5, 8, 11}
+
+def norm360(x: float) -> float:
+    x = x % 360.0
+    if x < 0:
+        x += 360.0
+    return x
+
+def angle_distance(a: float, b: float) -> float:
+    d = abs(norm360(a - b))
+    return min(d, 360 - d)
+
+def format_dms(deg: float) -> Dict[str, Any]:
+    total = deg % 360.0
+    sign_idx = int(total // 30)
+    within = total % 30
+    d = int(within)
+    m_float = (within - d) * 60
+    m = int(m_float)
+    s = int(round((m_float - m) * 60))
+    if s == 60:
+        s = 0; m += 1
+    if m == 60:
+        m = 0; d += 1
+    return {
+        "sign_index": sign_idx,
+        "sign_name": ZODIAC[sign_idx]["name"],
+        "sign_glyph": ZODIAC[sign_idx]["glyph"],
+        "deg": d,
+        "min": m,
+        "sec": s,
+        "text": f'{ZODIAC[sign_idx]["glyph"]}{d:02d}°{m:02d}′{s:02d}″ {ZODIAC[sign_idx]["name"]}',
+    }
+
+def arc_contains(angle: float, start: float, end: float) -> bool:
+    start = norm360(start); end = norm360(end); angle = norm360(angle)
+    span = (end - start) % 360.0
+    offset = (angle - start) % 360.0
+    return 0 <= offset < span if span != 0 else False
+
+def _twelve_cusps(cusps: Sequence[float]) -> List[float]:
+    cusp_list = list(cusps)
+    if len(cusp_list) == 13:
+        cusp_list = cusp_list[1:13]
+    elif len(cusp_list) > 12:
+        cusp_list = cusp_list[:12]
+    return cusp_list
+
+def cusp_offsets(cusps: Sequence[float]) -> Tuple[float, np.ndarray]:
+    """以第 1 宮宮首為 0° 的各宮首偏移（遞增排序），供二分搜尋落宮。"""
+    cusp_list = _twelve_cusps(cusps)
+    return cusp_list[0], np.mod(np.asarray(cusp_list, dtype=float) - cusp_list[0], 360.0)
+
+def houses_for(lons, cusps: Sequence[float]) -> np.ndarray:
+    """多個黃經一次求落宮（1–12）：相對第 1 宮首的偏移在排序後的宮首偏移中二分搜尋。"""
+    start, offsets = cusp_offsets(cusps)
+    pos = np.mod(np.asarray(lons, dtype=float) - start, 360.0)
+    return np.searchsorted(offsets, pos, side="right")
+
+def pick_house(lon: float, cusps: List[float]) -> int:
+    return int(houses_for(lon, cusps))
+
+def accidental_status(house: int, retrograde: bool, near_angle: bool) -> Dict[str, Any]:
+    status = {"flags": [], "score": 0}
+    if house in ANGULAR:
+        status["flags"].append("Angular（意外尊貴）"); status["score"] += 1
+    elif house in CADENT:
+        status["flags"].append("Cadent（意外失勢）"); status["score"] -= 1
+    else:
+        status["flags"].append("Succedent（中性）")
+    if retrograde:
+        status["flags"].append("逆行（減分）"); status["score"] -= 1
+    if near_angle:
+        status["flags"].append("臨近角度（略加分）"); status["score"] += 0.5
+    return status
+
+def near(a: float, b: float, orb: float=5.0) -> bool:
+    return angle_distance(a, b) <= orb
+
+def describe_patterns(positions: Dict[str, float], houses: Dict[str, int]) -> List[Dict[str, Any]]:
+    out = []
+    for t in detect_t_squares(positions):
+        out.append({"type": "T三角", "bodies": t["opposition"] + [t["apex"]], "apex": t["apex"],
+                    "text": f'T三角：{"、".join(t["opposition"])} 對分，頂點 {t["apex"]}'})
+    for y in detect_yods(positions):
+        out.append({"type": "上帝之指", "bodies": y["sextile"] + [y["apex"]], "apex": y["apex"],
+                    "text": f'上帝之指：{"、".join(y["sextile"])} 六合，頂點 {y["apex"]}'})
+    for st in detect_stelliums(positions, houses):
+        where = ZODIAC[st["value"]]["name"] if st["kind"] == "sign" else f'第{st["value"]}宮'
+        out.append({"type": "星群", "bodies": st["bodies"], "apex": None,
+                    "text": f'星群（{where}）：{"、".join(st["bodies"])}'})
+    return out
+
+def localize(dt_local: datetime, latitude: float, longitude: float) -> Tuple[str, datetime]:
+    """時區自動推斷並轉 UT；回傳 (時區名稱, UTC datetime)。"""
+    tzname = tfinder.timezone_at(lng=longitude, lat=latitude)
+    if tzname is None:
+        raise HTTPException(status_code=400, detail="無法判斷時區，請手動提供較精確的出生地或經緯度。")
+    tz = pytz.timezone(tzname)
+    localized = tz.localize(dt_local)
+    return tzname, localized.astimezone(pytz.utc)
+
+def julian_day(dt_ut: datetime) -> float:
+    # UT Julian Day
+    ut_hour = dt_ut.hour + dt_ut.minute/60.0 + dt_ut.second/3600.0
+    return swe.julday(dt_ut.year, dt_ut.month, dt_ut.day, ut_hour, swe.GREG_CAL)
+
+def calc_chart(dt_local: datetime, latitude: float, longitude: float, house_system: str = HOUSE_SYSTEM) -> Dict[str, Any]:
+    tzname, dt_ut = localize(dt_local, latitude, longitude)
+    return _compute(tzname, dt_ut, latitude, longitude, house_system)
+
+def _compute(tzname: str, dt_ut: datetime, latitude: float, longitude: float, house_system: str) -> Dict[str, Any]:
+    birth_julian_day = julian_day(dt_ut)
+    # 正確使用 swe.calc_ut
+    bodies = [swe.calc_ut(birth_julian_day, pid)[0] for _cname, pid, _glyph in PLANETS]
+    return build_chart(tzname, dt_ut, birth_julian_day, latitude, longitude, bodies, house_system=house_system)
+
+class ChartCache:
+    """
+    星盤結果的 LRU，鍵為 (UTC 時間, 四捨五入後的緯經度, 宮位制)。
+
+    命中時不呼叫 Swiss Ephemeris；未命中時以四捨五入後的經緯度計算，
+    確保同一個鍵永遠對應同一份結果。回傳的 dict 為共用物件，呼叫端不可修改。
+    """
+
+    def __init__(self, max_items: int = 4096, decimals: int = 4):
+        self.max_items = max_items
+        self.decimals = decimals
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dt_local: datetime, latitude: float, longitude: float, house_system: str = HOUSE_SYSTEM) -> Dict[str, Any]:
+        latitude, longitude = round(latitude, self.decimals), round(longitude, self.decimals)
+        tzname, dt_ut = localize(dt_local, latitude, longitude)
+        # 表單輸入精確到分鐘；有秒數時一併納入鍵（上升點每分鐘約移動 15′）
+        key = (dt_ut.replace(microsecond=0).isoformat(), latitude, longitude, house_system)
+        with self._lock:
+            chart = self._items.get(key)
+            if chart is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return chart
+            self.misses += 1
+        chart = _compute(tzname, dt_ut.replace(microsecond=0), latitude, longitude, house_system)
+        with self._lock:
+            self._items[key] = chart
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return chart
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+def build_chart(tzname: str, dt_ut: datetime, birth_julian_day: float, latitude: float, longitude: float,
+                bodies: List[tuple], aspects: Optional[List[Dict[str, Any]]] = None,
+                house_system: str = HOUSE_SYSTEM) -> Dict[str, Any]:
+    """由 PLANETS 順序的 swe.calc_ut 結果組成星盤；aspects 已由批次計算提供時不再重算。"""
+    # 宮位（預設 Placidus）— 正確使用 swe.houses
+    cusps, ascmc = swe.houses(birth_julian_day, latitude, longitude, house_system.encode())
+
+    positions: Dict[str, float] = {}
+    details: Dict[str, Any] = {}
+    aspects_basis: Dict[str, float] = {}
+
+    # 上升點
+    asc_lon = float(ascmc[0])
+    positions["上升"] = asc_lon
+    asc_fmt = format_dms(asc_lon)
+
+    # 行星
+    for (cname, pid, glyph), result in zip(PLANETS, bodies):
+        lon, lat, dist = result[:3]
+        speed_long = result[3]
+        positions[cname] = lon
+        aspects_basis[cname] = lon
+
+        h = pick_house(lon, list(cusps))
+        d = format_dms(lon)
+        near_asc = near(lon, asc_lon, orb=5.0)
+        retro = speed_long < 0
+
+        details[cname] = {
+            "name": cname,
+            "glyph": glyph,
+            "lon": lon,
+            "lat": lat,
+            "dist": dist,
+            "sign": d,
+            "house": h,
+            "house_meaning": HOUSE_MEANINGS.get(h, ""),
+            "accidental": accidental_status(h, retro, near_asc),
+            "retrograde": retro,
+        }
+
+    # 上升當作偽天體列出（固定落 1 宮）
+    details["上升"] = {
+        "name": "上升",
+        "glyph": "ASC",
+        "lon": asc_lon,
+        "lat": None,
+        "dist": None,
+        "sign": asc_fmt,
+        "house": 1,
+        "house_meaning": HOUSE_MEANINGS.get(1, ""),
+        "accidental": {"flags": ["角度點"], "score": 1},
+        "retrograde": False,
+    }
+
+    # 相位（不含上升）
+    if aspects is None:
+        aspects = detect_aspects(aspects_basis)
+
+    # 格局：大三角、T 三角、上帝之指、星群
+    grand_trines = detect_grand_trines(aspects_basis, [z["element"] for z in ZODIAC])
+    patterns = describe_patterns(aspects_basis, {n: details[n]["house"] for n in aspects_basis})
+
+    # 宮首整理 & 落宮清單
+    cusp_list = list(cusps)
+    if len(cusp_list) == 13:
+        cusp_list = cusp_list[1:13]
+    elif len(cusp_list) > 12:
+        cusp_list = cusp_list[:12]
+
+    house_data = []
+    occupants_map: Dict[int, List[str]] = {i: [] for i in range(1, 13)}
+    for pname in [p[0] for p in PLANETS]:
+        h = details[pname]["house"]
+        occupants_map[h].append(pname)
+
+    for i, cusp in enumerate(cusp_list, start=1):
+        house_data.append({
+            "house": i,
+            "cusp": cusp,
+            "cusp_text": format_dms(cusp)["text"],
+            "meaning": HOUSE_MEANINGS.get(i, ""),
+            "occupants": occupants_map[i],
+        })
+
+    return {
+        "utc": dt_ut.isoformat(),
+        "tz": tzname,
+        "positions": positions,
+        "details": details,
+        "aspects": aspects,
+        "grand_trines": grand_trines,
+        "patterns": patterns,
+        "houses": house_data,
+        "ascendant": {"lon": asc_lon, "sign": asc_fmt},
+    }
+
+def calc_charts(records: Sequence[Tuple[str, float, float]]) -> List[Dict[str, Any]]:
+    """
+    批次計算（在 worker 行程內執行）。records 為 (本地時間 ISO, 緯度, 經度)。
+
+    相位以 (筆數, 天體, 天體) 的矩陣一次算完。
+    回傳與 records 同順序；失敗的筆數（時間格式、經緯度、星曆範圍、宮位）為 {"error": 訊息}，不影響同批其他筆。
+    """
+    results: List[Dict[str, Any]] = [{} for _ in records]
+    prepared, rows = [], []
+    for idx, (dt_iso, latitude, longitude) in enumerate(records):
+        try:
+            dt_local = datetime.fromisoformat(dt_iso)
+        except (TypeError, ValueError):
+            results[idx] = {"error": "時間格式需為 ISO，如 2000-01-01T08:15"}
+            continue
+        try:
+            tzname, dt_ut = localize(dt_local, latitude, longitude)
+            jd = julian_day(dt_ut)
+            # 星曆範圍外的日期只讓這一筆失敗
+            rows.append([swe.calc_ut(jd, pid)[0] for _cname, pid, _glyph in PLANETS])
+            prepared.append((idx, latitude, longitude, tzname, dt_ut, jd))
+        except HTTPException as e:
+            results[idx] = {"error": e.detail}
+        except (swe.Error, OverflowError, ValueError) as e:  # 經緯度或日期超出範圍
+            results[idx] = {"error": str(e)}
+
+    lons = np.array([[res[0] for res in bodies] for bodies in rows]).reshape(len(rows), len(PLANETS))
+    aspects = detect_aspects_batch([p[0] for p in PLANETS], lons)
+    for bodies, asp, (idx, latitude, longitude, tzname, dt_ut, jd) in zip(rows, aspects, prepared):
+        try:
+            results[idx] = build_chart(tzname, dt_ut, jd, latitude, longitude, bodies, asp)
+        except (swe.Error, OverflowError, ValueError) as e:  # 宮位計算失敗（如極區）
+            results[idx] = {"error": str(e)}
+    return results
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+擇時搜尋：在時間區間內找出符合條件的時段（月亮非空亡、上升星座、吉星在第 10 宮、月亮無刑沖）。
+
+1. 粗網格（每 COARSE_MINUTES 分鐘）一次取得各行星黃經（依 GRID_DAYS 取樣後插值）；宮首只依 ARMC（恆星時 + 經度）而定，
+   事先以 ARMC_STEP 間距建好 ARMC → 上升／天頂／第 11 宮首的表，任何時刻都以插值取得
+2. 逐格剪枝，只淘汰「整格必定不成立」的格子：
+   - 月亮與行星的相對黃經單調遞增，兩端落在同一個刑沖容許範圍內 → 整格都在範圍內
+   - 上升、天頂與宮首隨時間單調前進，格內掃過的弧段碰不到目標星座或吉星 → 整格不成立
+   - 整格落在空亡區間（lunar.void_of_course 的精確時間）內
+3. 存活的格子以每 FINE_MINUTES 分鐘的細網格逐點判斷（行星黃經同樣以插值取得），
+   連續成立的點合併為時段，依評分與長度排序
+
+評分（0–1）為三項平均：月亮距最近刑沖容許度的餘裕（滿 10° 為 1）、
+吉星距天頂的角距（合天頂為 1，30° 為 0）、月亮是否漸盈。
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytz
+import swisseph as swe  # pyswisseph
+
+from aspects import ASPECTS, LUMINARY_BONUS
+from chart import HOUSE_SYSTEM, PLANETS, ZODIAC, _twelve_cusps, angle_distance
+from ephemeris import EphemerisTable
+from lunar import void_of_course
+from transits import GRID_DAYS, _aspect_targets, _grid, _wrap180, jd_to_iso, sample_grid
+
+COARSE_MINUTES = 60
+FINE_MINUTES = 1
+ARMC_STEP = 0.25
+SIDEREAL_RATE = 360.98564736629  # ARMC 每日增加的度數
+BENEFICS = ("金星", "木星")
+HARD_ASPECTS = ("四分相", "對分相")
+# 吉星一小時內移動不超過此角度（°），剪枝時的安全餘裕
+BENEFIC_MARGIN = 0.1
+
+def _unwrap(deg: np.ndarray) -> np.ndarray:
+    return np.rad2deg(np.unwrap(np.deg2rad(deg)))
+
+def _arc_len(start, end):
+    """由 start 順行到 end 的弧長（0–360°）。"""
+    return np.mod(np.asarray(end) - start, 360.0)
+
+class HouseTable:
+    """某一緯度的 ARMC → (上升, 天頂, 第 11 宮首) 查表；三者對 ARMC 都是連續遞增的。"""
+
+    def __init__(self, latitude: float, obliquity: float, house_system: str = HOUSE_SYSTEM):
+        self.armc = np.arange(0.0, 360.0 + ARMC_STEP, ARMC_STEP)
+        rows = []
+        for a in self.armc:
+            cusps, ascmc = swe.houses_armc(a % 360.0, latitude, obliquity, house_system.encode())
+            rows.append((ascmc[0], ascmc[1], _twelve_cusps(cusps)[10]))
+        self._cols = [_unwrap(np.array(col)) for col in zip(*rows)]
+
+    def lookup(self, armc: np.ndarray):
+        a = np.mod(armc, 360.0)
+        return tuple(np.interp(a, self.armc, col) % 360.0 for col in self._cols)
+
+def _positions(jds: np.ndarray, pid: int, step: float) -> np.ndarray:
+    """每 step 天取樣一次 (黃經, 速度)，再以三次 Hermite 插值到 jds；慢行星只需很疏的取樣。"""
+    nodes = _grid(jds[0], jds[-1], step)
+    lon, speed = sample_grid(nodes, pid)
+    table = EphemerisTable(np.stack([lon, speed], axis=1)[:, None, :], nodes[0], nodes[1] - nodes[0], [pid])
+    return table.interpolate(jds, pid)[0]
+
+def _hard_targets() -> List[Tuple[float, float]]:
+    """刑沖的目標相對黃經（±90°、180°）與對應容許度（月亮為日月，加寬）。"""
+    orbs = {name: orb for name, _angle, orb in ASPECTS}
+    return [(target, orbs[name] + LUMINARY_BONUS) for name, _angle, target in _aspect_targets() if name in HARD_ASPECTS]
+
+def search(latitude: float, longitude: float, jd_start: float, jd_end: float,
+           asc_sign: Optional[int] = None, benefic_in_10th: bool = False,
+           moon_not_void: bool = True, no_hard_moon_aspects: bool = True,
+           tz: str = "UTC", limit: int = 20) -> Dict[str, Any]:
+    """
+    回傳 {"windows": [...], "stats": {...}}；windows 依評分、長度排序，時間為 tz 當地時間。
+    asc_sign 為星座索引（0 = 白羊座）。
+    """
+    names = [name for name, _pid, _glyph in PLANETS]
+    moon_i, sun_i = names.index("月亮"), names.index("太陽")
+    others = [i for i in range(len(names)) if i != moon_i]
+    benefic_idx = [names.index(b) for b in BENEFICS]
+    targets = _hard_targets()
+    target_angles = np.array([t for t, _orb in targets])
+    target_orbs = np.array([orb for _t, orb in targets])
+
+    obliquity = swe.calc_ut((jd_start + jd_end) / 2, swe.ECL_NUT)[0][0]
+    houses = HouseTable(latitude, obliquity)
+    armc0 = swe.sidtime(jd_start) * 15.0 + longitude
+
+    # 1. 粗網格
+    jds = _grid(jd_start, jd_end, COARSE_MINUTES / 1440.0)
+    lons = np.column_stack([_unwrap(_positions(jds, pid, GRID_DAYS[name])) for name, pid, _glyph in PLANETS])
+    voc = void_of_course(jd_start, jd_end) if moon_not_void else []
+    voc_start = np.array([v["start"] for v in voc])
+    voc_end = np.array([v["end"] for v in voc])
+
+    def evaluate(t: np.ndarray, lon: np.ndarray):
+        """各時刻的 (是否成立, 刑沖偏差, 上升, 天頂, 第 11 宮首)。"""
+        asc, mc, c11 = houses.lookup(armc0 + SIDEREAL_RATE * (t - jd_start))
+        rel = lon[:, moon_i, None] - lon[:, others]
+        dev = np.abs(_wrap180(rel[:, :, None] - target_angles)) - target_orbs
+        ok = np.ones(len(t), dtype=bool)
+        if no_hard_moon_aspects:
+            ok &= (dev > 0).all(axis=(1, 2))
+        if asc_sign is not None:
+            ok &= (asc // 30).astype(int) == asc_sign
+        if benefic_in_10th:
+            span = _arc_len(mc, c11)
+            ok &= (_arc_len(mc[:, None], lon[:, benefic_idx] % 360.0) < span[:, None]).any(axis=1)
+        if len(voc):
+            i = np.searchsorted(voc_start, t, side="right") - 1
+            ok &= ~((i >= 0) & (t < voc_end[np.maximum(i, 0)]))
+        return ok, dev, asc, mc, c11
+
+    # 2. 剪枝
+    _ok, dev, asc, mc, c11 = evaluate(jds, lons)
+    keep = np.ones(len(jds) - 1, dtype=bool)
+    if no_hard_moon_aspects:
+        bad = dev <= 0
+        keep &= ~(bad[:-1] & bad[1:]).any(axis=(1, 2))
+    if asc_sign is not None:
+        sign_start = asc_sign * 30.0
+        keep &= (_arc_len(sign_start, asc[:-1]) < 30.0) | (_arc_len(asc[:-1], sign_start) <= _arc_len(asc[:-1], asc[1:]))
+    if benefic_in_10th:
+        sweep = _arc_len(mc[:-1], c11[1:]) + BENEFIC_MARGIN
+        reach = _arc_len(mc[:-1, None] - BENEFIC_MARGIN, lons[:-1, benefic_idx] % 360.0)
+        keep &= (reach <= sweep[:, None]).any(axis=1)
+    if len(voc):
+        i = np.searchsorted(voc_start, jds[:-1], side="right") - 1
+        keep &= ~((i >= 0) & (jds[1:] <= voc_end[np.maximum(i, 0)]))
+    cells = np.nonzero(keep)[0]
+
+    # 3. 細網格
+    per_cell = max(1, int(round(COARSE_MINUTES / FINE_MINUTES)))
+    step = (jds[1] - jds[0]) / per_cell if len(jds) > 1 else FINE_MINUTES / 1440.0
+    t = (jds[cells][:, None] + step * np.arange(per_cell)[None, :]).ravel()
+    fine = np.column_stack([np.interp(t, jds, lons[:, b]) for b in range(len(names))])
+    ok, dev, asc, mc, c11 = evaluate(t, fine)
+
+    windows = []
+    idx = np.nonzero(ok)[0]
+    if len(idx):
+        # 評分
+        margin = np.clip(dev.min(axis=(1, 2)) / 10.0, 0.0, 1.0)
+        near_mc = np.abs(_wrap180(fine[:, benefic_idx] - mc[:, None])).min(axis=1)
+        mc_score = np.clip(1.0 - near_mc / 30.0, 0.0, 1.0)
+        waxing = (_arc_len(fine[:, sun_i], fine[:, moon_i]) < 180.0).astype(float)
+        score = (margin + mc_score + waxing) / 3.0
+
+        breaks = np.nonzero(np.diff(t[idx]) > step * 1.5)[0] + 1
+        for run in np.split(idx, breaks):
+            best = run[np.argmax(score[run])]
+            in_10th = [names[b] for b in benefic_idx
+                       if _arc_len(mc[best], fine[best, b] % 360.0) < _arc_len(mc[best], c11[best])]
+            windows.append({
+                "start": t[run[0]], "end": t[run[-1]] + step, "best": t[best],
+                "score": round(float(score[best]), 3),
+                "ascendant": ZODIAC[int(asc[best] // 30)]["name"],
+                "moon": ZODIAC[int(fine[best, moon_i] % 360.0 // 30)]["name"],
+                "moon_waxing": bool(waxing[best]),
+                "benefics_in_10th": in_10th,
+                "benefic_mc_distance": round(float(min(angle_distance(fine[best, b], mc[best]) for b in benefic_idx)), 2),
+            })
+    windows.sort(key=lambda w: (-w["score"], -(w["end"] - w["start"])))
+
+    zone = pytz.timezone(tz)
+    out = []
+    for w in windows[:limit]:
+        minutes = int(round((w["end"] - w["start"]) * 1440))
+        for key in ("start", "end", "best"):
+            w[key] = datetime.fromisoformat(jd_to_iso(w[key])).astimezone(zone).isoformat()
+        out.append({**w, "minutes": minutes})
+    return {
+        "windows": out,
+        "stats": {
+            "found": len(windows),
+            "coarse_cells": int(len(keep)), "cells_searched": int(len(cells)),
+            "fine_samples": int(len(t)), "void_periods": len(voc),
+        },
+    }
+
+def sign_index(name: str) -> Optional[int]:
+    """星座中文名或英文名（不分大小寫）→ 索引；找不到回傳 None。"""
+    key = name.strip().casefold()
+    for i, z in enumerate(ZODIAC):
+        if key in (z["name"].casefold(), z["name"][:-1].casefold(), z["abbr"].casefold()):
+            return i
+    return None
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+離線地名索引（GeoNames cities 檔，如 cities15000.txt / cities5000.txt）。
+
+- 啟動時載入，名稱、ASCII 名稱與所有別名（含中文）都建成排序陣列
+- 前綴查詢以 bisect 找出範圍，依「完全相符 > 人口」排序
+- resolve() 只接受完全相符的地名（可加「, 國碼」），供 /api/chart 略過 Nominatim
+
+GeoNames 檔案格式（tab 分隔）：https://download.geonames.org/export/dump/readme.txt
+"""
+import heapq
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from geocache import normalize_place
+
+# 單一前綴最多檢查的候選數（例如只輸入一個字母時），避免掃描整個範圍
+SCAN_LIMIT = 5000
+
+@dataclass
+class City:
+    name: str
+    country: str
+    admin1: str
+    lat: float
+    lon: float
+    timezone: str
+    population: int
+
+def normalize_key(text: str) -> str:
+    # 臺 / 台 視為同一字，其餘沿用地理編碼快取的正規化
+    return normalize_place(text).replace("臺", "台")
+
+def _split_country(query: str) -> Tuple[str, Optional[str]]:
+    """「Tokyo, JP」-> ("Tokyo", "JP")；結尾不是兩碼國碼時原樣回傳。"""
+    head, sep, tail = query.rpartition(",")
+    tail = tail.strip()
+    if sep and len(tail) == 2 and tail.isascii() and tail.isalpha():
+        return head, tail.upper()
+    return query, None
+
+class Gazetteer:
+    def __init__(self, cities: List[City] = None, names: List[Tuple[str, int, str]] = None):
+        self.cities = cities or []
+        # (正規化鍵, city index, 原始名稱)，依鍵排序
+        names = sorted(names or [])
+        self._keys = [k for k, _i, _n in names]
+        self._ids = [i for _k, i, _n in names]
+        self._labels = [n for _k, _i, n in names]
+
+    @classmethod
+    def load(cls, path: str) -> "Gazetteer":
+        cities: List[City] = []
+        names: List[Tuple[str, int, str]] = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 18:
+                    continue
+                idx = len(cities)
+                cities.append(City(
+                    name=cols[1], country=cols[8], admin1=cols[10],
+                    lat=float(cols[4]), lon=float(cols[5]),
+                    timezone=cols[17], population=int(cols[14] or 0),
+                ))
+                seen = set()
+                for label in [cols[1], cols[2], *cols[3].split(",")]:
+                    key = normalize_key(label)
+                    if key and key not in seen:
+                        seen.add(key)
+                        names.append((key, idx, label.strip()))
+        return cls(cities, names)
+
+    def __len__(self) -> int:
+        return len(self.cities)
+
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        lo = bisect_left(self._keys, prefix)
+        hi = bisect_left(self._keys, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    def suggest(self, query: str, limit: int = 10) -> List[Dict]:
+        text, country = _split_country(query)
+        prefix = normalize_key(text)
+        if not prefix:
+            return []
+        lo, hi = self._range(prefix)
+        # 每個城市保留一個顯示名稱：完全相符者優先，其次為主要名稱
+        best: Dict[int, Tuple[bool, bool, str]] = {}
+        for pos in range(lo, min(hi, lo + SCAN_LIMIT)):
+            idx = self._ids[pos]
+            city = self.cities[idx]
+            if country and city.country != country:
+                continue
+            label = self._labels[pos]
+            cand = (self._keys[pos] == prefix, label == city.name, label)
+            if idx not in best or cand[:2] > best[idx][:2]:
+                best[idx] = cand
+        top = heapq.nlargest(limit, best.items(), key=lambda item: (item[1][0], self.cities[item[0]].population))
+        return [self._payload(idx, label) for idx, (_exact, _primary, label) in top]
+
+    def resolve(self, place: str) -> Optional[City]:
+        """完全相符的地名（同名時取人口最多者）；找不到回傳 None。"""
+        text, country = _split_country(place)
+        key = normalize_key(text)
+        if not key:
+            return None
+        lo, hi = self._range(key)
+        matches = [self.cities[self._ids[pos]] for pos in range(lo, hi) if self._keys[pos] == key]
+        if country:
+            matches = [c for c in matches if c.country == country]
+        return max(matches, key=lambda c: c.population, default=None)
+
+    def _payload(self, idx: int, label: str) -> Dict:
+        city = self.cities[idx]
+        display = f"{city.name}, {city.country}"
+        return {
+            "label": f"{label}（{display}）" if normalize_key(label) != normalize_key(city.name) else display,
+            "name": city.name,
+            "country": city.country,
+            "admin1": city.admin1,
+            "latitude": city.lat,
+            "longitude": city.lon,
+            "timezone": city.timezone,
+            "population": city.population,
+        }
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+地理編碼快取：SQLite 持久化 + TTL + 進行中請求合併 + 對上游限速。
+
+- 鍵為正規化後的地名（NFKC、去頭尾空白、壓縮空白、不分大小寫）加語言
+- 找不到的地名也會快取（較短的 TTL），避免重複打 Nominatim
+- 同一地名同時有多個請求時只查一次，其餘等待同一個結果
+- Nominatim 限制每秒 1 次，實際呼叫之間至少間隔 min_interval 秒
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Optional, Tuple
+
+Place = Tuple[float, float, str]  # (緯度, 經度, 地址)
+
+def normalize_place(place: str) -> str:
+    text = unicodedata.normalize("NFKC", place).strip().casefold()
+    return " ".join(text.split())
+
+class GeocodeCache:
+    def __init__(self, path: str, geocode: Callable[[str, str], Optional[Place]],
+                 ttl: float = 30 * 86400, negative_ttl: float = 3600, min_interval: float = 1.0):
+        self.geocode = geocode
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.min_interval = min_interval
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            " key TEXT PRIMARY KEY, lat REAL, lon REAL, address TEXT, created REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._throttle: Optional[asyncio.Lock] = None
+        self._last_call = 0.0
+
+    @staticmethod
+    def key(place: str, language: str) -> str:
+        return f"{language}|{normalize_place(place)}"
+
+    def _get(self, key: str):
+        with self._db_lock:
+            row = self._db.execute("SELECT lat, lon, address, created FROM geocode WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        lat, lon, address, created = row
+        ttl = self.ttl if lat is not None else self.negative_ttl
+        if time.time() - created > ttl:
+            return None
+        return ("hit", (lat, lon, address) if lat is not None else None)
+
+    def _put(self, key: str, value: Optional[Place]):
+        lat, lon, address = value if value is not None else (None, None, None)
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO geocode (key, lat, lon, address, created) VALUES (?, ?, ?, ?, ?)",
+                (key, lat, lon, address, time.time()),
+            )
+            self._db.commit()
+
+    async def _fetch(self, key: str, place: str, language: str) -> Optional[Place]:
+        if self._throttle is None:
+            self._throttle = asyncio.Lock()
+        async with self._throttle:
+            wait = self._last_call + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                value = await asyncio.to_thread(self.geocode, place, language)
+            finally:
+                self._last_call = time.monotonic()
+        await asyncio.to_thread(self._put, key, value)
+        return value
+
+    async def lookup(self, place: str, language: str = "zh-TW") -> Optional[Place]:
+        """回傳 (lat, lon, address)；找不到回傳 None。上游錯誤會原樣拋出（不寫入快取）。"""
+        key = self.key(place, language)
+        cached = await asyncio.to_thread(self._get, key)
+        if cached is not None:
+            self.hits += 1
+            return cached[1]
+
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._fetch(key, place, language))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _f: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._db_lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses, "inflight": len(self._inflight)}
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+AI 解讀快取（SQLite）。
+
+鍵為 fingerprint(提示版本, 模型, 星盤重點欄位…) 的 sha256；欄位由呼叫端正規化
+（見 app.interpret_key：星座、落宮、相位種類，不含度數），修改提示詞時調整 PROMPT_VERSION 即可讓舊快取失效。
+只有完整結束的串流才會寫入。
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+def fingerprint(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class InterpretationCache:
+    def __init__(self, path: str):
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS interpretation ("
+            " key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT text FROM interpretation WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO interpretation (key, text, created) VALUES (?, ?, ?)",
+                (key, text, time.time()),
+            )
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM interpretation").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+月亮事件：新月／滿月、換座、與行星的精確相位、空亡（Void of Course）。
+
+空亡採傳統定義：月亮在目前星座中對太陽到土星的最後一個主要相位之後，到進入下一星座為止；
+整個星座都沒有相位時，從進入該星座起算。事件時間以 transits.refine 求根（精度 1 秒）。
+月亮一定順行且比任何行星快，月亮與行星的相對黃經隨時間單調遞增。
+"""
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import swisseph as swe  # pyswisseph
+
+from chart import PLANETS, ZODIAC
+from transits import GRID_DAYS, _aspect_targets, _brackets, _grid, _lon_speed, _sign_changes, _wrap180, refine, sample_grid
+
+# 空亡只看傳統行星
+VOC_BODIES = ["太陽", "水星", "金星", "火星", "木星", "土星"]
+# 月亮約 2.5 天換一個星座；查詢區間前後多取的天數，確保包含前一次換座
+SIGN_MARGIN_DAYS = 3.0
+
+def moon_ingresses(jd_start: float, jd_end: float) -> List[Tuple[float, int]]:
+    """區間內月亮進入新星座的時刻：[(jd, 星座索引)]，依時間排序。"""
+    f = _lon_speed(swe.MOON)
+    jds = _grid(jd_start, jd_end, GRID_DAYS["月亮"])
+    lon, _speed = sample_grid(jds, swe.MOON)
+    boundary = (np.floor(lon[:-1] / 30.0) + 1) * 30.0
+    before, after = _wrap180(lon[:-1] - boundary), _wrap180(lon[1:] - boundary)
+    out = []
+    for t in _sign_changes(before, after)[0]:
+        cusp = boundary[t]
+
+        def g(jd, cusp=cusp):
+            l, s = f(jd)
+            return float(_wrap180(l - cusp)), s
+
+        out.append((refine(g, jds[t], jds[t + 1], before[t], after[t]), int(cusp % 360.0 // 30)))
+    return out
+
+def moon_aspects(jd_start: float, jd_end: float, bodies: Sequence[str] = VOC_BODIES) -> List[Dict]:
+    """區間內月亮與各行星的精確主要相位：{"jd", "body", "aspect", "exact"}，依時間排序。"""
+    pid_of = {name: pid for name, pid, _glyph in PLANETS}
+    moon = _lon_speed(swe.MOON)
+    targets = _aspect_targets()
+    target_angles = np.array([t[2] for t in targets])
+    jds = _grid(jd_start, jd_end, GRID_DAYS["月亮"])
+    moon_lon, _speed = sample_grid(jds, swe.MOON)
+
+    out = []
+    for body in bodies:
+        planet = _lon_speed(pid_of[body])
+        lon, _speed = sample_grid(jds, pid_of[body])
+        diff = _wrap180((moon_lon - lon)[:, None] - target_angles[None, :])
+        for t, k in zip(*_brackets(diff)):
+
+            def g(jd, target=target_angles[k]):
+                (m, ms), (p, ps) = moon(jd), planet(jd)
+                return float(_wrap180(m - p - target)), ms - ps
+
+            name, angle, _target = targets[k]
+            jd = refine(g, jds[t], jds[t + 1], diff[t, k], diff[t + 1, k])
+            out.append({"jd": jd, "body": body, "aspect": name, "exact": angle})
+    out.sort(key=lambda e: e["jd"])
+    return out
+
+def lunations(jd_start: float, jd_end: float) -> List[Dict]:
+    """區間內的新月與滿月：{"jd", "phase", "lon"}（lon 為月亮黃經），依時間排序。"""
+    sun, moon = _lon_speed(swe.SUN), _lon_speed(swe.MOON)
+    jds = _grid(jd_start, jd_end, GRID_DAYS["月亮"])
+    elong = _wrap180(sample_grid(jds, swe.MOON)[0] - sample_grid(jds, swe.SUN)[0])
+    out = []
+    for phase, target in (("新月", 0.0), ("滿月", 180.0)):
+        diff = _wrap180(elong - target)
+        for t in _brackets(diff)[0]:
+
+            def g(jd, target=target):
+                (m, ms), (s, ss) = moon(jd), sun(jd)
+                return float(_wrap180(m - s - target)), ms - ss
+
+            jd = refine(g, jds[t], jds[t + 1], diff[t], diff[t + 1])
+            out.append({"jd": jd, "phase": phase, "lon": round(moon(jd)[0], 4)})
+    out.sort(key=lambda e: e["jd"])
+    return out
+
+def void_of_course(jd_start: float, jd_end: float) -> List[Dict]:
+    """
+    與 [jd_start, jd_end] 重疊的空亡區間：{"start", "end"（皆為 jd）, "sign", "last_aspect"}。
+    last_aspect 為開始空亡前的最後一個相位（整個星座無相位時為 None）。
+    """
+    ingresses = moon_ingresses(jd_start - SIGN_MARGIN_DAYS, jd_end + SIGN_MARGIN_DAYS)
+    aspects = moon_aspects(jd_start - 2 * SIGN_MARGIN_DAYS, jd_end + SIGN_MARGIN_DAYS)
+    times = np.array([a["jd"] for a in aspects])
+    out = []
+    for (entered, sign), (left, _next) in zip(ingresses, ingresses[1:]):
+        i = int(np.searchsorted(times, left)) - 1
+        last = aspects[i] if i >= 0 and times[i] > entered else None
+        start = last["jd"] if last else entered
+        if left > jd_start and start < jd_end:
+            out.append({"start": start, "end": left, "sign": ZODIAC[sign]["name"], "last_aspect": last})
+    return out
@@ -16,6 +16,39 @@ $("btnGeo").addEventListener("click", () => {
   );
 });
 
+// 出生地自動完成（離線地名索引）
+let placeSuggestions = [];
+let suggestTimer = null;
+$("place").addEventListener("input", () => {
+  const q = $("place").value.trim();
+  const picked = placeSuggestions.find(p => p.label === q);
+  if (picked){
+    $("lat").value = picked.latitude.toFixed(6);
+    $("lng").value = picked.longitude.toFixed(6);
+    return;
+  }
+  clearTimeout(suggestTimer);
+  if (!q) return;
+  suggestTimer = setTimeout(async () => {
+    try{
+      const res = await fetch(`/api/places/suggest?q=${encodeURIComponent(q)}&limit=8`);
+      if (!res.ok) return;
+      const data = await res.json();
+      if (data.query !== $("place").value.trim()) return;
+      placeSuggestions = data.results;
+      $("placeList").innerHTML = "";
+      for (const p of placeSuggestions){
+        const opt = document.createElement("option");
+        opt.value = p.label;
+        opt.textContent = p.timezone;
+        $("placeList").appendChild(opt);
+      }
+    }catch(e){
+      console.error(e);
+    }
+  }, 120);
+});
+
 $("btnCalc").addEventListener("click", async () => {
   const place = $("place").value.trim();
   const lat = $("lat").value ? parseFloat($("lat").value) : null;
@@ -172,6 +205,12 @@ function fillTables(data){
       gt.appendChild(div);
     }
   }
+  for (const p of (data.patterns || [])){
+    const div = document.createElement("div");
+    div.className = "gt";
+    div.textContent = p.text;
+    gt.appendChild(div);
+  }
 }
 
 function aspectClass(type, importance){
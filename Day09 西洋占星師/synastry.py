@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+合盤：比較盤（兩人天體交互相位、落入對方宮位）與中點組合盤。
+
+交互相位以 aspects 的角距矩陣一次算完 n × m；落宮以排序後的宮首二分搜尋（chart.houses_for）。
+組合盤的天體取兩人對應點的短弧中點，宮首以上升點中點為起點，組合盤天體再依組合宮首落宮。
+"""
+from typing import Any, Dict, List
+
+import numpy as np
+
+from aspects import detect_aspects, detect_cross_aspects
+from chart import HOUSE_MEANINGS, PLANETS, format_dms, houses_for
+
+PLANET_NAMES = [name for name, _pid, _glyph in PLANETS]
+
+def midpoint(a, b):
+    """短弧中點（相差恰好 180° 時取 a 往順時針方向的中點）。"""
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return np.mod(a + (np.mod(b - a + 180.0, 360.0) - 180.0) / 2.0, 360.0)
+
+def _cusps(chart: Dict[str, Any]) -> List[float]:
+    return [h["cusp"] for h in chart["houses"]]
+
+def house_overlay(positions: Dict[str, float], cusps: List[float]) -> Dict[str, int]:
+    """一方的天體落在另一方的第幾宮。"""
+    houses = houses_for(list(positions.values()), cusps)
+    return {name: int(h) for name, h in zip(positions.keys(), houses)}
+
+def aspect_matrix(aspects: List[Dict[str, Any]], rows: List[str], cols: List[str]) -> List[List[Any]]:
+    """rows × cols 的表格，每格為最緊密相位的名稱（沒有相位為 None）。"""
+    cells: Dict[str, Dict[str, Any]] = {}
+    for a in aspects:
+        if a["pair"] not in cells or a["off_exact"] < cells[a["pair"]]["off_exact"]:
+            cells[a["pair"]] = a
+    return [[cells[f"{r}–{c}"]["type"] if f"{r}–{c}" in cells else None for c in cols] for r in rows]
+
+def composite(chart_a: Dict[str, Any], chart_b: Dict[str, Any]) -> Dict[str, Any]:
+    # 宮首逐一取短弧中點可能錯序；改為上升點取中點，其餘宮首取「相對上升點偏移」的平均
+    cusps_a, cusps_b = np.asarray(_cusps(chart_a)), np.asarray(_cusps(chart_b))
+    start = float(midpoint(cusps_a[0], cusps_b[0]))
+    offsets = (np.mod(cusps_a - cusps_a[0], 360.0) + np.mod(cusps_b - cusps_b[0], 360.0)) / 2.0
+    cusps = np.mod(start + offsets, 360.0).tolist()
+
+    names = PLANET_NAMES
+    lons = midpoint([chart_a["positions"][n] for n in names], [chart_b["positions"][n] for n in names])
+    houses = houses_for(lons, cusps)
+    positions = {n: float(l) for n, l in zip(names, lons)}
+    details = {
+        n: {"name": n, "lon": positions[n], "sign": format_dms(positions[n]), "house": int(h)}
+        for n, h in zip(names, houses)
+    }
+    asc = cusps[0]
+    return {
+        "positions": {"上升": asc, **positions},
+        "details": details,
+        "ascendant": {"lon": asc, "sign": format_dms(asc)},
+        "houses": [
+            {"house": i, "cusp": c, "cusp_text": format_dms(c)["text"], "meaning": HOUSE_MEANINGS.get(i, ""),
+             "occupants": [n for n in names if details[n]["house"] == i]}
+            for i, c in enumerate(cusps, start=1)
+        ],
+        "aspects": detect_aspects(positions),
+    }
+
+def synastry(chart_a: Dict[str, Any], chart_b: Dict[str, Any]) -> Dict[str, Any]:
+    """chart_a / chart_b 為 calc_chart 的結果。天體含上升點。"""
+    pos_a, pos_b = chart_a["positions"], chart_b["positions"]
+    aspects = detect_cross_aspects(pos_a, pos_b, labels=("A", "B"))
+    rows, cols = [f"A{n}" for n in pos_a], [f"B{n}" for n in pos_b]
+    return {
+        "aspects": aspects,
+        "matrix": {"rows": rows, "cols": cols, "cells": aspect_matrix(aspects, rows, cols)},
+        "overlays": {
+            "a_in_b": house_overlay(pos_a, _cusps(chart_b)),
+            "b_in_a": house_overlay(pos_b, _cusps(chart_a)),
+        },
+        "composite": composite(chart_a, chart_b),
+    }
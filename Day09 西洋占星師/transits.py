@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+行運時間軸：在日期區間內找出行運行星對本命點的精確相位、換座與停滯（順逆轉換）。
+
+1. 以粗網格（依行星速度，每格 0.25–10 天）取得各行運行星黃經與速度（有星曆表時用插值）
+2. 每顆行運行星對所有（本命點, 相位角）一次計算 wrap180(行運 − 本命 − 角度)，
+   以 NumPy 找出相鄰網格點間的變號（排除 ±180° 的折返跳動）
+3. 每個區間以 Newton 法（導數即行星速度）求根，跳出區間時改用二分法
+
+逆行造成的多次通過會各自成為一個事件；停滯點附近兩次通過落在同一格內時可能漏算，
+可調小 resolution 改善。
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import swisseph as swe  # pyswisseph
+
+from aspects import ASPECTS
+from chart import PLANETS, ZODIAC
+from ephemeris import default_table
+
+# 預設不含月亮（每月繞一圈，一年會產生上千個事件）
+DEFAULT_BODIES = [name for name, _pid, _glyph in PLANETS if name != "月亮"]
+# 各天體的網格間距（天）：每格移動不超過約 2°，外行星可用較粗的網格
+GRID_DAYS = {
+    "太陽": 1.0, "月亮": 0.25, "水星": 1.0, "金星": 1.0, "火星": 2.0,
+    "木星": 5.0, "土星": 5.0, "天王星": 10.0, "海王星": 10.0, "冥王星": 10.0,
+}
+TOLERANCE_DAYS = 1.0 / 86400  # 求根精度：1 秒
+
+def _wrap180(x):
+    return (np.asarray(x) + 180.0) % 360.0 - 180.0
+
+def jd_to_iso(jd: float) -> str:
+    y, m, d, hours = swe.revjul(jd, swe.GREG_CAL)
+    dt = datetime(y, m, d, tzinfo=timezone.utc) + timedelta(hours=hours)
+    return (dt + timedelta(microseconds=500000)).replace(microsecond=0).isoformat()
+
+def iso_to_jd(dt: datetime) -> float:
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    hours = dt.hour + dt.minute / 60.0 + dt.second / 3600.0
+    return swe.julday(dt.year, dt.month, dt.day, hours, swe.GREG_CAL)
+
+def _lon_speed(pid: int) -> Callable[[float], Tuple[float, float]]:
+    def f(jd: float) -> Tuple[float, float]:
+        res = swe.calc_ut(jd, pid)[0]
+        return res[0], res[3]
+    return f
+
+def sample_grid(jds: np.ndarray, pid: int) -> Tuple[np.ndarray, np.ndarray]:
+    """單一天體在網格上的 (黃經, 速度)。有預算星曆表時用插值（只用來找區間，求根仍用 swe）。"""
+    table = default_table()
+    if table is not None and table.covers(float(jds[0]), float(jds[-1])):
+        lon, speed = table.positions(jds, [pid])
+        return lon[:, 0], speed[:, 0]
+    lon = np.empty(len(jds))
+    speed = np.empty(len(jds))
+    for t, jd in enumerate(jds):
+        res = swe.calc_ut(float(jd), pid)[0]
+        lon[t], speed[t] = res[0], res[3]
+    return lon, speed
+
+def _grid(jd_start: float, jd_end: float, step: float) -> np.ndarray:
+    n = max(1, int(np.ceil((jd_end - jd_start) / step)))
+    return np.linspace(jd_start, jd_end, n + 1)
+
+def _sign_changes(a: np.ndarray, b: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """a → b 變號（且不是 ±180° 折返）的位置；回傳 np.nonzero 的索引組。"""
+    return np.nonzero(((a < 0) != (b < 0)) & (np.abs(b - a) < 180.0))
+
+def _brackets(values: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """第 0 軸相鄰兩個網格點之間的變號。"""
+    return _sign_changes(values[:-1], values[1:])
+
+def refine(f: Callable[[float], Tuple[float, Optional[float]]], a: float, b: float, fa: float, fb: float,
+           tol: float = TOLERANCE_DAYS, max_iter: int = 60) -> float:
+    """
+    在 [a, b] 內求 f 的根（f 回傳 (值, 導數或 None)）。以割線估計起步，
+    之後用 Newton 法；步驟跳出區間或沒有導數時改用二分法。
+    """
+    t = a + (b - a) * fa / (fa - fb) if fa != fb else (a + b) / 2
+    for _ in range(max_iter):
+        v, slope = f(t)
+        if v == 0:
+            return t
+        if (v < 0) == (fa < 0):
+            a, fa = t, v
+        else:
+            b = t
+        step = t - v / slope if slope else None
+        if step is not None and a < step < b:
+            if abs(step - t) < tol:
+                return step
+            t = step
+        else:
+            if b - a < tol:
+                break
+            t = (a + b) / 2
+    return (a + b) / 2
+
+def _aspect_targets() -> List[Tuple[str, int, float]]:
+    """(相位名稱, 相位角, 目標差角)；合相與對分相各一個，其餘為 ±角度。"""
+    out = []
+    for name, angle, _orb in ASPECTS:
+        # ±180° 是同一個目標，先 wrap 再去重
+        for target in sorted({float(_wrap180(angle)), float(_wrap180(-angle))}):
+            out.append((name, angle, target))
+    return out
+
+def transit_events(natal: Dict[str, float], jd_start: float, jd_end: float,
+                   bodies: Sequence[str] = DEFAULT_BODIES, resolution: float = 1.0) -> List[Dict]:
+    """
+    natal 為本命點黃經（如 calc_chart 的 positions）。回傳依時間排序的事件：
+    - aspect: 行運行星與本命點形成精確相位
+    - ingress: 行運行星進入新星座
+    - station: 行運行星停滯（速度變號），direction 為「逆行」或「順行」
+
+    resolution 為 GRID_DAYS 的倍率（< 1 為更細的網格）。
+    """
+    pid_of = {name: pid for name, pid, _glyph in PLANETS}
+    natal_names = list(natal.keys())
+    natal_lons = np.array([natal[n] for n in natal_names], dtype=float)
+    targets = _aspect_targets()
+    target_angles = np.array([t[2] for t in targets])
+
+    events = []
+    for body in bodies:
+        f = _lon_speed(pid_of[body])
+        jds = _grid(jd_start, jd_end, GRID_DAYS[body] * resolution)
+        lon, speed = sample_grid(jds, pid_of[body])
+
+        # 相位：(時間, 本命點, 目標角)
+        diff = _wrap180(lon[:, None, None] - natal_lons[None, :, None] - target_angles[None, None, :])
+        for t, n, k in zip(*_brackets(diff)):
+            offset = natal_lons[n] + target_angles[k]
+
+            def g(jd, offset=offset):
+                l, s = f(jd)
+                return float(_wrap180(l - offset)), s
+
+            jd = refine(g, jds[t], jds[t + 1], diff[t, n, k], diff[t + 1, n, k])
+            name, angle, _target = targets[k]
+            events.append({"type": "aspect", "jd": jd, "transit": body, "natal": natal_names[n],
+                           "aspect": name, "exact": angle, "retrograde": f(jd)[1] < 0})
+
+        # 換座：與行進方向上下一個星座邊界的差角
+        boundary = (np.floor(lon[:-1] / 30.0) + (speed[:-1] >= 0)) * 30.0
+        before, after = _wrap180(lon[:-1] - boundary), _wrap180(lon[1:] - boundary)
+        for t in _sign_changes(before, after)[0]:
+            cusp = boundary[t]
+
+            def g(jd, cusp=cusp):
+                l, s = f(jd)
+                return float(_wrap180(l - cusp)), s
+
+            jd = refine(g, jds[t], jds[t + 1], before[t], after[t])
+            retro = f(jd)[1] < 0
+            sign = int(((cusp - 30.0 if retro else cusp) % 360.0) // 30)
+            events.append({"type": "ingress", "jd": jd, "body": body, "sign": ZODIAC[sign]["name"], "retrograde": retro})
+
+        # 停滯：速度變號
+        for t in _brackets(speed)[0]:
+            jd = refine(lambda jd: (f(jd)[1], None), jds[t], jds[t + 1], speed[t], speed[t + 1], tol=60.0 / 86400)
+            l = f(jd)[0]
+            events.append({"type": "station", "jd": jd, "body": body, "direction": "逆行" if speed[t] > 0 else "順行",
+                           "lon": round(l, 4), "sign": ZODIAC[int(l % 360 // 30)]["name"]})
+
+    events.sort(key=lambda e: e["jd"])
+    for e in events:
+        e["time"] = jd_to_iso(e.pop("jd"))
+    return events